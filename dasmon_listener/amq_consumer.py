@@ -12,8 +12,7 @@ import logging
 import json
 import os
 import datetime
-import smtplib
-from email.mime.text import MIMEText
+import calendar
 
 if os.path.isfile("settings.py"):
     logging.warning("Using local settings.py file")
@@ -25,7 +24,18 @@ import settings
 from settings import INSTALLATION_DIR
 from settings import PURGE_TIMEOUT
 from settings import IMAGE_PURGE_TIMEOUT
+from settings import PURGE_TIME_BUDGET
+from settings import PURGE_CHUNK_SIZE
 from settings import MIN_NOTIFICATION_LEVEL
+from settings import STATUS_BATCH_SIZE
+from settings import STATUS_FLUSH_INTERVAL
+from settings import CACHE_FLUSH_INTERVAL
+from settings import WRITER_QUEUE_SIZE
+from settings import SMTP_HOST, SMTP_PORT
+from settings import NOTIFICATION_DIGEST_WINDOW, NOTIFICATION_RATE_LIMIT
+from settings import METRICS_PORT
+from settings import SNAPSHOT_FILE, SNAPSHOT_INTERVAL
+from settings import DEDUP_CAPACITY, DEDUP_WINDOW
 sys.path.append(INSTALLATION_DIR)
 
 import django
@@ -33,17 +43,47 @@ if django.VERSION[1] >= 7:
     django.setup()
 from django.utils import timezone
 
-from dasmon.models import StatusVariable, Parameter, StatusCache, Signal, UserNotification
-from pvmon.models import PV, PVCache, PVString, PVStringCache, MonitoredVariable
+from dasmon.models import StatusVariable, Parameter, Signal, UserNotification
+from dasmon.snapshot import SnapshotWriter
+from pvmon.models import PVName
 try:
     from report.models import Instrument
 except:
     from workflow.database.report.models import Instrument
-from file_handling.models import ReducedImage
+from workflow.database.registry import get_table, get_statistics
+from workflow import metrics
+from workflow.dedup import Deduplicator
+from write_behind import StatusVariableBuffer, StatusCacheBuffer, PVBuffer, CommitWatcher
+from storage_policy import StoragePolicy
+from writer_pool import WriterPool
+from purge import PurgeWorker
+from notifier import Notifier
 
 # ACK data
 acks = {}
 
+# Buffer of StatusVariable entries waiting to be written to the DB
+status_buffer = StatusVariableBuffer(batch_size=STATUS_BATCH_SIZE,
+                                     flush_interval=STATUS_FLUSH_INTERVAL)
+
+# Latest value of each DASMON parameter, written to the StatusCache table periodically
+status_cache = StatusCacheBuffer(flush_interval=CACHE_FLUSH_INTERVAL)
+
+# Buffer of PV values received on PV topics
+pv_buffer = PVBuffer(batch_size=STATUS_BATCH_SIZE,
+                     flush_interval=STATUS_FLUSH_INTERVAL)
+
+# Messages whose entries are still in the buffers, to record their latency once written
+commit_watcher = CommitWatcher([status_buffer, status_cache, pv_buffer])
+
+# Per-parameter storage policies, applied against the last cached values
+storage_policy = StoragePolicy(last_value=status_cache.get)
+
+# Email notifications are sent in the background
+notifier = Notifier(host=SMTP_HOST, port=SMTP_PORT,
+                    digest_window=NOTIFICATION_DIGEST_WINDOW,
+                    rate_limit=NOTIFICATION_RATE_LIMIT)
+
 # Extra logs
 EXTRA_LOGS = True
 
@@ -62,44 +102,85 @@ class Listener(stomp.ConnectionListener):
         messages.
     """
 
-    def __init__(self):
+    def __init__(self, number_of_threads=0):
+        """
+            @param number_of_threads: number of DB writer threads. If zero, messages are processed on the receiver thread.
+        """
         super(Listener, self).__init__()
-        # Get a snapshot of the current set of instruments
-        # Turn the QuerySet into a list to ensure that the query
-        # is executed now as opposed to every time we need an instrument
-        self._instruments = list(Instrument.objects.all())
+        # Instruments and parameters are looked up in process-wide
+        # lookup tables to avoid going to the DB for every message
+        self._instruments = get_table(Instrument)
+        self._parameters = get_table(Parameter)
+
+        # Recently received message IDs, to drop redelivered messages.
+        # Messages are acknowledged automatically: duplicates are never held.
+        self._dedup = Deduplicator(capacity=DEDUP_CAPACITY, window=DEDUP_WINDOW,
+                                   hold_duplicates=False)
+
+        # Pool of threads doing the DB work
+        self._writer_pool = None
+        if number_of_threads > 0:
+            self._writer_pool = WriterPool(self.process_message,
+                                           number_of_threads=number_of_threads,
+                                           queue_size=WRITER_QUEUE_SIZE)
 
-        # Do the same thing for the list of parameters
-        self._parameters = list(Parameter.objects.all())
+    def stop(self):
+        """
+            Process pending messages and stop the writer threads
+        """
+        if self._writer_pool is not None:
+            self._writer_pool.stop()
+            self._writer_pool = None
+
+    def stats(self):
+        """
+            Return the writer pool statistics, or None if we don't use a pool
+        """
+        if self._writer_pool is not None:
+            return self._writer_pool.stats()
+        return None
 
     def retrieve_parameter(self, key):
         """
             Retrieve of create a Parameter entry
         """
-        for key_id in self._parameters:
-            if str(key_id) == key:
-                return key_id
-        # If we haven't found it, create it.
-        key_id = Parameter(name=key)
-        key_id.save()
-        self._parameters.append(key_id)
-        return key_id
+        return self._parameters.get_or_create(key)
 
     def retrieve_instrument(self, instrument_name):
         """
             Retrieve or create an instrument given its name
         """
-        # Get or create the instrument object from the DB
-        for instrument in self._instruments:
-            if str(instrument) == instrument_name:
-                return instrument
-        # If we haven't found it, create it.
-        instrument = Instrument(name=instrument_name)
-        instrument.save()
-        self._instruments.append(instrument)
-        return instrument
+        return self._instruments.get_or_create(instrument_name)
 
     def on_message(self, headers, message):
+        """
+            Receive a message. The message is handed over to the
+            writer pool if we have one, or processed right away.
+            @param headers: message headers
+            @param message: JSON-encoded message content
+        """
+        if self._dedup.is_duplicate(headers):
+            metrics.registry.inc('amq_duplicates_total', {'process': 'dasmon_listener'},
+                                 help_text='Number of redelivered messages that were dropped')
+            return
+        if self._writer_pool is not None:
+            self._writer_pool.submit(headers, message)
+        else:
+            self.process_message(headers, message)
+
+    def process_message(self, headers, message):
+        """
+            Process a message and record its metrics.
+            @param headers: message headers
+            @param message: JSON-encoded message content
+        """
+        with metrics.registry.track_message(headers, 'dasmon_listener'):
+            self._process_message(headers, message)
+        # The listener runs in autocommit mode: the entries are committed
+        # once the buffers holding them are flushed
+        commit_watcher.processed(headers)
+
+    def _process_message(self, headers, message):
         """
             Process a message.
             @param headers: message headers
@@ -131,7 +212,10 @@ class Listener(stomp.ConnectionListener):
             logging.error(str(sys.exc_value))
             return
 
-        if "STATUS" in destination:
+        if is_pv_topic(destination):
+            process_PVs(instrument, data_dict)
+
+        elif "STATUS" in destination:
             # STS is the Streaming Translation Service, also referred to as STC.
             if "STS" in destination:
                 key_id = self.retrieve_parameter("system_sts")
@@ -205,27 +289,71 @@ class Listener(stomp.ConnectionListener):
                     key_id = self.retrieve_parameter(key)
                     store_and_cache(instrument, key_id, data_dict[key], timestamp=timestamp, cache_only=cache_only)
 
-def send_message(sender, recipients, subject, message):
+def record_committed():
+    """
+        Record the latency of the messages whose entries were written
+        by the last buffer flushes
     """
-        Send an email message
+    for headers in commit_watcher.committed():
+        metrics.registry.message_committed(headers, 'dasmon_listener')
+
+def publish_snapshot(writer):
+    """
+        Publish the latest value of every parameter for the web monitor
+        @param writer: SnapshotWriter object
+    """
+    instruments = dict([(item.id, item.name) for item in get_table(Instrument).items()])
+    parameters = dict([(item.id, item.name) for item in get_table(Parameter).items()])
+    data = {}
+    for instrument_id, key_id, value, timestamp in status_cache.items():
+        if instrument_id in instruments and key_id in parameters:
+            epoch = calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1.0e6
+            data.setdefault(instruments[instrument_id], {})[parameters[key_id]] = [value, epoch]
+    writer.publish(data)
+
+def is_pv_topic(destination):
+    """
+        Returns True if a destination carries PV updates, for instance /topic/SNS.BL6.APP.PV
+        @param destination: message destination
+    """
+    return 'PV' in destination.upper().split('.')[2:]
+
+def process_PVs(instrument_id, data):
+    """
+        Process PV updates. A message holds either a single update or a list of updates:
+            {"name": "BL6:Mot:Position", "value": 1.5, "status": 0, "timestamp": 1451606400}
+            {"pvs": [{"name": ...}, {"name": ...}]}
+        Numerical values are stored in the PV tables, strings in the PV string tables.
+        Only the cache is updated for PVs that are not monitored.
+        @param instrument_id: Instrument object
+        @param data: decoded message
+    """
+    if type(data) == dict and "pvs" in data:
+        updates = data["pvs"]
+    elif type(data) == list:
+        updates = data
+    else:
+        updates = [data]
+    pv_names = get_table(PVName)
+    for item in updates:
+        try:
+            name_id = pv_names.get_or_create(item["name"])
+            update_time = int(item["timestamp"]) if "timestamp" in item else int(time.time())
+            pv_buffer.append(instrument_id, name_id, item["value"], int(item.get("status", 0)),
+                             update_time, cache_only=not name_id.monitored)
+        except:
+            logging.error("Could not process PV update %s: %s", str(item), sys.exc_value)
+
+def send_message(sender, recipients, subject, message, digest_key=None):
+    """
+        Queue an email message. Emails are sent by the notifier thread.
         @param sender: email of the sender
         @param recipients: list of recipient emails
         @param subject: subject of the message
         @param message: content of the message
+        @param digest_key: repeated messages with the same key are merged into a digest
     """
-    # If no sender or recipients are defined, do nothing
-    if len(sender) == 0 or len(recipients) == 0:
-        return
-    try:
-        msg = MIMEText(message)
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = ';'.join(recipients)
-        s = smtplib.SMTP('localhost')
-        s.sendmail(sender, recipients, msg.as_string())
-        s.quit()
-    except:
-        logging.error("Could not send message: %s", sys.exc_value)
+    notifier.send(sender, recipients, subject, message, digest_key=digest_key)
 
 def process_SMS(instrument_id, headers, data):
     """
@@ -274,7 +402,8 @@ def process_ack(data=None, headers=None):
                     acks[proc_name] = None
                     send_message(sender=FROM_EMAIL, recipients=ALERT_EMAIL,
                                  subject="Client %s disappeared" % proc_name,
-                                 message="An AMQ client disappeared")
+                                 message="An AMQ client disappeared",
+                                 digest_key=('heartbeat_disappeared', proc_name))
         elif 'src_name' in data:
             current_time = time.time()
             msg_time = 0
@@ -298,7 +427,8 @@ def process_ack(data=None, headers=None):
                 logging.error("Client %s reappeared", proc_name)
                 send_message(sender=FROM_EMAIL, recipients=ALERT_EMAIL,
                              subject="Client %s reappeared" % proc_name,
-                             message="An AMQ client reappeared")
+                             message="An AMQ client reappeared",
+                             digest_key=('heartbeat_reappeared', proc_name))
             acks[proc_name] = time.time()
             if EXTRA_LOGS:
                 logging.warning("%s ACK deltas: msg=%s rcv=%s", proc_name, msg_time, answer_delay)
@@ -321,7 +451,8 @@ def notify_users(instrument_id, signal):
             message += "    Time:    %s\n" % signal.timestamp.ctime()
             send_message(sender=item.email, recipients=[item.email],
                          subject="New alert on %s" % str(instrument_id).upper(),
-                         message=message)
+                         message=message,
+                         digest_key=(instrument_id.id, signal.name, item.email))
     except:
         logging.error("Failed to notify users: %s", sys.exc_value)
 
@@ -420,32 +551,25 @@ def store_and_cache_(instrument_id, key_id, value, timestamp=None, cache_only=Fa
 
     datetime_timestamp = datetime.datetime.fromtimestamp(time.time()).replace(tzinfo=timezone.get_current_timezone())
     if cache_only is False:
-        status_entry = StatusVariable(instrument_id=instrument_id,
-                                      key_id=key_id,
-                                      value=value_string)
         # Force the timestamp value as needed
         if timestamp is not None:
             try:
                 datetime_timestamp = datetime.datetime.fromtimestamp(timestamp).replace(tzinfo=timezone.get_current_timezone())
-                status_entry.timestamp = datetime_timestamp
             except:
                 logging.error("Could not process timestamp [%s]: %s", timestamp, sys.exc_value)
-        status_entry.save()
-        datetime_timestamp = status_entry.timestamp
+                timestamp = None
+        # Skip the values the parameter's storage policy doesn't need
+        for stored_value in storage_policy.filter(instrument_id, key_id, value_string, now=timestamp):
+            status_entry = StatusVariable(instrument_id=instrument_id,
+                                          key_id=key_id,
+                                          value=stored_value)
+            if timestamp is not None:
+                status_entry.timestamp = datetime_timestamp
+            # The entry will be written to the DB with the next buffer flush
+            status_buffer.append(status_entry)
 
-    # Update the latest value
-    try:
-        last_value = StatusCache.objects.filter(instrument_id=instrument_id,
-                                                key_id=key_id).latest('timestamp')
-        last_value.value = value_string
-        last_value.timestamp = datetime_timestamp
-        last_value.save()
-    except:
-        last_value = StatusCache(instrument_id=instrument_id,
-                                 key_id=key_id,
-                                 value=value_string,
-                                 timestamp=datetime_timestamp)
-        last_value.save()
+    # Update the latest value. It will be written to the DB with the next cache flush.
+    status_cache.update(instrument_id, key_id, value_string, datetime_timestamp)
 
 
 class Client(object):
@@ -470,6 +594,10 @@ class Client(object):
         self._queues = queues
         self._consumer_name = consumer_name
         self._listener = None
+        self._purge_worker = None
+        self._metrics_server = None
+        ## Set to stop the listening loop. Only a flag, so that it can be set from a signal handler.
+        self._stop_requested = False
         logging.info("Dasmon Listener client 2.0")
 
     def set_listener(self, listener):
@@ -537,66 +665,109 @@ class Client(object):
         if self._connection is not None:
             self._connection.stop()
         self._connection = None
+        if self._purge_worker is not None:
+            self._purge_worker.stop()
+            self._purge_worker = None
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+            self._metrics_server = None
+        # Process pending messages and write out any pending status entries
+        if self._listener is not None:
+            self._listener.stop()
+        status_buffer.flush()
+        status_cache.flush()
+        pv_buffer.flush()
+        record_committed()
+        notifier.stop()
+
+    def request_stop(self):
+        """
+            Make listen_and_wait() return. This is safe to call from a
+            signal handler: call stop() once listen_and_wait() returned.
+        """
+        self._stop_requested = True
+
+    def _register_gauges(self):
+        """
+            Register the internal queue depths with the metrics registry
+        """
+        def _writer_depth():
+            stats = self._listener.stats() if self._listener is not None else None
+            return stats['depth'] if stats is not None else 0
+        def _writer_dropped():
+            stats = self._listener.stats() if self._listener is not None else None
+            return stats['dropped'] if stats is not None else 0
+        help_text = 'Number of items waiting in internal queues'
+        metrics.registry.register_gauge('queue_depth', _writer_depth, {'queue': 'writer_pool'}, help_text)
+        metrics.registry.register_gauge('queue_depth', lambda: len(status_buffer), {'queue': 'status_variables'}, help_text)
+        metrics.registry.register_gauge('queue_depth', lambda: len(status_cache), {'queue': 'status_cache'}, help_text)
+        metrics.registry.register_gauge('queue_depth', lambda: len(pv_buffer), {'queue': 'pv_values'}, help_text)
+        metrics.registry.register_gauge('queue_depth', lambda: notifier.stats()['queued'], {'queue': 'notifications'}, help_text)
+        metrics.registry.register_gauge('status_entries_suppressed', lambda: storage_policy.suppressed,
+                                        help_text='Number of status values skipped by the storage policies')
+        metrics.registry.register_gauge('writer_pool_dropped', _writer_dropped,
+                                        help_text='Number of messages dropped because the writer pool was full')
 
     def listen_and_wait(self, waiting_period=1.0):
         """
             Listen for the next message from the brokers.
-            This method will simply return once the connection is
-            terminated.
+            This method returns once request_stop() is called.
             @param waiting_period: sleep time between connection to a broker
         """
         # Get or create the "common" instrument object from the DB.
         # This dummy instrument is used for heartbeats and central services.
-        try:
-            common_instrument = Instrument.objects.get(name='common')
-        except Instrument.DoesNotExist:
-            common_instrument = Instrument(name='common')
-            common_instrument.save()
+        common_instrument = get_table(Instrument).get_or_create('common')
 
         # Retrieve the Parameter object for our own heartbeat
-        try:
-            pid_key_id = Parameter.objects.get(name="system_dasmon_listener_pid")
-        except:
-            pid_key_id = Parameter(name="system_dasmon_listener_pid")
-            pid_key_id.save()
+        pid_key_id = get_table(Parameter).get_or_create("system_dasmon_listener_pid")
+
+        # Start removing old entries in the background
+        if self._purge_worker is None:
+            self._purge_worker = PurgeWorker(PURGE_TIMEOUT, IMAGE_PURGE_TIMEOUT,
+                                             delay=PURGE_DELAY,
+                                             time_budget=PURGE_TIME_BUDGET,
+                                             chunk_size=PURGE_CHUNK_SIZE)
+            self._purge_worker.start()
+
+        # Serve throughput and latency metrics on a local port
+        if self._metrics_server is None:
+            self._register_gauges()
+            self._metrics_server = metrics.start_server(METRICS_PORT)
+
+        # Publish the latest values for the web monitor
+        snapshot_writer = None
+        if SNAPSHOT_FILE is not None:
+            snapshot_writer = SnapshotWriter(SNAPSHOT_FILE)
+        last_snapshot = 0
 
-        last_purge_time = None
         last_heartbeat = 0
-        while True:
+        while not self._stop_requested:
             try:
                 if self._connection is None or self._connection.is_connected() is False:
                     self.connect()
-                if last_purge_time is None or time.time() - last_purge_time > PURGE_DELAY:
-                    last_purge_time = time.time()
-                    # Remove old entries
-                    delta_time = datetime.timedelta(days=PURGE_TIMEOUT)
-                    cutoff = timezone.now() - delta_time
-                    StatusVariable.objects.filter(timestamp__lte=cutoff).delete()
-                    #StatusCache.objects.filter(timestamp__lte=cutoff).delete()
-
-                    # Remove old PVMON entries: first, the float values
-                    PV.objects.filter(update_time__lte=time.time() - PURGE_TIMEOUT * 24 * 60 * 60).delete()
-                    old_entries = PVCache.objects.filter(update_time__lte=time.time() - PURGE_TIMEOUT * 24 * 60 * 60)
-                    for item in old_entries:
-                        if len(MonitoredVariable.objects.filter(instrument=item.instrument,
-                                                                pv_name=item.name)) == 0:
-                            item.delete()
-                    # Remove old PVMON entries: second, the string values
-                    PVString.objects.filter(update_time__lte=time.time() - PURGE_TIMEOUT * 24 * 60 * 60).delete()
-                    old_entries = PVStringCache.objects.filter(update_time__lte=time.time() - PURGE_TIMEOUT * 24 * 60 * 60)
-                    for item in old_entries:
-                        if len(MonitoredVariable.objects.filter(instrument=item.instrument,
-                                                                pv_name=item.name)) == 0:
-                            item.delete()
-                    # Remove old images
-                    delta_time = datetime.timedelta(days=IMAGE_PURGE_TIMEOUT)
-                    cutoff = timezone.now() - delta_time
-                    ReducedImage.objects.filter(created_on__lte=cutoff).delete()
                 time.sleep(waiting_period)
+                status_buffer.flush_if_needed()
+                status_cache.flush_if_needed()
+                pv_buffer.flush_if_needed()
+                record_committed()
+                if snapshot_writer is not None and time.time() - last_snapshot > SNAPSHOT_INTERVAL / 1000.0:
+                    last_snapshot = time.time()
+                    try:
+                        publish_snapshot(snapshot_writer)
+                    except Exception:
+                        logging.error("Could not publish snapshot: %s", sys.exc_value)
                 try:
                     if time.time() - last_heartbeat > HEARTBEAT_DELAY:
                         last_heartbeat = time.time()
                         store_and_cache(common_instrument, pid_key_id, str(os.getpid()))
+                        if EXTRA_LOGS:
+                            logging.warning("Lookup tables: %s", str(get_statistics()))
+                            if self._listener is not None and self._listener.stats() is not None:
+                                logging.warning("Writer pool: %s", str(self._listener.stats()))
+                            if self._purge_worker is not None:
+                                logging.warning("Purge: %s", str(self._purge_worker.stats()))
+                            logging.warning("Notifications: %s", str(notifier.stats()))
+                            logging.warning("Storage policy: %s", str(storage_policy.stats()))
                         # Send ping request
                         if hasattr(settings, "PING_TOPIC"):
                             from settings import PING_TOPIC, ACK_TOPIC
@@ -609,9 +780,10 @@ class Client(object):
                             process_ack()
                         else:
                             logging.error("settings.PING_TOPIC is not defined")
-                except:
+                except Exception:
                     logging.error("Problem writing heartbeat %s", sys.exc_value)
-            except:
+            except Exception:
+                # SystemExit and KeyboardInterrupt stop the loop
                 logging.error("Problem connecting to AMQ broker %s", sys.exc_value)
                 time.sleep(5.0)
 
@@ -3,6 +3,7 @@
 """
 import sys
 import argparse
+import signal
 
 import logging
 import logging.handlers
@@ -26,6 +27,7 @@ from settings import brokers
 from settings import amq_user
 from settings import amq_pwd
 from settings import queues
+from settings import WRITER_THREADS
 
 class DasMonListenerDaemon(Daemon):
     """
@@ -37,8 +39,18 @@ class DasMonListenerDaemon(Daemon):
         """
         c = Client(brokers, amq_user, amq_pwd,
                    queues, "dasmon_listener")
-        c.set_listener(Listener())
+
+        def _shutdown(signum, frame):
+            """
+                Stop listening. The pending DB writes are flushed
+                by the main loop, outside of the signal handler.
+            """
+            c.request_stop()
+        signal.signal(signal.SIGTERM, _shutdown)
+
+        c.set_listener(Listener(number_of_threads=WRITER_THREADS))
         c.listen_and_wait(0.01)
+        c.stop()
 
 def run():
     """
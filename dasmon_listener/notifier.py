@@ -0,0 +1,222 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes, too-many-arguments
+"""
+    Asynchronous email notifications.
+
+    Emails are queued by the message processing threads and sent by a
+    dedicated thread, which keeps a single SMTP connection open
+    between emails.
+
+    Repeated alerts with the same digest key (for instance the same signal
+    on the same instrument, for the same recipient) are merged: the first
+    alert is sent right away, and the alerts that come in during the next
+    digest window are sent as a single digest email at the end of the window.
+
+    The number of emails sent per minute is limited. Emails that exceed
+    the limit wait in the queue. When the queue is full, new emails are dropped.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import socket
+import logging
+import smtplib
+import threading
+import Queue
+from email.mime.text import MIMEText
+
+
+class Notifier(threading.Thread):
+    """
+        Thread sending queued email notifications
+    """
+    ## Sentinel used to stop the thread
+    _STOP = None
+
+    def __init__(self, host='localhost', port=25, digest_window=300,
+                 rate_limit=30, queue_size=1000, idle_timeout=60):
+        """
+            @param host: SMTP server host
+            @param port: SMTP server port
+            @param digest_window: time during which repeated alerts are merged [secs]
+            @param rate_limit: maximum number of emails sent per minute
+            @param queue_size: maximum number of emails waiting to be sent
+            @param idle_timeout: time after which an unused SMTP connection is closed [secs]
+        """
+        super(Notifier, self).__init__(name="dasmon_notifier")
+        self.daemon = True
+        self._host = host
+        self._port = port
+        self._digest_window = digest_window
+        self._rate_limit = max(1, rate_limit)
+        self._idle_timeout = idle_timeout
+        self._queue = Queue.Queue(maxsize=queue_size)
+        ## Open digest windows, keyed by digest key
+        self._digests = {}
+        self._tokens = float(self._rate_limit)
+        self._last_refill = time.time()
+        self._smtp = None
+        self._last_used = 0
+        self._start_lock = threading.Lock()
+        ## Counters
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def send(self, sender, recipients, subject, message, digest_key=None):
+        """
+            Queue an email. The sender thread is started if needed.
+            @param sender: email of the sender
+            @param recipients: list of recipient emails
+            @param subject: subject of the message
+            @param message: content of the message
+            @param digest_key: repeated messages with the same key are merged into a digest
+        """
+        # If no sender or recipients are defined, do nothing
+        if len(sender) == 0 or len(recipients) == 0:
+            return
+        with self._start_lock:
+            if self.ident is None:
+                self.start()
+        try:
+            self._queue.put_nowait((sender, recipients, subject, message, digest_key))
+        except Queue.Full:
+            self.dropped += 1
+            logging.error("Notification queue full: dropped message '%s'", subject)
+
+    def stop(self, timeout=10.0):
+        """
+            Send pending digests and stop the thread
+            @param timeout: maximum time to wait for the thread [secs]
+        """
+        if self.is_alive():
+            self._queue.put(self._STOP)
+            self.join(timeout)
+
+    def stats(self):
+        """
+            Return a dictionary of counters
+        """
+        return {'queued': self._queue.qsize(),
+                'open_digests': len(self._digests),
+                'sent': self.sent,
+                'merged': self.merged,
+                'dropped': self.dropped,
+                'failed': self.failed}
+
+    def run(self):
+        """
+            Sender loop
+        """
+        while True:
+            try:
+                item = self._queue.get(timeout=1.0)
+            except Queue.Empty:
+                item = False
+            if item is self._STOP:
+                self._send_digests(force=True)
+                break
+            try:
+                if item:
+                    self._process(*item)
+                self._send_digests()
+                if self._smtp is not None and time.time() - self._last_used > self._idle_timeout:
+                    self._close()
+            except:
+                logging.error("Notifier error: %s", sys.exc_value)
+        self._close()
+
+    def _process(self, sender, recipients, subject, message, digest_key):
+        """
+            Send a message, or add it to an open digest
+        """
+        if digest_key is None:
+            self._deliver(sender, recipients, subject, message)
+            return
+        if digest_key in self._digests:
+            self._digests[digest_key]['messages'].append(message)
+            self.merged += 1
+            return
+        self._digests[digest_key] = {'sender': sender,
+                                     'recipients': recipients,
+                                     'subject': subject,
+                                     'messages': [],
+                                     'deadline': time.time() + self._digest_window}
+        self._deliver(sender, recipients, subject, message)
+
+    def _send_digests(self, force=False):
+        """
+            Send the digests for which the window has closed
+            @param force: if True, send all digests
+        """
+        now = time.time()
+        for key in self._digests.keys():
+            digest = self._digests[key]
+            if force or now >= digest['deadline']:
+                del self._digests[key]
+                count = len(digest['messages'])
+                if count > 0:
+                    content = "%d more alert(s) were received:\n\n" % count
+                    content += "\n\n".join(digest['messages'])
+                    self._deliver(digest['sender'], digest['recipients'],
+                                  "%s [digest of %d]" % (digest['subject'], count), content)
+
+    def _wait_for_token(self):
+        """
+            Token bucket rate limiting: wait until we are allowed to send an email
+        """
+        while True:
+            now = time.time()
+            self._tokens = min(float(self._rate_limit),
+                               self._tokens + (now - self._last_refill) * self._rate_limit / 60.0)
+            self._last_refill = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return
+            time.sleep((1.0 - self._tokens) * 60.0 / self._rate_limit)
+
+    def _connection(self):
+        """
+            Return the SMTP connection, opening it if needed
+        """
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self._host, self._port)
+        return self._smtp
+
+    def _close(self):
+        """
+            Close the SMTP connection
+        """
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except:
+                # The connection may already be gone
+                pass
+            self._smtp = None
+
+    def _deliver(self, sender, recipients, subject, message):
+        """
+            Send an email, reconnecting once if the connection was lost
+        """
+        self._wait_for_token()
+        msg = MIMEText(message)
+        msg['Subject'] = subject
+        msg['From'] = sender
+        msg['To'] = ';'.join(recipients)
+        for attempt in range(2):
+            try:
+                self._connection().sendmail(sender, recipients, msg.as_string())
+                self._last_used = time.time()
+                self.sent += 1
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self._close()
+                if attempt > 0:
+                    logging.error("Could not send message: %s", sys.exc_value)
+            except:
+                self._close()
+                logging.error("Could not send message: %s", sys.exc_value)
+                break
+        self.failed += 1
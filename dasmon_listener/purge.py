@@ -0,0 +1,237 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes, too-many-arguments
+"""
+    Background purge of old DASMON and PVMON entries.
+
+    The purge runs on its own thread so that it never delays the
+    heartbeats or the processing of incoming messages. Each purge cycle:
+      - deletes old rows in chunks of at most PURGE_CHUNK_SIZE primary keys,
+        within the range of primary keys of the old rows. The range is found
+        with the index on the time column (see dasmon/sql/indices.sql and
+        pvmon/sql/indices.sql), so that recent rows are never read,
+      - removes old PV cache entries that are not monitored with a single
+        anti-join against the MonitoredVariable table per chunk,
+      - removes old reduced images by batch, deleting their files directly
+        instead of going through one post_delete signal per row,
+      - stops after PURGE_TIME_BUDGET seconds. Unfinished work is picked up
+        by the next cycle.
+
+    If the history tables use the partitioned layout (see dasmon/partitions.py),
+    expired partitions are dropped and partitions for the coming days are
+    created before the remaining old rows are deleted.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import time
+import datetime
+import logging
+import threading
+from django.db import connection, transaction, close_old_connections
+from django.db.models import Min, Max
+from django.utils import timezone
+
+from dasmon.models import StatusVariable
+from dasmon import partitions
+from pvmon.models import PV, PVCache, PVString, PVStringCache, MonitoredVariable
+from file_handling.models import ReducedImage
+
+
+class PurgeWorker(threading.Thread):
+    """
+        Thread periodically removing old DB entries
+    """
+
+    def __init__(self, purge_timeout, image_purge_timeout, delay=600, time_budget=60, chunk_size=10000):
+        """
+            @param purge_timeout: number of days after which DASMON and PVMON entries are removed
+            @param image_purge_timeout: number of days after which reduced images are removed
+            @param delay: time between purge cycles [secs]
+            @param time_budget: maximum duration of a purge cycle [secs]
+            @param chunk_size: maximum number of primary keys covered by a single DELETE
+        """
+        super(PurgeWorker, self).__init__(name="dasmon_purge")
+        self.daemon = True
+        self._purge_timeout = purge_timeout
+        self._image_purge_timeout = image_purge_timeout
+        self._delay = delay
+        self._time_budget = time_budget
+        self._chunk_size = max(1, chunk_size)
+        self._stop_event = threading.Event()
+        ## Next primary key to look at in the cache tables, when a cycle ran out of time
+        self._cache_position = {}
+        ## Metrics
+        self.rows_deleted = {}
+        self.cycles = 0
+        self.last_cycle_duration = 0
+        self.last_cycle_complete = True
+
+    def run(self):
+        """
+            Purge loop
+        """
+        while not self._stop_event.is_set():
+            t0 = time.time()
+            try:
+                close_old_connections()
+                self.last_cycle_complete = self.purge(deadline=t0 + self._time_budget)
+            except:
+                logging.error("Purge cycle failed: %s", sys.exc_value)
+                self.last_cycle_complete = True
+            self.cycles += 1
+            self.last_cycle_duration = time.time() - t0
+            logging.info("Purge cycle: %s", str(self.stats()))
+            # If we ran out of time, continue after a short pause
+            if self.last_cycle_complete:
+                self._stop_event.wait(self._delay)
+            else:
+                self._stop_event.wait(min(self._delay, self._time_budget))
+        connection.close()
+
+    def stop(self):
+        """
+            Stop the purge thread after the current chunk
+        """
+        self._stop_event.set()
+
+    def stats(self):
+        """
+            Return a dictionary of purge metrics
+        """
+        return {'cycles': self.cycles,
+                'last_cycle_duration': self.last_cycle_duration,
+                'last_cycle_complete': self.last_cycle_complete,
+                'rows_deleted': dict(self.rows_deleted),
+                'pending_cache_positions': dict(self._cache_position)}
+
+    def _out_of_time(self, deadline):
+        """
+            Returns True if we should stop working
+            @param deadline: time at which the cycle should end
+        """
+        return time.time() > deadline or self._stop_event.is_set()
+
+    def _execute(self, model, sql, params):
+        """
+            Execute a DELETE statement and keep count of the deleted rows
+            @param model: model class the rows belong to
+            @param sql: SQL statement
+            @param params: statement parameters
+        """
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            count = max(cursor.rowcount, 0)
+        table = model._meta.db_table
+        self.rows_deleted[table] = self.rows_deleted.get(table, 0) + count
+        return count
+
+    def purge(self, deadline):
+        """
+            Perform a purge cycle. Returns True if all the work was done.
+            @param deadline: time at which the cycle should end
+        """
+        cutoff = timezone.now() - datetime.timedelta(days=self._purge_timeout)
+        # PV update times are integers: an integer cutoff lets the DB use their time index
+        cutoff_epoch = int(time.time() - self._purge_timeout * 24 * 60 * 60)
+        image_cutoff = timezone.now() - datetime.timedelta(days=self._image_purge_timeout)
+
+        # Drop expired partitions and make sure we have partitions for the coming days
+        if partitions.is_supported():
+            try:
+                with transaction.atomic():
+                    dropped = partitions.maintain(cutoff_epoch)
+                for table in dropped:
+                    if len(dropped[table]) > 0:
+                        logging.info("Dropped partitions: %s", str(dropped[table]))
+                        self.rows_deleted[table + '_partitions'] = self.rows_deleted.get(table + '_partitions', 0) + len(dropped[table])
+            except:
+                logging.error("Could not maintain partitions: %s", sys.exc_value)
+
+        return self._purge_history(StatusVariable, 'timestamp', cutoff, deadline) \
+            and self._purge_history(PV, 'update_time', cutoff_epoch, deadline) \
+            and self._purge_history(PVString, 'update_time', cutoff_epoch, deadline) \
+            and self._purge_cache(PVCache, cutoff_epoch, deadline) \
+            and self._purge_cache(PVStringCache, cutoff_epoch, deadline) \
+            and self._purge_images(image_cutoff, deadline)
+
+    def _purge_history(self, model, field, cutoff, deadline):
+        """
+            Delete old entries of an append-only table. The primary key range holding
+            old entries is found with the index on the time column, and walked through
+            in chunks. Entries with a time out of order, for instance a PV update time
+            in the future, are left in place until they are old enough.
+            Returns True if all old entries were deleted.
+            @param model: model class
+            @param field: name of the time field
+            @param cutoff: entries older than this are deleted
+            @param deadline: time at which the cycle should end
+        """
+        column = model._meta.get_field(field).column
+        sql = 'DELETE FROM %s WHERE id >= %%s AND id < %%s AND "%s" <= %%s' % (model._meta.db_table, column)
+
+        bounds = model.objects.filter(**{'%s__lte' % field: cutoff}).aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            return True
+        position = bounds['id__min']
+        while position <= bounds['id__max']:
+            if self._out_of_time(deadline):
+                return False
+            self._execute(model, sql, [position, position + self._chunk_size, cutoff])
+            position += self._chunk_size
+        return True
+
+    def _purge_cache(self, model, cutoff, deadline):
+        """
+            Delete old PV cache entries, unless they are monitored.
+            The whole primary key range is walked through in chunks, since cache entries
+            are updated in place.
+            Returns True if the whole table was processed.
+            @param model: PVCache or PVStringCache
+            @param cutoff: entries older than this are deleted [epoch secs]
+            @param deadline: time at which the cycle should end
+        """
+        table = model._meta.db_table
+        monitored = MonitoredVariable._meta.db_table
+        sql = 'DELETE FROM %s c WHERE c.id >= %%s AND c.id < %%s AND c.update_time <= %%s ' % table
+        sql += 'AND NOT EXISTS (SELECT 1 FROM %s m ' % monitored
+        sql += 'WHERE m.%s = c.%s ' % (MonitoredVariable._meta.get_field('instrument').column,
+                                       model._meta.get_field('instrument').column)
+        sql += 'AND m.%s = c.%s)' % (MonitoredVariable._meta.get_field('pv_name').column,
+                                     model._meta.get_field('name').column)
+
+        bounds = model.objects.aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            return True
+        position = max(self._cache_position.get(table, bounds['id__min']), bounds['id__min'])
+        while position <= bounds['id__max']:
+            if self._out_of_time(deadline):
+                self._cache_position[table] = position
+                return False
+            self._execute(model, sql, [position, position + self._chunk_size, cutoff])
+            position += self._chunk_size
+        self._cache_position.pop(table, None)
+        return True
+
+    def _purge_images(self, cutoff, deadline):
+        """
+            Delete old reduced images and their files
+            Returns True if all old images were deleted.
+            @param cutoff: images older than this are deleted
+            @param deadline: time at which the cycle should end
+        """
+        storage = ReducedImage._meta.get_field('file').storage
+        sql = 'DELETE FROM %s WHERE id IN (%%s)' % ReducedImage._meta.db_table
+        while not self._out_of_time(deadline):
+            items = list(ReducedImage.objects.filter(created_on__lte=cutoff).order_by('id').values_list('id', 'file')[:self._chunk_size])
+            if len(items) == 0:
+                return True
+            for _, file_name in items:
+                try:
+                    if file_name and os.path.isfile(storage.path(file_name)):
+                        os.remove(storage.path(file_name))
+                except:
+                    logging.error("Could not remove image %s: %s", file_name, sys.exc_value)
+            ids = [item[0] for item in items]
+            self._execute(ReducedImage, sql % ', '.join(['%s'] * len(ids)), ids)
+        return False
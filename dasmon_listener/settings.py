@@ -32,14 +32,59 @@ FROM_EMAIL = ""
 queues = ["/topic/ADARA.APP.DASMON.0",
           "/topic/ADARA.STATUS.DASMON.0",
           "/topic/ADARA.SIGNAL.DASMON.0"]
+# PV updates are processed from topics with a PV token after
+# the instrument name, for instance "/topic/SNS.BL6.APP.PV".
 
 INSTALLATION_DIR = "/var/www/workflow/app"
 
 PURGE_TIMEOUT = 7
 IMAGE_PURGE_TIMEOUT = 360
+# Maximum duration of a purge cycle [secs]
+PURGE_TIME_BUDGET = 60
+# Maximum number of primary keys covered by a single purge DELETE
+PURGE_CHUNK_SIZE = 10000
 
 MIN_NOTIFICATION_LEVEL = 3
 
+# Email notifications
+SMTP_HOST = 'localhost'
+SMTP_PORT = 25
+# Repeated alerts for the same signal within this time are merged into a digest [secs]
+NOTIFICATION_DIGEST_WINDOW = 300
+# Maximum number of emails sent per minute
+NOTIFICATION_RATE_LIMIT = 30
+
+# Write-behind buffering of StatusVariable entries:
+# rows are written in bulk every STATUS_BATCH_SIZE rows
+# or every STATUS_FLUSH_INTERVAL milliseconds, whichever comes first.
+STATUS_BATCH_SIZE = 500
+STATUS_FLUSH_INTERVAL = 500
+# Changed StatusCache entries are written every CACHE_FLUSH_INTERVAL milliseconds.
+# Repeated updates to the same key within that window result in a single write.
+CACHE_FLUSH_INTERVAL = 1000
+
+# Number of threads writing to the DB. Messages for a given instrument
+# are always processed by the same thread, in the order they came in.
+# Set to zero to process messages on the AMQ receiver thread.
+WRITER_THREADS = 4
+# Maximum number of messages waiting to be processed
+WRITER_QUEUE_SIZE = 10000
+
+# Redelivered messages are dropped if a message with the same ID was
+# received within DEDUP_WINDOW seconds. The last DEDUP_CAPACITY message IDs are kept.
+DEDUP_CAPACITY = 10000
+DEDUP_WINDOW = 3600
+
+# Latest values are published to this file for the web monitor
+# every SNAPSHOT_INTERVAL milliseconds. Set to None to disable.
+# The web monitor reads it from its DASMON_SNAPSHOT_FILE setting.
+SNAPSHOT_FILE = '/var/tmp/dasmon_snapshot'
+SNAPSHOT_INTERVAL = 1000
+
+# Local port on which throughput and latency metrics are served
+# in the Prometheus text format. Set to None to disable.
+METRICS_PORT = 9120
+
 # Import local settings if available
 try:
     from local_settings import *
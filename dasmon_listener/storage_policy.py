@@ -0,0 +1,140 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Storage policies for the StatusVariable history.
+
+    Each Parameter can limit the values that are stored in the history:
+      - store_on_change: only store values that differ from the last stored value,
+      - deadband_abs / deadband_rel: only store numerical values that differ from
+        the last stored value by more than an absolute amount or by more than a
+        fraction of the last stored value (the larger of the two bands is used),
+      - min_interval: store at most one value every min_interval seconds,
+      - keep_alive: store a value at least every keep_alive seconds, even if
+        it didn't change.
+
+    The StatusCache is updated with every value regardless of the policy,
+    so the latest values shown by the monitor are unaffected.
+
+    When a change is stored after values were skipped, the last skipped value
+    is stored right before it so that plots keep their step shape instead of
+    showing a slow ramp between the two stored values.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import time
+import calendar
+import threading
+
+
+def _has_change_criteria(key_id):
+    """
+        Returns True if a Parameter only stores values that changed
+        @param key_id: Parameter object
+    """
+    return key_id.store_on_change \
+        or key_id.deadband_abs is not None \
+        or key_id.deadband_rel is not None
+
+def has_changed(key_id, last_value, value):
+    """
+        Returns True if a value should be considered different from the last stored value
+        @param key_id: Parameter object
+        @param last_value: last stored value string
+        @param value: new value string
+    """
+    if not _has_change_criteria(key_id):
+        return True
+    if key_id.deadband_abs is not None or key_id.deadband_rel is not None:
+        try:
+            last_float = float(last_value)
+            new_float = float(value)
+            band = 0.0
+            if key_id.deadband_abs is not None:
+                band = max(band, key_id.deadband_abs)
+            if key_id.deadband_rel is not None:
+                band = max(band, key_id.deadband_rel * abs(last_float))
+            return abs(new_float - last_float) > band
+        except (TypeError, ValueError):
+            # Not a number: fall back to comparing strings
+            pass
+    return value != last_value
+
+
+class StoragePolicy(object):
+    """
+        Decides which values go to the StatusVariable history
+    """
+
+    def __init__(self, last_value=None):
+        """
+            @param last_value: function returning the cached (value, datetime) for
+                               an (instrument, parameter) pair, or None. It is used
+                               when we don't know the last stored value yet.
+        """
+        self._last_value = last_value
+        ## (instrument ID, parameter ID) -> (last stored value, time [epoch secs])
+        self._stored = {}
+        ## (instrument ID, parameter ID) -> last skipped value
+        self._skipped = {}
+        self._lock = threading.Lock()
+        ## Counters
+        self.stored = 0
+        self.suppressed = 0
+
+    def stats(self):
+        """
+            Return a dictionary of counters
+        """
+        return {'stored': self.stored,
+                'suppressed': self.suppressed,
+                'tracked_keys': len(self._stored)}
+
+    def _last_stored(self, instrument_id, key_id):
+        """
+            Return the last stored (value, time) for a key, or None
+        """
+        key = (instrument_id.id, key_id.id)
+        if key not in self._stored and self._last_value is not None:
+            cached = self._last_value(instrument_id, key_id)
+            if cached is not None:
+                self._stored[key] = (cached[0], calendar.timegm(cached[1].utctimetuple()))
+        return self._stored.get(key)
+
+    def filter(self, instrument_id, key_id, value, now=None):
+        """
+            Return the list of values to store for a new value: an empty list if
+            the value should be skipped, or the value preceded by the last skipped
+            value when a change is stored after skipped values.
+            @param instrument_id: Instrument object
+            @param key_id: Parameter object
+            @param value: new value string
+            @param now: time of the value [epoch secs]
+        """
+        if not key_id.has_storage_policy():
+            return [value]
+        if now is None:
+            now = time.time()
+        key = (instrument_id.id, key_id.id)
+        with self._lock:
+            last = self._last_stored(instrument_id, key_id)
+            store = True
+            if last is not None:
+                elapsed = now - last[1]
+                if key_id.keep_alive is not None and elapsed >= key_id.keep_alive:
+                    store = True
+                elif key_id.min_interval > 0 and elapsed < key_id.min_interval:
+                    store = False
+                else:
+                    store = has_changed(key_id, last[0], value)
+
+            if not store:
+                self._skipped[key] = value
+                self.suppressed += 1
+                return []
+
+            values = [value]
+            skipped = self._skipped.pop(key, None)
+            if skipped is not None and skipped != value and _has_change_criteria(key_id):
+                values.insert(0, skipped)
+            self._stored[key] = (value, now)
+            self.stored += len(values)
+            return values
@@ -0,0 +1,521 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Write-behind buffering of DASMON status entries.
+
+    Instead of issuing one INSERT per key-value pair, the listener
+    accumulates StatusVariable rows in memory and writes them to the
+    DB with a single bulk insert once the buffer holds a given number
+    of rows or once a given amount of time has passed since the last flush.
+
+    The latest value of each key is kept in a StatusCacheBuffer.
+    Updates to the same key within a flush window are coalesced
+    and only the latest value is written, using a single multi-row
+    upsert when the DB supports it.
+
+    PV values received by the listener go through a PVBuffer, which
+    bulk-inserts the PV history rows and coalesces the PV cache updates.
+
+    Crash safety:
+      - Rows are only written when the buffer is flushed. If the listener
+        process dies before a flush, at most one buffer worth of rows
+        (STATUS_BATCH_SIZE rows, or STATUS_FLUSH_INTERVAL ms of traffic)
+        is lost. DASMON status values are re-published continuously, so the
+        history will have a short gap but the latest values will recover
+        with the next messages.
+      - The buffer is flushed when the client is stopped (Client.stop())
+        and when the daemon receives SIGTERM.
+      - If a bulk insert fails, the rows of that batch are dropped and an
+        error is logged. This matches the previous behavior, where a failed
+        save() was logged and the entry discarded.
+      - If the StatusCache entries can't be written, they are kept and
+        written with their latest values at the next flush.
+      - StatusVariable.timestamp is an auto_now_add field, so stored rows are
+        time-stamped at flush time. The difference with the reception time is
+        bounded by STATUS_FLUSH_INTERVAL.
+
+    Each buffer reports the time before which all the values it was given
+    are written (written_until()), so that the latency of a message can be
+    recorded once its entries are in the DB rather than in the buffers.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import collections
+
+from django.db import connection, transaction
+from dasmon.models import StatusVariable, StatusCache
+from pvmon.models import PV, PVCache, PVString, PVStringCache
+
+
+def _missing_unique_index(error):
+    """
+        Return True if a DB error was caused by an ON CONFLICT clause
+        without a matching unique index
+        @param error: exception raised by the DB backend
+    """
+    # Django keeps the psycopg2 exception as the cause of its own
+    cause = getattr(error, '__cause__', None)
+    if getattr(cause, 'pgcode', None) == '42P10':
+        return True
+    return 'no unique or exclusion constraint' in str(error)
+
+
+class _WriteMark(object):
+    """
+        Time before which all the values added to a buffer were written.
+        The methods must be called with the lock of the buffer held.
+    """
+
+    def __init__(self):
+        self._written = time.time()
+        ## Number of flushes in progress, and start time of the latest one that completed
+        self._flushes = 0
+        self._started = 0
+
+    def start(self):
+        """
+            Record the start of a flush and return its start time
+        """
+        self._flushes += 1
+        return time.time()
+
+    def done(self, started, written=True):
+        """
+            Record the end of a flush
+            @param started: start time of the flush
+            @param written: False if the values were kept for the next flush
+        """
+        self._flushes -= 1
+        if written:
+            self._started = max(self._started, started)
+        if self._flushes == 0:
+            self._written = max(self._written, self._started)
+
+    def written_until(self, is_empty):
+        """
+            Return the time before which all the values added were written
+            @param is_empty: True if the buffer holds no value
+        """
+        if is_empty and self._flushes == 0:
+            return time.time()
+        return self._written
+
+
+class StatusVariableBuffer(object):
+    """
+        Buffer of StatusVariable rows waiting to be written to the DB
+    """
+
+    def __init__(self, batch_size=500, flush_interval=500):
+        """
+            @param batch_size: number of rows that triggers a flush
+            @param flush_interval: maximum time between flushes [ms]
+        """
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval / 1000.0
+        self._rows = []
+        self._last_flush = time.time()
+        self._mark = _WriteMark()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def written_until(self):
+        """
+            Return the time before which all the rows added were written
+        """
+        with self._lock:
+            return self._mark.written_until(len(self._rows) == 0)
+
+    def append(self, status_entry):
+        """
+            Add a StatusVariable object to the buffer. The buffer is
+            flushed if it is full.
+            @param status_entry: StatusVariable object (not yet saved)
+        """
+        with self._lock:
+            self._rows.append(status_entry)
+            is_full = len(self._rows) >= self._batch_size
+        if is_full:
+            self.flush()
+
+    def flush_if_needed(self):
+        """
+            Flush the buffer if the maximum time between flushes has elapsed.
+            This is meant to be called periodically by the client loop.
+        """
+        if len(self._rows) > 0 and time.time() - self._last_flush > self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+            Write all buffered rows to the DB with a single bulk insert.
+            Returns the number of rows written.
+        """
+        with self._lock:
+            rows = self._rows
+            self._rows = []
+            self._last_flush = time.time()
+            started = self._mark.start()
+        try:
+            if len(rows) > 0:
+                StatusVariable.objects.bulk_create(rows, batch_size=self._batch_size)
+        except:
+            logging.error("Could not write %d buffered status entries: %s", len(rows), sys.exc_value)
+            return 0
+        finally:
+            with self._lock:
+                self._mark.done(started)
+        return len(rows)
+
+
+class StatusCacheBuffer(object):
+    """
+        In-memory map of the latest StatusCache values, keyed by
+        (instrument ID, parameter ID). Only the entries that changed
+        since the last flush are written to the DB.
+    """
+
+    def __init__(self, flush_interval=1000):
+        """
+            @param flush_interval: maximum time between flushes [ms]
+        """
+        self._flush_interval = flush_interval / 1000.0
+        ## (instrument ID, parameter ID) -> [StatusCache ID, value, timestamp]
+        self._entries = {}
+        self._dirty = set()
+        self._loaded = False
+        self._use_upsert = connection.vendor == 'postgresql'
+        self._last_flush = time.time()
+        self._mark = _WriteMark()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def written_until(self):
+        """
+            Return the time before which all the updates were written
+        """
+        with self._lock:
+            return self._mark.written_until(len(self._dirty) == 0)
+
+    def load(self):
+        """
+            Load the current content of the StatusCache table
+        """
+        entries = {}
+        for pk, instrument_id, key_id, value, timestamp in \
+            StatusCache.objects.values_list('id', 'instrument_id', 'key_id', 'value', 'timestamp'):
+            key = (instrument_id, key_id)
+            if key not in entries or timestamp > entries[key][2]:
+                entries[key] = [pk, value, timestamp]
+        with self._lock:
+            for key in entries:
+                if key not in self._dirty:
+                    self._entries[key] = entries[key]
+            self._loaded = True
+
+    def get(self, instrument_id, key_id):
+        """
+            Return the latest (value, timestamp) for a given key,
+            or None if we don't have one.
+            @param instrument_id: Instrument object
+            @param key_id: Parameter object
+        """
+        if not self._loaded:
+            self.load()
+        entry = self._entries.get((instrument_id.id, key_id.id))
+        if entry is None:
+            return None
+        return entry[1], entry[2]
+
+    def items(self):
+        """
+            Return the list of (instrument ID, parameter ID, value, timestamp) for all entries
+        """
+        if not self._loaded:
+            self.load()
+        with self._lock:
+            return [(key[0], key[1], entry[1], entry[2]) for key, entry in self._entries.items()]
+
+    def update(self, instrument_id, key_id, value, timestamp):
+        """
+            Set the latest value for a given key. Older values are ignored.
+            @param instrument_id: Instrument object
+            @param key_id: Parameter object
+            @param value: value string
+            @param timestamp: datetime of the update
+        """
+        if not self._loaded:
+            self.load()
+        key = (instrument_id.id, key_id.id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [None, value, timestamp]
+            elif timestamp >= entry[2]:
+                entry[1] = value
+                entry[2] = timestamp
+            else:
+                return
+            self._dirty.add(key)
+
+    def flush_if_needed(self):
+        """
+            Flush the changed entries if the maximum time between flushes has elapsed.
+        """
+        if len(self._dirty) > 0 and time.time() - self._last_flush > self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+            Write the entries that changed since the last flush.
+            Returns the number of entries written.
+        """
+        with self._lock:
+            keys = self._dirty
+            rows = [(key[0], key[1], self._entries[key][1], self._entries[key][2]) for key in keys]
+            self._dirty = set()
+            self._last_flush = time.time()
+            started = self._mark.start()
+        if len(rows) == 0:
+            with self._lock:
+                self._mark.done(started)
+            return 0
+        try:
+            if self._use_upsert and connection.pg_version >= 90500:
+                try:
+                    self._upsert(rows)
+                    with self._lock:
+                        self._mark.done(started)
+                    return len(rows)
+                except:
+                    if not _missing_unique_index(sys.exc_value):
+                        raise
+                    logging.error("StatusCache upsert failed, falling back to updates: %s", sys.exc_value)
+                    self._use_upsert = False
+            self._update_or_create(rows)
+        except:
+            logging.error("Could not write %d cached status entries: %s", len(rows), sys.exc_value)
+            # Write them at the next flush, with the values they will have by then
+            with self._lock:
+                self._dirty |= keys
+                self._mark.done(started, written=False)
+            return 0
+        with self._lock:
+            self._mark.done(started)
+        return len(rows)
+
+    @transaction.atomic
+    def _upsert(self, rows):
+        """
+            Write entries with a single INSERT ... ON CONFLICT statement [PostgreSQL >= 9.5]
+            @param rows: list of (instrument ID, parameter ID, value, timestamp)
+        """
+        sql = 'INSERT INTO %s (instrument_id_id, key_id_id, value, "timestamp") VALUES ' % StatusCache._meta.db_table
+        sql += ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+        sql += ' ON CONFLICT (instrument_id_id, key_id_id)'
+        sql += ' DO UPDATE SET value = EXCLUDED.value, "timestamp" = EXCLUDED."timestamp"'
+        params = []
+        for row in rows:
+            params.extend(row)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+    @transaction.atomic
+    def _update_or_create(self, rows):
+        """
+            Write entries one at a time, for DB backends without upsert support
+            @param rows: list of (instrument ID, parameter ID, value, timestamp)
+        """
+        for instrument_id, key_id, value, timestamp in rows:
+            key = (instrument_id, key_id)
+            pk = self._entries[key][0]
+            if pk is not None and StatusCache.objects.filter(id=pk).update(value=value, timestamp=timestamp) > 0:
+                continue
+            cached = StatusCache.objects.filter(instrument_id=instrument_id, key_id=key_id).order_by('-timestamp')[:1]
+            if len(cached) > 0:
+                cached = cached[0]
+                cached.value = value
+                cached.timestamp = timestamp
+            else:
+                cached = StatusCache(instrument_id_id=instrument_id, key_id_id=key_id,
+                                     value=value, timestamp=timestamp)
+            cached.save()
+            self._entries[key][0] = cached.id
+
+
+class PVBuffer(object):
+    """
+        Buffer of PV values waiting to be written to the DB.
+        History rows are written with bulk inserts. Only the latest value
+        of each PV is written to the cache tables, with one UPDATE and one
+        bulk INSERT per table.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=500):
+        """
+            @param batch_size: number of values that triggers a flush
+            @param flush_interval: maximum time between flushes [ms]
+        """
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval / 1000.0
+        ## History model -> list of unsaved rows
+        self._rows = {PV: [], PVString: []}
+        ## Cache model -> {(instrument ID, PVName ID): (value, status, update_time)}
+        self._latest = {PVCache: {}, PVStringCache: {}}
+        self._count = 0
+        self._last_flush = time.time()
+        self._mark = _WriteMark()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def written_until(self):
+        """
+            Return the time before which all the values added were written
+        """
+        with self._lock:
+            return self._mark.written_until(self._count == 0)
+
+    def append(self, instrument_id, name_id, value, status, update_time, cache_only=False):
+        """
+            Add a PV value. Numbers go to the PV tables, strings to the PV string tables.
+            The buffer is flushed if it is full.
+            @param instrument_id: Instrument object
+            @param name_id: PVName object
+            @param value: value of the PV
+            @param status: PV status
+            @param update_time: time of the update [epoch secs]
+            @param cache_only: if True, only the cache is updated
+        """
+        if isinstance(value, basestring):
+            model, cache_model = PVString, PVStringCache
+        else:
+            model, cache_model = PV, PVCache
+            value = float(value)
+        key = (instrument_id.id, name_id.id)
+        with self._lock:
+            if not cache_only:
+                self._rows[model].append(model(instrument=instrument_id, name=name_id, value=value,
+                                               status=status, update_time=update_time))
+            latest = self._latest[cache_model]
+            if key not in latest or update_time >= latest[key][2]:
+                latest[key] = (value, status, update_time)
+            self._count += 1
+            is_full = self._count >= self._batch_size
+        if is_full:
+            self.flush()
+
+    def flush_if_needed(self):
+        """
+            Flush the buffer if the maximum time between flushes has elapsed.
+        """
+        if self._count > 0 and time.time() - self._last_flush > self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+            Write the buffered values. Returns the number of history rows written.
+        """
+        with self._lock:
+            rows = self._rows
+            latest = self._latest
+            self._rows = {PV: [], PVString: []}
+            self._latest = {PVCache: {}, PVStringCache: {}}
+            self._count = 0
+            self._last_flush = time.time()
+            started = self._mark.start()
+        count = 0
+        for model in rows:
+            if len(rows[model]) == 0:
+                continue
+            try:
+                model.objects.bulk_create(rows[model], batch_size=self._batch_size)
+                count += len(rows[model])
+            except:
+                logging.error("Could not write %d buffered PV entries: %s", len(rows[model]), sys.exc_value)
+        for cache_model in latest:
+            if len(latest[cache_model]) == 0:
+                continue
+            try:
+                self._write_cache(cache_model, latest[cache_model])
+            except:
+                logging.error("Could not write %d PV cache entries: %s", len(latest[cache_model]), sys.exc_value)
+        with self._lock:
+            self._mark.done(started)
+        return count
+
+    @transaction.atomic
+    def _write_cache(self, cache_model, latest):
+        """
+            Update the cache entries, and create the missing ones
+            @param cache_model: PVCache or PVStringCache
+            @param latest: {(instrument ID, PVName ID): (value, status, update_time)}
+        """
+        updated = set()
+        if connection.vendor == 'postgresql':
+            sql = 'UPDATE %s AS c SET value = v.value, status = v.status, update_time = v.update_time ' % cache_model._meta.db_table
+            sql += 'FROM (VALUES %s) ' % ', '.join(['(%s, %s, %s, %s, %s)'] * len(latest))
+            sql += 'AS v(instrument_id, name_id, value, status, update_time) '
+            sql += 'WHERE c.instrument_id = v.instrument_id AND c.name_id = v.name_id '
+            sql += 'RETURNING c.instrument_id, c.name_id'
+            params = []
+            for key, item in latest.items():
+                params.extend([key[0], key[1], item[0], item[1], item[2]])
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            updated = set(cursor.fetchall())
+        else:
+            for key, item in latest.items():
+                if cache_model.objects.filter(instrument_id=key[0], name_id=key[1]) \
+                    .update(value=item[0], status=item[1], update_time=item[2]) > 0:
+                    updated.add(key)
+        new_entries = [cache_model(instrument_id=key[0], name_id=key[1], value=item[0],
+                                   status=item[1], update_time=item[2])
+                       for key, item in latest.items() if key not in updated]
+        if len(new_entries) > 0:
+            cache_model.objects.bulk_create(new_entries)
+
+
+class CommitWatcher(object):
+    """
+        Messages whose entries may still be waiting in the buffers.
+        A message is committed once every buffer has written the
+        values it was given before the message was processed.
+    """
+
+    def __init__(self, buffers, max_messages=10000):
+        """
+            @param buffers: list of buffers with a written_until() method
+            @param max_messages: maximum number of messages to watch. The oldest are dropped.
+        """
+        self._buffers = buffers
+        ## (processing time, headers) of each message, in processing order
+        self._messages = collections.deque(maxlen=max_messages)
+
+    def processed(self, headers):
+        """
+            Watch a message that was processed
+            @param headers: message headers
+        """
+        self._messages.append((time.time(), headers))
+
+    def committed(self):
+        """
+            Return the headers of the messages whose entries were written
+            since the last call. This is meant to be called by a single thread.
+        """
+        if len(self._messages) == 0:
+            return []
+        cutoff = min([buf.written_until() for buf in self._buffers])
+        headers = []
+        while len(self._messages) > 0 and self._messages[0][0] < cutoff:
+            headers.append(self._messages.popleft()[1])
+        return headers
@@ -0,0 +1,131 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes
+"""
+    Pool of DB writer threads for the DASMON listener.
+
+    The stomp receiver thread only hands incoming messages over to a pool
+    of worker threads, so that a slow DB query doesn't stall the consumption
+    of messages from the other topics.
+
+    Messages are partitioned by instrument: all the messages for a given
+    instrument are processed by the same worker, in the order they were
+    received. Each worker has its own bounded queue. When a queue is full,
+    the receiver thread waits for a short time before dropping the message.
+
+    Each worker thread uses its own Django DB connection.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import Queue
+from django.db import connection, close_old_connections
+
+
+class WriterPool(object):
+    """
+        Pool of threads processing messages in the background
+    """
+    ## Sentinel used to stop the workers
+    _STOP = None
+
+    def __init__(self, handler, number_of_threads=4, queue_size=10000, put_timeout=1.0):
+        """
+            @param handler: function called with (headers, message) to process a message
+            @param number_of_threads: number of worker threads
+            @param queue_size: maximum number of pending messages for the whole pool
+            @param put_timeout: time to wait for room in a full queue before dropping a message [secs]
+        """
+        self._handler = handler
+        self._put_timeout = put_timeout
+        number_of_threads = max(1, number_of_threads)
+        self._queues = [Queue.Queue(maxsize=max(1, queue_size / number_of_threads)) for _ in range(number_of_threads)]
+        ## Number of messages processed by each worker
+        self._processed = [0] * number_of_threads
+        ## Time spent processing messages by each worker [secs]
+        self._busy_time = [0.0] * number_of_threads
+        self._dropped = 0
+        self._start_time = time.time()
+        self._threads = []
+        for i in range(number_of_threads):
+            thread = threading.Thread(target=self._run, args=(i,), name="dasmon_writer_%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def partition_key(destination):
+        """
+            Return the key used to assign a message to a worker.
+            Topics are of the form /topic/SNS.<instrument>.<...>,
+            so the instrument name is the second token.
+            @param destination: message destination
+        """
+        toks = destination.upper().split('.')
+        if len(toks) > 1:
+            return toks[1]
+        return destination
+
+    def submit(self, headers, message):
+        """
+            Queue a message for processing.
+            Returns False if the message was dropped.
+            @param headers: message headers
+            @param message: message content
+        """
+        key = self.partition_key(headers.get("destination", ""))
+        worker_queue = self._queues[hash(key) % len(self._queues)]
+        try:
+            worker_queue.put((headers, message), timeout=self._put_timeout)
+        except Queue.Full:
+            self._dropped += 1
+            logging.error("Writer queue full: dropped message from %s", headers.get("destination", ""))
+            return False
+        return True
+
+    def _run(self, index):
+        """
+            Worker thread loop
+            @param index: worker index
+        """
+        worker_queue = self._queues[index]
+        while True:
+            item = worker_queue.get()
+            if item is self._STOP:
+                break
+            t0 = time.time()
+            try:
+                # Drop the DB connection if it became unusable or too old
+                close_old_connections()
+                self._handler(*item)
+            except:
+                logging.error("Writer %d failed to process message: %s", index, sys.exc_value)
+            self._processed[index] += 1
+            self._busy_time[index] += time.time() - t0
+        connection.close()
+
+    def stop(self, timeout=10.0):
+        """
+            Process the pending messages and stop the worker threads
+            @param timeout: maximum time to wait for each worker [secs]
+        """
+        for worker_queue in self._queues:
+            worker_queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """
+            Return a dictionary of queue depths, drops and per-worker throughput
+        """
+        elapsed = max(time.time() - self._start_time, 1e-6)
+        workers = []
+        for i in range(len(self._queues)):
+            workers.append({'depth': self._queues[i].qsize(),
+                            'processed': self._processed[i],
+                            'rate': self._processed[i] / elapsed,
+                            'busy_fraction': self._busy_time[i] / elapsed})
+        return {'depth': sum([q.qsize() for q in self._queues]),
+                'dropped': self._dropped,
+                'workers': workers}
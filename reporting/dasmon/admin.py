@@ -17,8 +17,8 @@ class StatusVariableAdmin(admin.ModelAdmin):
         return '-'
 
 class ParameterAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'monitored')
-    list_editable = ('monitored',)
+    list_display = ('id', 'name', 'monitored', 'store_on_change', 'deadband_abs', 'deadband_rel', 'min_interval', 'keep_alive')
+    list_editable = ('monitored', 'store_on_change', 'deadband_abs', 'deadband_rel', 'min_interval', 'keep_alive')
 
 class ActiveInstrumentAdmin(admin.ModelAdmin):
     list_display = ('id', 'instrument_id', 'is_alive', 'is_adara')
@@ -0,0 +1,61 @@
+"""
+    Maintain the time-partitioned history tables.
+    See dasmon/partitions.py for details.
+
+    Run daily, for instance from cron:
+        python manage.py partitions --purge 7
+"""
+import time
+from optparse import make_option
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from dasmon import partitions
+
+class Command(BaseCommand):
+    help = "Create future partitions of the history tables and drop expired ones"
+    if django.VERSION < (1, 8):
+        # Older versions only read the optparse options
+        option_list = BaseCommand.option_list + (
+            make_option('--convert', action='store_true', dest='convert', default=False,
+                        help='convert the history tables to the partitioned layout'),
+            make_option('--days-ahead', type='int', dest='days_ahead', default=partitions.PARTITIONS_AHEAD,
+                        help='number of days for which partitions are created ahead of time'),
+            make_option('--weekly', action='store_true', dest='weekly', default=False,
+                        help='use weekly instead of daily partitions'),
+            make_option('--purge', type='int', dest='purge', default=None,
+                        help='drop partitions holding only entries older than the given number of days'),
+            )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', dest='convert', default=False,
+                            help='convert the history tables to the partitioned layout')
+        parser.add_argument('--days-ahead', type=int, dest='days_ahead', default=partitions.PARTITIONS_AHEAD,
+                            help='number of days for which partitions are created ahead of time')
+        parser.add_argument('--weekly', action='store_true', dest='weekly', default=False,
+                            help='use weekly instead of daily partitions')
+        parser.add_argument('--purge', type=int, dest='purge', default=None,
+                            help='drop partitions holding only entries older than the given number of days')
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported():
+            raise CommandError("Partitioned tables require PostgreSQL 11 or above")
+        interval = 'weekly' if options.get('weekly', False) else 'daily'
+        days_ahead = options.get('days_ahead', partitions.PARTITIONS_AHEAD)
+        purge = options.get('purge', None)
+
+        if options.get('convert', False):
+            for table in partitions.PARTITIONED_TABLES:
+                with transaction.atomic():
+                    partitions.convert_table(table, days_ahead, interval)
+                self.stdout.write('Converted %s\n' % table)
+
+        cutoff = None
+        if purge is not None:
+            cutoff = time.time() - purge * 24 * 60 * 60
+        with transaction.atomic():
+            dropped = partitions.maintain(cutoff, days_ahead, interval)
+        for table in dropped:
+            for partition in dropped[table]:
+                self.stdout.write('Dropped %s\n' % partition)
+        self.stdout.write('Partitions are up to date\n')
@@ -12,10 +12,30 @@ class Parameter(models.Model):
     """
     name = models.CharField(max_length=128, unique=True)
     monitored = models.BooleanField(default=True)
+    # Storage policy for the StatusVariable history. By default, every value is stored.
+    # Only store a value if it differs from the last stored value
+    store_on_change = models.BooleanField(default=False)
+    # Only store a numerical value if it differs from the last stored value
+    # by more than an absolute amount, or by more than a fraction of the last stored value
+    deadband_abs = models.FloatField(null=True, blank=True)
+    deadband_rel = models.FloatField(null=True, blank=True)
+    # Minimum time between stored values [secs]
+    min_interval = models.FloatField(default=0)
+    # Store a value at least this often, even if it didn't change [secs]
+    keep_alive = models.FloatField(null=True, blank=True)
 
     def __unicode__(self):
         return self.name
 
+    def has_storage_policy(self):
+        """
+            Returns True if the parameter limits the values to be stored
+        """
+        return self.store_on_change \
+            or self.deadband_abs is not None \
+            or self.deadband_rel is not None \
+            or self.min_interval > 0
+
 
 class StatusVariable(models.Model):
     """
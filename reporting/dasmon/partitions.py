@@ -0,0 +1,291 @@
+#pylint: disable=bare-except, invalid-name, line-too-long
+"""
+    Optional time-partitioned layout for the append-only history tables
+    (dasmon_statusvariable, pvmon_pv and pvmon_pvstring).
+
+    Requires PostgreSQL >= 11 (declarative partitioning with default partitions).
+
+    Each table is partitioned by range on its time column, with one partition
+    per day or per week, named <table>_pYYYYMMDD after the first day it covers.
+    When a table is converted, its existing content becomes the partition
+    <table>_legacy, which covers everything before the first regular partition.
+    A <table>_default partition catches rows that fall outside the existing
+    partitions, so that inserts never fail if partitions were not created in time.
+
+    The indices defined in dasmon/sql/indices.sql and pvmon/sql/indices.sql
+    are created on each partition, along with a unique index on the ID.
+
+    Retention is enforced by dropping partitions that only contain expired rows.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import calendar
+import datetime
+import logging
+import sys
+from django.db import connection, transaction
+from django.utils import timezone
+
+# Default partition size: 'daily' or 'weekly'
+PARTITION_INTERVAL = 'daily'
+# Default number of days for which partitions are created ahead of time
+PARTITIONS_AHEAD = 7
+
+## Partitioned tables: time column, whether the column holds epoch seconds, and indices
+PARTITIONED_TABLES = {
+    'dasmon_statusvariable': {'column': 'timestamp',
+                              'epoch': False,
+                              'indices': {'time_key': ['instrument_id_id', 'key_id_id', '"timestamp"'],
+                                          'time': ['"timestamp"']}},
+    'pvmon_pv': {'column': 'update_time',
+                 'epoch': True,
+                 'indices': {'time_key': ['instrument_id', 'name_id', 'update_time'],
+                             'time': ['update_time']}},
+    'pvmon_pvstring': {'column': 'update_time',
+                       'epoch': True,
+                       'indices': {'time_key': ['instrument_id', 'name_id', 'update_time'],
+                                   'time': ['update_time']}},
+    }
+
+
+def _execute(sql, params=None):
+    """
+        Execute an SQL statement and return the cursor
+        @param sql: SQL statement
+        @param params: statement parameters
+    """
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor
+
+def is_supported():
+    """
+        Returns True if the DB supports the partitioned layout
+    """
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+def is_partitioned(table):
+    """
+        Returns True if the given table is partitioned
+        @param table: name of the table
+    """
+    if not is_supported():
+        return False
+    cursor = _execute("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s", [table])
+    return cursor.fetchone() is not None
+
+def _interval(interval):
+    """
+        Return the partition size as a timedelta
+        @param interval: 'daily' or 'weekly'
+    """
+    if interval == 'weekly':
+        return datetime.timedelta(days=7)
+    return datetime.timedelta(days=1)
+
+def _partition_start(day, interval):
+    """
+        Return the first day of the partition containing a given day
+        @param day: date object
+        @param interval: 'daily' or 'weekly'
+    """
+    if interval == 'weekly':
+        return day - datetime.timedelta(days=day.weekday())
+    return day
+
+def _boundary(table, day):
+    """
+        Return the value of the time column at midnight UTC of a given day
+        @param table: name of the table
+        @param day: date object
+    """
+    if PARTITIONED_TABLES[table]['epoch']:
+        return calendar.timegm(day.timetuple())
+    return "%s 00:00:00+00" % day.isoformat()
+
+def list_partitions(table):
+    """
+        Return the sorted list of (partition name, first day) for the regular partitions of a table
+        @param table: name of the table
+    """
+    cursor = _execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                      "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", [table])
+    partitions = []
+    prefix = "%s_p" % table
+    for (name,) in cursor.fetchall():
+        if name.startswith(prefix):
+            try:
+                partitions.append((name, datetime.datetime.strptime(name[len(prefix):], "%Y%m%d").date()))
+            except ValueError:
+                logging.error("Unexpected partition name for %s: %s", table, name)
+    return sorted(partitions, key=lambda item: item[1])
+
+def _create_indices(table, partition):
+    """
+        Create the indices of a partition
+        @param table: name of the partitioned table
+        @param partition: name of the partition
+    """
+    _execute('CREATE UNIQUE INDEX IF NOT EXISTS %s_id ON %s USING btree (id)' % (partition, partition))
+    for name, columns in PARTITIONED_TABLES[table]['indices'].items():
+        _execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s USING btree (%s)' % (partition, name, partition, ', '.join(columns)))
+
+def _relation_exists(name):
+    """
+        Returns True if a table with the given name exists
+        @param name: name of the table
+    """
+    return _execute("SELECT 1 FROM pg_class WHERE relname = %s", [name]).fetchone() is not None
+
+def create_partition(table, day, interval=PARTITION_INTERVAL):
+    """
+        Create the partition holding a given day, if it doesn't exist.
+        Entries of that range which already landed in the default partition
+        are moved to the new partition.
+        @param table: name of the partitioned table
+        @param day: date object
+        @param interval: 'daily' or 'weekly'
+    """
+    start = _partition_start(day, interval)
+    end = start + _interval(interval)
+    partition = "%s_p%s" % (table, start.strftime("%Y%m%d"))
+    bounds = [_boundary(table, start), _boundary(table, end)]
+    if _relation_exists(partition):
+        _create_indices(table, partition)
+        return partition
+
+    default = "%s_default" % table
+    column = PARTITIONED_TABLES[table]['column']
+    in_range = '"%s" >= %%s AND "%s" < %%s' % (column, column)
+    if _relation_exists(default) and \
+            _execute("SELECT 1 FROM %s WHERE %s LIMIT 1" % (default, in_range), bounds).fetchone() is not None:
+        # The new partition can't be attached while the default partition holds
+        # entries in its range: detach the default partition while they are moved.
+        # Detaching locks the parent table until the end of the transaction.
+        logging.warning("Moving entries of %s from %s to %s", table, default, partition)
+        _execute("ALTER TABLE %s DETACH PARTITION %s" % (table, default))
+        _execute("CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)" % (partition, table), bounds)
+        _execute("INSERT INTO %s SELECT * FROM %s WHERE %s" % (partition, default, in_range), bounds)
+        _execute("DELETE FROM %s WHERE %s" % (default, in_range), bounds)
+        _execute("ALTER TABLE %s ATTACH PARTITION %s DEFAULT" % (table, default))
+    else:
+        _execute("CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)" % (partition, table), bounds)
+    _create_indices(table, partition)
+    return partition
+
+def create_future_partitions(table, days_ahead=PARTITIONS_AHEAD, interval=PARTITION_INTERVAL, first_day=None):
+    """
+        Create the partitions for today and the given number of days ahead.
+        A partition that can't be created is logged and skipped.
+        @param table: name of the partitioned table
+        @param days_ahead: number of days to cover
+        @param interval: 'daily' or 'weekly'
+        @param first_day: first day to cover, if not today
+    """
+    today = timezone.now().date()
+    if first_day is None:
+        first_day = today
+    created = []
+    day = first_day
+    while day <= today + datetime.timedelta(days=days_ahead):
+        try:
+            # Use a savepoint so that a failure doesn't abort the enclosing transaction
+            with transaction.atomic():
+                partition = create_partition(table, day, interval)
+            if partition not in created:
+                created.append(partition)
+        except:
+            logging.error("Could not create the partition of %s for %s: %s", table, day, sys.exc_value)
+        day += datetime.timedelta(days=1)
+    return created
+
+def drop_expired_partitions(table, cutoff, interval=PARTITION_INTERVAL):
+    """
+        Drop the partitions that only hold entries older than a cutoff date.
+        Returns the list of dropped partitions.
+        @param table: name of the partitioned table
+        @param cutoff: aware datetime object
+        @param interval: 'daily' or 'weekly'
+    """
+    cutoff_day = cutoff.astimezone(timezone.utc).date()
+    partitions = list_partitions(table)
+    dropped = []
+    for name, start in partitions:
+        if start + _interval(interval) <= cutoff_day:
+            _execute("DROP TABLE IF EXISTS %s" % name)
+            dropped.append(name)
+    # The legacy partition holds everything before the first regular partition
+    if len(partitions) > 0 and partitions[0][1] <= cutoff_day:
+        if _relation_exists("%s_legacy" % table):
+            _execute("DROP TABLE %s_legacy" % table)
+            dropped.append("%s_legacy" % table)
+    return dropped
+
+def _last_day(table, relation):
+    """
+        Return the day of the latest entry of a table, or None if it is empty
+        @param table: name of the partitioned table
+        @param relation: name of the table to look at
+    """
+    column = PARTITIONED_TABLES[table]['column']
+    latest = _execute('SELECT MAX("%s") FROM %s' % (column, relation)).fetchone()[0]
+    if latest is None:
+        return None
+    if PARTITIONED_TABLES[table]['epoch']:
+        return datetime.datetime.utcfromtimestamp(latest).date()
+    return latest.astimezone(timezone.utc).date()
+
+def convert_table(table, days_ahead=PARTITIONS_AHEAD, interval=PARTITION_INTERVAL):
+    """
+        Convert a regular table to the partitioned layout.
+        The existing table becomes the legacy partition. It covers
+        everything up to the partition boundary following its latest entry.
+        @param table: name of the table
+        @param days_ahead: number of days for which to create partitions
+        @param interval: 'daily' or 'weekly'
+    """
+    if is_partitioned(table):
+        logging.info("%s is already partitioned", table)
+        return
+    column = PARTITIONED_TABLES[table]['column']
+    legacy = "%s_legacy" % table
+    sequence = _execute("SELECT pg_get_serial_sequence(%s, 'id')", [table]).fetchone()[0]
+
+    # The rename locks the table, so no entry is added after we find the latest one
+    _execute("ALTER TABLE %s RENAME TO %s" % (table, legacy))
+    first_day = _partition_start(timezone.now().date(), interval)
+    last_day = _last_day(table, legacy)
+    if last_day is not None:
+        first_day = max(first_day, _partition_start(last_day, interval) + _interval(interval))
+    _execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE ("%s")' % (table, legacy, column))
+    if sequence is not None:
+        _execute("ALTER SEQUENCE %s OWNED BY %s.id" % (sequence, table))
+    _execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%%s)" % (table, legacy),
+             [_boundary(table, first_day)])
+    _execute("CREATE TABLE %s_default PARTITION OF %s DEFAULT" % (table, table))
+    _create_indices(table, "%s_default" % table)
+    create_future_partitions(table, days_ahead, interval, first_day=first_day)
+
+def partition_cutoff(epoch_cutoff):
+    """
+        Convert a cutoff in epoch seconds to an aware datetime
+        @param epoch_cutoff: time in seconds since epoch
+    """
+    return datetime.datetime.utcfromtimestamp(epoch_cutoff).replace(tzinfo=timezone.utc)
+
+def maintain(cutoff_epoch=None, days_ahead=PARTITIONS_AHEAD, interval=PARTITION_INTERVAL):
+    """
+        Create future partitions and drop expired ones for all partitioned tables.
+        Returns a dictionary of dropped partitions, keyed by table.
+        @param cutoff_epoch: entries older than this time are expired [epoch secs]. If None, nothing is dropped.
+        @param days_ahead: number of days for which to create partitions
+        @param interval: 'daily' or 'weekly'
+    """
+    dropped = {}
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(table):
+            continue
+        create_future_partitions(table, days_ahead, interval)
+        if cutoff_epoch is not None:
+            dropped[table] = drop_expired_partitions(table, partition_cutoff(cutoff_epoch), interval)
+    return dropped
@@ -0,0 +1,139 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Live status snapshot shared between the DASMON listener and the web monitor.
+
+    The listener periodically publishes the latest value of every DASMON
+    parameter, for every instrument, to a memory-mapped file. The web monitor
+    reads it instead of querying the StatusCache table for every request.
+
+    File layout:
+      - header: magic string, format version, sequence number,
+        publication time [epoch secs], payload length,
+      - payload: JSON dictionary {instrument name: {parameter name: [value, epoch time]}}.
+
+    The sequence number is odd while the payload is being written. Readers
+    retry if the sequence number is odd or changed while they were reading.
+    When the payload no longer fits, the writer creates a larger file
+    and moves it in place, so readers always see a complete file.
+
+    Readers get None when the file is missing, has an unknown format, or is
+    older than the given maximum age, and should then fall back to the DB.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import logging
+
+## Header: magic, format version, sequence number, publication time, payload length
+HEADER = struct.Struct('!4sIQdI')
+MAGIC = 'DSNP'
+FORMAT_VERSION = 1
+# Initial size of the snapshot file [bytes]
+DEFAULT_SIZE = 1024 * 1024
+
+# Last snapshot read by this process: ((sequence, publication time), data)
+_last_read = (None, None)
+
+
+class SnapshotWriter(object):
+    """
+        Publishes snapshots to a memory-mapped file
+    """
+
+    def __init__(self, file_path, size=DEFAULT_SIZE):
+        """
+            @param file_path: path of the snapshot file
+            @param size: initial size of the file [bytes]
+        """
+        self._file_path = file_path
+        self._size = size
+        self._mmap = None
+        self._sequence = 0
+
+    def _create(self, size):
+        """
+            Create a new snapshot file and move it in place
+            @param size: size of the file [bytes]
+        """
+        tmp_path = "%s.%d" % (self._file_path, os.getpid())
+        with open(tmp_path, 'wb') as fd:
+            fd.truncate(size)
+        with open(tmp_path, 'r+b') as fd:
+            new_mmap = mmap.mmap(fd.fileno(), size)
+        # Mark the new file as being written until the first publication
+        HEADER.pack_into(new_mmap, 0, MAGIC, FORMAT_VERSION, self._sequence + 1, 0, 0)
+        os.rename(tmp_path, self._file_path)
+        self.close()
+        self._mmap = new_mmap
+        self._size = size
+
+    def publish(self, data):
+        """
+            Write a new snapshot
+            @param data: dictionary {instrument name: {parameter name: [value, epoch time]}}
+        """
+        payload = json.dumps(data)
+        needed = HEADER.size + len(payload)
+        if self._mmap is None or needed > self._size:
+            self._create(max(self._size, 2 * needed))
+        publish_time = time.time()
+        # Odd sequence number: write in progress
+        self._sequence += 1
+        HEADER.pack_into(self._mmap, 0, MAGIC, FORMAT_VERSION, self._sequence, publish_time, len(payload))
+        self._mmap[HEADER.size:needed] = payload
+        self._sequence += 1
+        HEADER.pack_into(self._mmap, 0, MAGIC, FORMAT_VERSION, self._sequence, publish_time, len(payload))
+
+    def close(self):
+        """
+            Release the memory map
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def read_snapshot(file_path, max_age=10, retries=3):
+    """
+        Read the latest snapshot. Returns None if it is missing or stale.
+        The parsed snapshot is kept in memory until a new one is published.
+        @param file_path: path of the snapshot file
+        @param max_age: snapshots older than this are ignored [secs]
+        @param retries: number of attempts when the snapshot is being written
+    """
+    global _last_read
+    try:
+        with open(file_path, 'rb') as fd:
+            snapshot_map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except:
+        # No snapshot file, or an empty one
+        return None
+    try:
+        for _ in range(retries):
+            magic, version, sequence, publish_time, length = HEADER.unpack_from(snapshot_map, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                logging.error("Unknown snapshot format in %s", file_path)
+                return None
+            if sequence % 2 == 1:
+                time.sleep(0.001)
+                continue
+            if time.time() - publish_time > max_age:
+                return None
+            if _last_read[0] == (sequence, publish_time):
+                return _last_read[1]
+            payload = snapshot_map[HEADER.size:HEADER.size + length]
+            if HEADER.unpack_from(snapshot_map, 0)[2] != sequence:
+                continue
+            data = json.loads(payload)
+            _last_read = ((sequence, publish_time), data)
+            return data
+    except:
+        logging.error("Could not read snapshot %s: %s", file_path, sys.exc_value)
+    finally:
+        snapshot_map.close()
+    return None
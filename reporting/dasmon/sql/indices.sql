@@ -1,9 +1,41 @@
 -- Index: dasmon_statusvariable_time_key
 -- DROP INDEX dasmon_statusvariable_time_key;
+-- When the table is partitioned (see dasmon/partitions.py),
+-- this index is created on each partition by "manage.py partitions".
 
 CREATE INDEX dasmon_statusvariable_time_key
   ON dasmon_statusvariable
   USING btree
   (instrument_id_id , key_id_id , "timestamp" );
+
+
+-- Index: dasmon_statusvariable_time
+-- Used by the DASMON listener to find the range of entries to purge.
+-- DROP INDEX dasmon_statusvariable_time;
+-- When the table is partitioned (see dasmon/partitions.py),
+-- this index is created on each partition by "manage.py partitions".
+
+CREATE INDEX dasmon_statusvariable_time
+  ON dasmon_statusvariable
+  USING btree
+  ("timestamp" );
   
- 
\ No newline at end of file
+ 
+-- Index: dasmon_statuscache_instrument_key
+-- The DASMON listener writes the status cache with INSERT ... ON CONFLICT,
+-- which requires a unique index on (instrument_id_id, key_id_id).
+-- The index is not declared on the model, so that it is only created here.
+-- Older databases may hold duplicate cache entries: keep only the latest one
+-- before creating the index.
+-- DROP INDEX dasmon_statuscache_instrument_key;
+
+DELETE FROM dasmon_statuscache a
+  USING dasmon_statuscache b
+  WHERE a.instrument_id_id = b.instrument_id_id
+    AND a.key_id_id = b.key_id_id
+    AND (a."timestamp" < b."timestamp" OR (a."timestamp" = b."timestamp" AND a.id < b.id));
+
+CREATE UNIQUE INDEX dasmon_statuscache_instrument_key
+  ON dasmon_statuscache
+  USING btree
+  (instrument_id_id , key_id_id );
@@ -0,0 +1,32 @@
+-- Storage policy columns of dasmon_parameter.
+-- Only needed when upgrading an existing database with Django < 1.7,
+-- where "manage.py syncdb" doesn't add columns to existing tables.
+-- With Django >= 1.7, the columns are added by "manage.py migrate".
+-- The script can be run more than once. The default values keep the
+-- previous behavior of storing every value.
+-- See dasmon_listener/storage_policy.py
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'dasmon_parameter' AND column_name = 'store_on_change') THEN
+        ALTER TABLE dasmon_parameter ADD COLUMN store_on_change boolean NOT NULL DEFAULT false;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'dasmon_parameter' AND column_name = 'deadband_abs') THEN
+        ALTER TABLE dasmon_parameter ADD COLUMN deadband_abs double precision NULL;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'dasmon_parameter' AND column_name = 'deadband_rel') THEN
+        ALTER TABLE dasmon_parameter ADD COLUMN deadband_rel double precision NULL;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'dasmon_parameter' AND column_name = 'min_interval') THEN
+        ALTER TABLE dasmon_parameter ADD COLUMN min_interval double precision NOT NULL DEFAULT 0;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'dasmon_parameter' AND column_name = 'keep_alive') THEN
+        ALTER TABLE dasmon_parameter ADD COLUMN keep_alive double precision NULL;
+    END IF;
+END
+$$;
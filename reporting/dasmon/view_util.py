@@ -20,6 +20,8 @@ import time
 import report.view_util
 import pvmon.view_util
 import users.view_util
+from workflow.database.registry import get_table
+from dasmon.snapshot import read_snapshot
 
 def get_monitor_breadcrumbs(instrument_id, current_view='monitor'):
     """
@@ -37,13 +39,63 @@ def get_monitor_breadcrumbs(instrument_id, current_view='monitor'):
     breadcrumbs += " &rsaquo; %s" % current_view
     return breadcrumbs
 
+def _get_snapshot(instrument_id):
+    """
+        Return the latest values published by the DASMON listener for a given instrument,
+        as a dictionary {parameter name: [value, epoch time]}.
+        Returns None if the snapshot is not available, in which case the DB should be used.
+        @param instrument_id: Instrument object
+    """
+    snapshot_file = getattr(settings, 'DASMON_SNAPSHOT_FILE', None)
+    if snapshot_file is None:
+        return None
+    data = read_snapshot(snapshot_file, max_age=settings.DASMON_SNAPSHOT_MAX_AGE)
+    if data is None:
+        return None
+    return data.get(instrument_id.name, {})
+
+def _snapshot_entry(instrument_id, key_id, entry):
+    """
+        Return an unsaved StatusCache object for a snapshot entry
+        @param instrument_id: Instrument object
+        @param key_id: Parameter object
+        @param entry: [value, epoch time]
+    """
+    timestamp = datetime.datetime.utcfromtimestamp(entry[1]).replace(tzinfo=timezone.utc)
+    return StatusCache(instrument_id=instrument_id, key_id=key_id,
+                       value=entry[0], timestamp=timestamp)
+
+def get_cached_value(instrument_id, key_id):
+    """
+        Returns the cached entry for a given key on a given instrument,
+        from the listener snapshot if available or from the DB otherwise.
+        Raises StatusCache.DoesNotExist if there is no cached entry.
+        @param instrument_id: Instrument object
+        @param key_id: Parameter object
+    """
+    snapshot = _get_snapshot(instrument_id)
+    if snapshot is not None:
+        if key_id.name not in snapshot:
+            raise StatusCache.DoesNotExist("No cached value for %s" % key_id.name)
+        return _snapshot_entry(instrument_id, key_id, snapshot[key_id.name])
+    return StatusCache.objects.filter(instrument_id=instrument_id, key_id=key_id).latest('timestamp')
+
 def get_cached_variables(instrument_id, monitored_only=False):
     """
         Get cached parameter values for a given instrument
         @param instrument_id: Instrument object
         @param monitored_only: if True, only monitored parameters are returned
     """
-    parameter_values = StatusCache.objects.filter(instrument_id=instrument_id).order_by("key_id__name")
+    snapshot = _get_snapshot(instrument_id)
+    if snapshot is not None:
+        parameter_values = []
+        for name in sorted(snapshot.keys()):
+            try:
+                parameter_values.append(_snapshot_entry(instrument_id, get_table(Parameter).get(name), snapshot[name]))
+            except Parameter.DoesNotExist:
+                logging.debug("Unknown parameter in snapshot: %s", name)
+    else:
+        parameter_values = StatusCache.objects.filter(instrument_id=instrument_id).order_by("key_id__name")
     # Variables that are displayed on top
     top_variables = ['run_number', 'proposal_id', 'run_title']
     key_value_pairs = []
@@ -102,8 +154,7 @@ def get_latest(instrument_id, key_id):
     """
     # First get it from the cache
     try:
-        last_value = StatusCache.objects.filter(instrument_id=instrument_id,
-                                                key_id=key_id).latest('timestamp')
+        last_value = get_cached_value(instrument_id, key_id)
     except:
         # If that didn't work, get it from the table of values
         values = StatusVariable.objects.filter(instrument_id=instrument_id,
@@ -135,14 +186,14 @@ def is_running(instrument_id):
         logging.error("Could not determine whether %s is running ADARA", str(instrument_id))
     try:
         is_recording = False
-        key_id = Parameter.objects.get(name="recording")
+        key_id = get_table(Parameter).get("recording")
         last_value = get_latest(instrument_id, key_id)
         if last_value is not None:
             is_recording = last_value.value.lower() == "true"
 
         is_paused = False
         try:
-            key_id = Parameter.objects.get(name="paused")
+            key_id = get_table(Parameter).get("paused")
             last_value = get_latest(instrument_id, key_id)
             if last_value is not None:
                 is_paused = last_value.value.lower() == "true"
@@ -234,7 +285,7 @@ def _find_value(instrument_id, dasmon_name, default='-', prune=False):
     """
     _value = default
     try:
-        key_id = Parameter.objects.get(name=dasmon_name)
+        key_id = get_table(Parameter).get(dasmon_name)
         last_value = get_latest(instrument_id, key_id)
         _value = last_value.value
         if prune:
@@ -272,24 +323,27 @@ def get_live_variables(request, instrument_id):
         if len(key) == 0: continue
         try:
             data_list = []
-            key_id = Parameter.objects.get(name=key)
-            values = StatusVariable.objects.filter(instrument_id=instrument_id,
-                                                   key_id=key_id,
-                                                   timestamp__gte=two_hours)
-            if len(values) > 0:
-                values = values.order_by(settings.DASMON_SQL_SORT).reverse()
+            key_id = get_table(Parameter).get(key)
+            # The time range is part of the query so that only the
+            # relevant partitions are scanned when the table is partitioned
+            values = list(StatusVariable.objects.filter(instrument_id=instrument_id,
+                                                        key_id=key_id,
+                                                        timestamp__gte=two_hours).order_by(settings.DASMON_SQL_SORT).reverse())
             # If you don't have any values for the past 2 hours, just show
             # the latest values up to 20
             if len(values) == 0:
-                values = StatusVariable.objects.filter(instrument_id=instrument_id,
-                                                       key_id=key_id)
-                if len(values) > 0:
-                    values = values.order_by(settings.DASMON_SQL_SORT).reverse()
-                else:
+                values = list(StatusVariable.objects.filter(instrument_id=instrument_id,
+                                                            key_id=key_id).order_by(settings.DASMON_SQL_SORT).reverse()[:settings.DASMON_NUMBER_OF_OLD_PTS])
+                if len(values) == 0:
                     data_dict.append([key, []])
                     continue
-                if len(values) > settings.DASMON_NUMBER_OF_OLD_PTS:
-                    values = values[:settings.DASMON_NUMBER_OF_OLD_PTS]
+
+            # When the parameter has a storage policy, the latest value may
+            # only be in the cache: add it so that the plot extends to it
+            if key_id.has_storage_policy():
+                cached = StatusCache.objects.filter(instrument_id=instrument_id, key_id=key_id)
+                if len(cached) > 0 and cached[0].timestamp > values[0].timestamp:
+                    values.insert(0, cached[0])
 
             for v in values:
                 delta_t = now - v.timestamp
@@ -329,8 +383,8 @@ def get_component_status(instrument_id, red_timeout=1, yellow_timeout=None, proc
         if not ActiveInstrument.objects.is_adara(instrument_id):
             return -1
 
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + process)
-        last_value = StatusCache.objects.filter(instrument_id=instrument_id, key_id=key_id).latest('timestamp')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + process)
+        last_value = get_cached_value(instrument_id, key_id)
         # Check the status value
         #    STATUS_OK = 0
         #    STATUS_FAULT = 1
@@ -363,9 +417,9 @@ def get_workflow_status(red_timeout=1, yellow_timeout=None):
     delta_long = datetime.timedelta(hours=red_timeout)
 
     try:
-        common_services = Instrument.objects.get(name='common')
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + 'workflowmgr')
-        last_value = StatusCache.objects.filter(instrument_id=common_services, key_id=key_id).latest('timestamp')
+        common_services = get_table(Instrument).get('common')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + 'workflowmgr')
+        last_value = get_cached_value(common_services, key_id)
         if int(last_value.value) > 0:
             logging.error("WorkflowMgr status = %s", last_value.value)
             return 2
@@ -397,9 +451,9 @@ def workflow_diagnostics(timeout=None):
     status_time = datetime.datetime(2000, 1, 1, 0, 1).replace(tzinfo=timezone.get_current_timezone())
     common_services = None
     try:
-        common_services = Instrument.objects.get(name='common')
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + 'workflowmgr')
-        last_value = StatusCache.objects.filter(instrument_id=common_services, key_id=key_id).latest('timestamp')
+        common_services = get_table(Instrument).get('common')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + 'workflowmgr')
+        last_value = get_cached_value(common_services, key_id)
         status_value = int(last_value.value)
         status_time = timezone.localtime(last_value.timestamp)
     except:
@@ -410,7 +464,7 @@ def workflow_diagnostics(timeout=None):
     # Determine the number of workflow manager processes running
     process_list = []
     try:
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + 'workflowmgr_pid')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + 'workflowmgr_pid')
         last_values = StatusVariable.objects.filter(instrument_id=common_services, key_id=key_id).order_by('-timestamp')
         pid_list = []
         for item in last_values:
@@ -423,7 +477,7 @@ def workflow_diagnostics(timeout=None):
 
     dasmon_listener_list = []
     try:
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + 'dasmon_listener_pid')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + 'dasmon_listener_pid')
         last_values = StatusVariable.objects.filter(instrument_id=common_services, key_id=key_id).order_by('-timestamp')
         pid_list = []
         for item in last_values:
@@ -473,7 +527,7 @@ def postprocessing_diagnostics(timeout=None):
 
     # Get the status of auto-reduction nodes
     try:
-        common_services = Instrument.objects.get(name='common')
+        common_services = get_table(Instrument).get('common')
         nodes = []
         for item in Parameter.objects.all().order_by("name"):
             for node_prefix in settings.POSTPROCESS_NODE_PREFIX:
@@ -531,8 +585,8 @@ def pvstreamer_diagnostics(instrument_id, timeout=None, process='pvstreamer'):
     status_value = -1
     status_time = datetime.datetime(2000, 1, 1, 0, 1).replace(tzinfo=timezone.get_current_timezone())
     try:
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + process)
-        last_value = StatusCache.objects.filter(instrument_id=instrument_id, key_id=key_id).latest('timestamp')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + process)
+        last_value = get_cached_value(instrument_id, key_id)
         status_value = int(last_value.value)
         status_time = timezone.localtime(last_value.timestamp)
     except:
@@ -575,7 +629,7 @@ def dasmon_diagnostics(instrument_id, timeout=None):
     status_value = -1
     status_time = datetime.datetime(2000, 1, 1, 0, 1).replace(tzinfo=timezone.get_current_timezone())
     try:
-        key_id = Parameter.objects.get(name=settings.SYSTEM_STATUS_PREFIX + 'dasmon')
+        key_id = get_table(Parameter).get(settings.SYSTEM_STATUS_PREFIX + 'dasmon')
         last_value = StatusCache.objects.filter(instrument_id=instrument_id, key_id=key_id).latest('timestamp')
         status_value = int(last_value.value)
         status_time = timezone.localtime(last_value.timestamp)
@@ -997,7 +1051,7 @@ def add_status_entry(instrument_id, message_channel, value):
     """
     # Find the parameter used to report updates
     try:
-        key_id = Parameter.objects.get(name=message_channel)
+        key_id = get_table(Parameter).get(message_channel)
         update = StatusVariable(instrument_id=instrument_id,
                                 key_id=key_id,
                                 value=str(value))
@@ -1019,7 +1073,7 @@ def get_latest_updates(instrument_id, message_channel,
     """
     # Find the parameter used to report updates
     try:
-        key_id = Parameter.objects.get(name=message_channel)
+        key_id = get_table(Parameter).get(message_channel)
     except:
         logging.error("get_latest_updates: could not find parameter for %s", message_channel)
         return []
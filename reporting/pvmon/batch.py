@@ -0,0 +1,70 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Batch insertion of PV values, using the "pvUpdateBatch" and
+    "pvStringUpdateBatch" stored procedures defined in pvmon/sql/stored_procs.sql.
+
+    Usage:
+        from pvmon.batch import update_pvs
+        update_pvs([('bl6', 'BL6:Mot:Position', 1.5, 0, 1451606400),
+                    ('bl6', 'BL6:CS:Run:Title', 'Sample 1', 0, 1451606400)])
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+from django.db import connection, transaction
+
+# Maximum number of values sent in a single call
+BATCH_SIZE = 1000
+
+_NUMERIC_SQL = 'SELECT "pvUpdateBatch"(%s::varchar[], %s::varchar[], %s::float8[], %s::bigint[], %s::bigint[])'
+_STRING_SQL = 'SELECT "pvStringUpdateBatch"(%s::varchar[], %s::varchar[], %s::varchar[], %s::bigint[], %s::bigint[])'
+
+
+def _call(sql, pv_list, batch_size):
+    """
+        Send a list of values to a batch stored procedure
+        @param sql: SQL statement calling the stored procedure
+        @param pv_list: list of (instrument, name, value, status, update_time)
+        @param batch_size: maximum number of values per call
+    """
+    cursor = connection.cursor()
+    for i in range(0, len(pv_list), batch_size):
+        chunk = pv_list[i:i + batch_size]
+        # Transpose the list of tuples into one list per column
+        cursor.execute(sql, [list(column) for column in zip(*chunk)])
+
+@transaction.atomic
+def update_numeric_pvs(pv_list, batch_size=BATCH_SIZE):
+    """
+        Store numerical PV values and update the PV cache
+        @param pv_list: list of (instrument, name, value, status, update_time)
+        @param batch_size: maximum number of values per call
+    """
+    _call(_NUMERIC_SQL, [(i, n, float(v), int(s), int(t)) for i, n, v, s, t in pv_list], batch_size)
+
+@transaction.atomic
+def update_string_pvs(pv_list, batch_size=BATCH_SIZE):
+    """
+        Store string PV values and update the PV string cache
+        @param pv_list: list of (instrument, name, value, status, update_time)
+        @param batch_size: maximum number of values per call
+    """
+    _call(_STRING_SQL, [(i, n, unicode(v), int(s), int(t)) for i, n, v, s, t in pv_list], batch_size)
+
+def update_pvs(pv_list, batch_size=BATCH_SIZE):
+    """
+        Store PV values, sending numbers to the PV tables and
+        strings to the PV string tables.
+        @param pv_list: list of (instrument, name, value, status, update_time)
+        @param batch_size: maximum number of values per call
+    """
+    numeric = []
+    strings = []
+    for item in pv_list:
+        if isinstance(item[2], basestring):
+            strings.append(item)
+        else:
+            numeric.append(item)
+    if len(numeric) > 0:
+        update_numeric_pvs(numeric, batch_size)
+    if len(strings) > 0:
+        update_string_pvs(strings, batch_size)
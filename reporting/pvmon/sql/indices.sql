@@ -1,7 +1,27 @@
 -- Index: pvmon_pv_time_key
 -- DROP INDEX pvmon_pv_time_key;
+-- When the table is partitioned (see dasmon/partitions.py),
+-- this index is created on each partition by "manage.py partitions".
 
 CREATE INDEX pvmon_pv_time_key
   ON pvmon_pv
   USING btree
-  (instrument_id , name_id , update_time );
\ No newline at end of file
+  (instrument_id , name_id , update_time );
+
+
+-- Indices: pvmon_pv_time, pvmon_pvstring_time
+-- Used by the DASMON listener to find the range of entries to purge.
+-- DROP INDEX pvmon_pv_time;
+-- DROP INDEX pvmon_pvstring_time;
+-- When the tables are partitioned (see dasmon/partitions.py),
+-- these indices are created on each partition by "manage.py partitions".
+
+CREATE INDEX pvmon_pv_time
+  ON pvmon_pv
+  USING btree
+  (update_time );
+
+CREATE INDEX pvmon_pvstring_time
+  ON pvmon_pvstring
+  USING btree
+  (update_time );
@@ -180,4 +180,116 @@ $BODY$
   LANGUAGE plpgsql VOLATILE
   COST 100;
 ALTER FUNCTION "pvStringUpdate"(character varying, character varying, character varying, bigint, bigint)
-  OWNER TO postgres;
\ No newline at end of file
+  OWNER TO postgres;
+
+-- Batch versions of "pvUpdate" and "pvStringUpdate".
+-- Each argument is an array, and element k of each array describes one PV value.
+-- PV names are resolved once for the whole batch, history rows are added with a
+-- single INSERT, and the cache is updated with a single statement using the latest
+-- value of each PV in the batch.
+-- Requires PGSQL >= 9.1 (data-modifying statements in WITH).
+
+-- Function: "pvUpdateBatch"(character varying[], character varying[], double precision[], bigint[], bigint[])
+
+DROP FUNCTION IF EXISTS "pvUpdateBatch"(character varying[], character varying[], double precision[], bigint[], bigint[]);
+
+CREATE OR REPLACE FUNCTION "pvUpdateBatch"(instruments character varying[], pv_names character varying[], pv_values double precision[], statuses bigint[], update_times bigint[])
+  RETURNS void AS
+$BODY$
+BEGIN
+  -- Create the parameter name entries that don't already exist
+  INSERT INTO pvmon_pvname (name, monitored)
+    SELECT DISTINCT pv_names[k], true
+      FROM generate_subscripts(pv_names, 1) AS k
+      WHERE NOT EXISTS (SELECT 1 FROM pvmon_pvname WHERE pvmon_pvname.name = pv_names[k]);
+
+  -- Add the entries for the new values
+  INSERT INTO pvmon_pv (instrument_id, name_id, value, status, update_time)
+    SELECT report_instrument.id, pvmon_pvname.id, pv_values[k], statuses[k], update_times[k]
+      FROM generate_subscripts(pv_names, 1) AS k
+      JOIN pvmon_pvname ON pvmon_pvname.name = pv_names[k]
+      LEFT JOIN report_instrument ON report_instrument.name = lower(instruments[k])
+      ORDER BY k;
+
+  -- Cache the latest values
+  WITH latest AS (
+    SELECT DISTINCT ON (report_instrument.id, pvmon_pvname.id)
+           report_instrument.id AS instrument_id, pvmon_pvname.id AS name_id,
+           pv_values[k] AS value, statuses[k] AS status, update_times[k] AS update_time
+      FROM generate_subscripts(pv_names, 1) AS k
+      JOIN pvmon_pvname ON pvmon_pvname.name = pv_names[k]
+      LEFT JOIN report_instrument ON report_instrument.name = lower(instruments[k])
+      ORDER BY report_instrument.id, pvmon_pvname.id, update_times[k] DESC, k DESC
+  ), updated AS (
+    UPDATE pvmon_pvcache
+      SET value=latest.value, status=latest.status, update_time=latest.update_time
+      FROM latest
+      WHERE pvmon_pvcache.name_id = latest.name_id
+        AND pvmon_pvcache.instrument_id IS NOT DISTINCT FROM latest.instrument_id
+      RETURNING pvmon_pvcache.instrument_id, pvmon_pvcache.name_id
+  )
+  INSERT INTO pvmon_pvcache (instrument_id, name_id, value, status, update_time)
+    SELECT latest.instrument_id, latest.name_id, latest.value, latest.status, latest.update_time
+      FROM latest
+      WHERE NOT EXISTS (SELECT 1 FROM updated
+                        WHERE updated.name_id = latest.name_id
+                          AND updated.instrument_id IS NOT DISTINCT FROM latest.instrument_id);
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 100;
+ALTER FUNCTION "pvUpdateBatch"(character varying[], character varying[], double precision[], bigint[], bigint[])
+  OWNER TO postgres;
+
+
+-- Function: "pvStringUpdateBatch"(character varying[], character varying[], character varying[], bigint[], bigint[])
+
+DROP FUNCTION IF EXISTS "pvStringUpdateBatch"(character varying[], character varying[], character varying[], bigint[], bigint[]);
+
+CREATE OR REPLACE FUNCTION "pvStringUpdateBatch"(instruments character varying[], pv_names character varying[], pv_values character varying[], statuses bigint[], update_times bigint[])
+  RETURNS void AS
+$BODY$
+BEGIN
+  -- Create the parameter name entries that don't already exist
+  INSERT INTO pvmon_pvname (name, monitored)
+    SELECT DISTINCT pv_names[k], true
+      FROM generate_subscripts(pv_names, 1) AS k
+      WHERE NOT EXISTS (SELECT 1 FROM pvmon_pvname WHERE pvmon_pvname.name = pv_names[k]);
+
+  -- Add the entries for the new values
+  INSERT INTO pvmon_pvstring (instrument_id, name_id, value, status, update_time)
+    SELECT report_instrument.id, pvmon_pvname.id, pv_values[k], statuses[k], update_times[k]
+      FROM generate_subscripts(pv_names, 1) AS k
+      JOIN pvmon_pvname ON pvmon_pvname.name = pv_names[k]
+      LEFT JOIN report_instrument ON report_instrument.name = lower(instruments[k])
+      ORDER BY k;
+
+  -- Cache the latest values
+  WITH latest AS (
+    SELECT DISTINCT ON (report_instrument.id, pvmon_pvname.id)
+           report_instrument.id AS instrument_id, pvmon_pvname.id AS name_id,
+           pv_values[k] AS value, statuses[k] AS status, update_times[k] AS update_time
+      FROM generate_subscripts(pv_names, 1) AS k
+      JOIN pvmon_pvname ON pvmon_pvname.name = pv_names[k]
+      LEFT JOIN report_instrument ON report_instrument.name = lower(instruments[k])
+      ORDER BY report_instrument.id, pvmon_pvname.id, update_times[k] DESC, k DESC
+  ), updated AS (
+    UPDATE pvmon_pvstringcache
+      SET value=latest.value, status=latest.status, update_time=latest.update_time
+      FROM latest
+      WHERE pvmon_pvstringcache.name_id = latest.name_id
+        AND pvmon_pvstringcache.instrument_id IS NOT DISTINCT FROM latest.instrument_id
+      RETURNING pvmon_pvstringcache.instrument_id, pvmon_pvstringcache.name_id
+  )
+  INSERT INTO pvmon_pvstringcache (instrument_id, name_id, value, status, update_time)
+    SELECT latest.instrument_id, latest.name_id, latest.value, latest.status, latest.update_time
+      FROM latest
+      WHERE NOT EXISTS (SELECT 1 FROM updated
+                        WHERE updated.name_id = latest.name_id
+                          AND updated.instrument_id IS NOT DISTINCT FROM latest.instrument_id);
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 100;
+ALTER FUNCTION "pvStringUpdateBatch"(character varying[], character varying[], character varying[], bigint[], bigint[])
+  OWNER TO postgres;
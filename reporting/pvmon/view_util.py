@@ -57,19 +57,17 @@ def get_live_variables(request, instrument_id, key_id=None):
         key = str(key_id.name)
         try:
             data_list = []
-            values = PV.objects.filter(instrument_id=instrument_id,
-                                       name=key_id,
-                                       update_time__gte=two_hours)
-            if len(values) > 0:
-                values = values.order_by('update_time').reverse()
+            # The time range is part of the query so that only the
+            # relevant partitions are scanned when the table is partitioned
+            values = list(PV.objects.filter(instrument_id=instrument_id,
+                                            name=key_id,
+                                            update_time__gte=two_hours).order_by('-update_time'))
             # If you don't have any values for the past 2 hours, just show
             # the latest values up to 20
             if len(values) < 2:
-                values = PV.objects.filter(instrument_id=instrument_id,
-                                           name=key_id)
-                if len(values) > 0:
-                    values = values.order_by('update_time').reverse()
-                else:
+                values = list(PV.objects.filter(instrument_id=instrument_id,
+                                                name=key_id).order_by('-update_time')[:settings.PVMON_NUMBER_OF_OLD_PTS])
+                if len(values) == 0:
                     latest_entry = PVCache.objects.filter(instrument=instrument_id, name=key_id)
                     if len(latest_entry) > 0:
                         latest_entry = latest_entry.latest("update_time")
@@ -78,8 +76,6 @@ def get_live_variables(request, instrument_id, key_id=None):
                     else:
                         data_dict.append([key, []])
                     continue
-                if len(values) > settings.PVMON_NUMBER_OF_OLD_PTS:
-                    values = values[:settings.PVMON_NUMBER_OF_OLD_PTS]
 
             for v in values:
                 delta_t = now - v.update_time
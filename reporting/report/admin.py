@@ -1,5 +1,5 @@
 from report.models import DataRun, StatusQueue, RunStatus, WorkflowSummary, IPTS, Instrument, InstrumentStatus
-from report.models import Information, Error, Task
+from report.models import Information, Error, Task, ProcessingJob
 from django.contrib import admin
 from django.utils import dateformat, timezone
 from django.conf import settings
@@ -89,6 +89,12 @@ class InstrumentStatusAdmin(admin.ModelAdmin):
     readonly_fields=('last_run_id',)
     list_display = ('id', 'instrument_id', 'last_run_id')
 
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_filter = ('instrument_id', 'status')
+    list_display = ('id', 'instrument_id', 'ipts_id', 'task', 'run_list', 'status',
+                    'number_of_runs', 'submitted', 'failed', 'user', 'created_on')
+    readonly_fields = ('instrument_id', 'ipts_id')
+
 admin.site.register(DataRun, DataRunAdmin)
 admin.site.register(StatusQueue, StatusQueueAdmin)
 admin.site.register(RunStatus, RunStatusAdmin)
@@ -99,3 +105,4 @@ admin.site.register(Information, InformationAdmin)
 admin.site.register(Error, ErrorAdmin)
 admin.site.register(Task, TaskAdmin)
 admin.site.register(InstrumentStatus, InstrumentStatusAdmin)
+admin.site.register(ProcessingJob, ProcessingJobAdmin)
@@ -52,6 +52,126 @@ def get_run_info(instrument, ipts, run_number):
         facility = settings.FACILITY_INFO.get(instrument, 'SNS')
     return _get_run_info(instrument, ipts, run_number, facility)
 
+def get_runs_info(instrument, ipts, run_numbers):
+    """
+        Get the catalog information for a list of runs, with a single
+        catalog query. Returns a dictionary of run information
+        dictionaries, keyed by run number. Runs not found in the
+        catalog are left out.
+        :param str instrument: instrument short name
+        :param str ipts: experiment name
+        :param list run_numbers: list of run numbers
+    """
+    facility = 'SNS'
+    if hasattr(settings, 'FACILITY_INFO'):
+        facility = settings.FACILITY_INFO.get(instrument, 'SNS')
+    runs_info = {}
+    if len(run_numbers) == 0:
+        return runs_info
+    try:
+        datafiles = _list_datafiles(instrument, ipts, compress_run_list(run_numbers), facility)
+        for datafile in datafiles:
+            run_number = _get_run_number(datafile)
+            if run_number is None:
+                continue
+            if run_number not in runs_info:
+                runs_info[run_number] = {'data_files': []}
+            _add_datafile(runs_info[run_number], datafile)
+    except:
+        logging.error("Communication with ONCat server failed: %s", sys.exc_value)
+
+    return runs_info
+
+def compress_run_list(run_numbers):
+    """
+        Return a list of run numbers as a string of comma-separated
+        ranges, e.g. [1, 2, 3, 5] gives "1-3,5"
+        :param list run_numbers: list of run numbers
+    """
+    ranges = []
+    for run in run_numbers:
+        run = int(run)
+        if len(ranges) > 0 and run == ranges[-1][1] + 1:
+            ranges[-1][1] = run
+        else:
+            ranges.append([run, run])
+    return ','.join([str(r[0]) if r[0] == r[1] else "%s-%s" % (r[0], r[1]) for r in ranges])
+
+def _list_datafiles(instrument, ipts, ranges, facility='SNS'):
+    """
+        Query ONCat for the raw data files of a set of runs
+        :param str instrument: instrument short name
+        :param str ipts: experiment name
+        :param str ranges: comma-separated list of run ranges
+        :param str facility: facility name (SNS or HFIR)
+    """
+    oncat = pyoncat.ONCat(
+        settings.CATALOG_URL,
+        # Here we're using the machine-to-machine "Client Credentials" flow,
+        # which requires a client ID and secret, but no *user* credentials.
+        flow = pyoncat.CLIENT_CREDENTIALS_FLOW,
+        client_id = settings.CATALOG_ID,
+        client_secret = settings.CATALOG_SECRET,
+    )
+    oncat.login()
+
+    return oncat.Datafile.list(
+        facility = facility,
+        instrument = instrument.upper(),
+
+        # Specifying the exact IPTS that contains the runs you need is optional,
+        # but you should provide one if that information is available -- this will
+        # mean ONCat can respond quicker because it has to look in fewer places.
+        experiment = ipts,
+
+        # We are only interested in the location of "raw" .nxs.h5 files.
+        projection = ['experiment', 'location',
+                      'indexed.run_number',
+                      'metadata.entry.title',
+                      'metadata.entry.duration',
+                      'metadata.entry.total_counts',
+                      'metadata.entry.proton_charge',
+                      'metadata.entry.start_time',
+                      'metadata.entry.end_time',
+                      ],
+        tags = ['type/raw'],
+        #exts = ['.nxs.h5'],
+
+        # Specify the list of ranges of run numbers we want.
+        ranges_q = 'indexed.run_number:%s' % ranges
+    )
+
+def _get_run_number(datafile):
+    """
+        Return the run number of an ONCat data file, or None
+        :param datafile: ONCat data file
+    """
+    try:
+        return int(datafile.indexed.get('run_number'))
+    except:
+        # Fall back to the file name: INST_1234.nxs.h5 or INST_1234_event.nxs
+        toks = datafile.location.split('/')[-1].split('.')[0].split('_')
+        for item in reversed(toks):
+            if item.isdigit():
+                return int(item)
+    return None
+
+def _add_datafile(run_info, datafile):
+    """
+        Add the information of an ONCat data file to a run information dictionary
+        :param dict run_info: run information
+        :param datafile: ONCat data file
+    """
+    run_info['data_files'].append(datafile.location)
+    if datafile.location.endswith('.nxs.h5'):
+        run_info['title'] = datafile.metadata.get('entry', {}).get('title', None)
+        run_info['proposal'] = datafile.experiment
+        run_info['duration'] = datafile.metadata.get('entry', {}).get('duration', None)
+        run_info['totalCounts'] = datafile.metadata.get('entry', {}).get('total_counts', None)
+        run_info['protonCharge'] = datafile.metadata.get('entry', {}).get('proton_charge', None)
+        run_info['startTime'] = decode_time(datafile.metadata.get('entry', {}).get('start_time', None))
+        run_info['endTime'] = decode_time(datafile.metadata.get('entry', {}).get('end_time', None))
+
 def _get_run_info(instrument, ipts, run_number, facility='SNS'):
     """
         Get ONCat info for the specified run
@@ -63,52 +183,10 @@ def _get_run_info(instrument, ipts, run_number, facility='SNS'):
     """
     run_info = {}
     try:
-        oncat = pyoncat.ONCat(
-            settings.CATALOG_URL,
-            # Here we're using the machine-to-machine "Client Credentials" flow,
-            # which requires a client ID and secret, but no *user* credentials.
-            flow = pyoncat.CLIENT_CREDENTIALS_FLOW,
-            client_id = settings.CATALOG_ID,
-            client_secret = settings.CATALOG_SECRET,
-        )
-        oncat.login()
-
-        datafiles = oncat.Datafile.list(
-            facility = facility,
-            instrument = instrument.upper(),
-
-            # Specifying the exact IPTS that contains the runs you need is optional,
-            # but you should provide one if that information is available -- this will
-            # mean ONCat can respond quicker because it has to look in fewer places.
-            experiment = ipts,
-
-            # We are only interested in the location of "raw" .nxs.h5 files.
-            projection = ['experiment', 'location',
-                          'metadata.entry.title',
-                          'metadata.entry.duration',
-                          'metadata.entry.total_counts',
-                          'metadata.entry.proton_charge',
-                          'metadata.entry.start_time',
-                          'metadata.entry.end_time',
-                          ],
-            tags = ['type/raw'],
-            #exts = ['.nxs.h5'],
-
-            # Specify the list of ranges of run numbers we want.
-            ranges_q = 'indexed.run_number:%s' % str(run_number)
-        )
-
+        datafiles = _list_datafiles(instrument, ipts, str(run_number), facility)
         run_info['data_files'] = []
         for datafile in datafiles:
-            run_info['data_files'].append(datafile.location)
-            if datafile.location.endswith('.nxs.h5'):
-                run_info['title'] = datafile.metadata.get('entry', {}).get('title', None)
-                run_info['proposal'] = datafile.experiment
-                run_info['duration'] = datafile.metadata.get('entry', {}).get('duration', None)
-                run_info['totalCounts'] = datafile.metadata.get('entry', {}).get('total_counts', None)
-                run_info['protonCharge'] = datafile.metadata.get('entry', {}).get('proton_charge', None)
-                run_info['startTime'] = decode_time(datafile.metadata.get('entry', {}).get('start_time', None))
-                run_info['endTime'] = decode_time(datafile.metadata.get('entry', {}).get('end_time', None))
+            _add_datafile(run_info, datafile)
     except:
         logging.error("Communication with ONCat server failed: %s", sys.exc_value)
 
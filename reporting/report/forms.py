@@ -140,31 +140,27 @@ class ProcessingForm(forms.Form):
             output_report += "Fix your inputs and re-submit<br>"
             return {'report': output_report, 'task': None}
 
-        # Parse the runs and make sure they all exist
+        # Parse the runs and make sure they all exist.
+        # All the runs are looked up with a single query.
         run_list = validate_integer_list(self.cleaned_data['run_list'])
+        run_objects = DataRun.objects.filter(instrument_id=instrument,
+                                             run_number__in=run_list).select_related('ipts_id')
+        known_runs = {}
+        for run_obj in run_objects:
+            if run_obj.run_number not in known_runs or run_obj.ipts_id_id == ipts.id:
+                known_runs[run_obj.run_number] = run_obj
         invalid_runs = []
         valid_run_objects = []
         for run in run_list:
-            try:
-                run_obj = DataRun.objects.get(instrument_id=instrument,
-                                              ipts_id = ipts,
-                                              run_number=run)
-                # In some cases, when the DAS has started acquiring but the run is not
-                # completed, we can have an entry without a file path. When that's the
-                # case, create a standard path before submitting.
-                if len(run_obj.file) == 0:
-                    run_obj.file = ProcessingForm._create_file_path(instrument, ipts, run)
-                    run_obj.save()
-                valid_run_objects.append(run_obj)
-            except DataRun.DoesNotExist:
+            if run in known_runs and known_runs[run].ipts_id_id == ipts.id:
+                valid_run_objects.append(known_runs[run])
+            else:
                 invalid_runs.append(run)
                 if self.cleaned_data['create_as_needed']:
-                    # Create a file path
-                    file_path = ProcessingForm._create_file_path(instrument, ipts, run)
                     new_run = type('new_run', (object,), {'instrument_id' : instrument,
                                                           'run_number': run,
                                                           'ipts_id': ipts,
-                                                          'file': file_path})
+                                                          'file': ''})
                     valid_run_objects.append(new_run)
         if len(invalid_runs) == 0:
             output_report += "All the runs were valid<br>"
@@ -172,9 +168,8 @@ class ProcessingForm(forms.Form):
             # First look for mismatch between run and ipts
             has_ipts_mismatch = False
             for run in invalid_runs:
-                run_list = DataRun.objects.filter(instrument_id=instrument, run_number=run)
-                if len(run_list)>0:
-                    output_report += "Run %s was found in experiment %s<br>" % (run, run_list[0].ipts_id)
+                if run in known_runs:
+                    output_report += "Run %s was found in experiment %s<br>" % (run, known_runs[run].ipts_id)
                     has_ipts_mismatch = True
 
             if has_ipts_mismatch:
@@ -196,7 +191,7 @@ class ProcessingForm(forms.Form):
 
         # Returns a report and task to be sent
         return {'report': output_report, 'task': str(queue),
-                'instrument': instrument, 'runs': valid_run_objects}
+                'instrument': instrument, 'ipts': ipts, 'runs': valid_run_objects}
 
     def _recover_processed_run(self, instrument):
         """
@@ -216,4 +211,4 @@ class ProcessingForm(forms.Form):
 
         # Returns a report and task to be sent
         return {'report': output_report, 'task': str(self.cleaned_data['task']).upper(),
-                'instrument': instrument, 'runs': valid_run_objects, 'is_complete': True}
+                'instrument': instrument, 'ipts': None, 'runs': valid_run_objects, 'is_complete': True}
@@ -0,0 +1,47 @@
+"""
+    Run the bulk processing jobs submitted on the processing admin page.
+    See report/processing_jobs.py for details.
+
+    Run the queued jobs and exit:
+        python manage.py processjobs
+    Keep polling for new jobs:
+        python manage.py processjobs --loop
+"""
+import time
+from optparse import make_option
+import django
+from django.core.management.base import BaseCommand
+from report import processing_jobs
+
+class Command(BaseCommand):
+    help = "Run the queued bulk processing jobs"
+    if django.VERSION < (1, 8):
+        # Older versions only read the optparse options
+        option_list = BaseCommand.option_list + (
+            make_option('--loop', action='store_true', dest='loop', default=False,
+                        help='keep polling for new jobs'),
+            make_option('--interval', type='float', dest='interval', default=5.0,
+                        help='polling interval in seconds when looping'),
+            make_option('--requeue', action='store_true', dest='requeue', default=False,
+                        help='resume the jobs left running by a worker that stopped'),
+            )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', dest='loop', default=False,
+                            help='keep polling for new jobs')
+        parser.add_argument('--interval', type=float, dest='interval', default=5.0,
+                            help='polling interval in seconds when looping')
+        parser.add_argument('--requeue', action='store_true', dest='requeue', default=False,
+                            help='resume the jobs left running by a worker that stopped')
+
+    def handle(self, *args, **options):
+        if options.get('requeue', False):
+            count = processing_jobs.requeue_jobs()
+            self.stdout.write('Requeued %d jobs\n' % count)
+        while True:
+            count = processing_jobs.run_pending_jobs()
+            if count > 0:
+                self.stdout.write('Ran %d jobs\n' % count)
+            if not options.get('loop', False):
+                break
+            time.sleep(options.get('interval', 5.0))
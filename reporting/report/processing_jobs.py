@@ -0,0 +1,302 @@
+#pylint: disable=bare-except, invalid-name, too-many-arguments
+"""
+    Background processing of bulk post-processing requests.
+
+    A ProcessingJob records a request made on the processing admin page
+    or with test/recatalog.py. Its runs are processed in chunks:
+    one query to find the DataRun entries of the chunk, one catalog
+    query for the runs without a data file, and the messages are sent
+    together over the shared AMQ connection. The number of messages
+    sent per second is limited so that a large request doesn't flood
+    the workflow manager. Progress is saved after each chunk, so that
+    it can be polled, and so that an interrupted job can be resumed.
+    A running job that made no progress for PROCESSING_JOB_STALE_TIME
+    is assumed to be abandoned and is put back in the queue when
+    a worker looks for jobs.
+
+    Jobs are run by a thread of the web process, started when a job is
+    submitted (see PROCESSING_JOB_THREAD), or by the processjobs
+    management command:
+        python manage.py processjobs --loop
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import datetime
+import logging
+import threading
+from django.conf import settings
+from django.db import connection
+from django.utils import dateformat, timezone
+from report.models import DataRun, ProcessingJob
+from report.catalog import get_runs_info, compress_run_list
+from report.forms import ProcessingForm, validate_integer_list
+from . import view_util
+import reporting_app.view_util
+
+
+def create_job(instrument_id, ipts_id, run_numbers, task, user=None,
+               create_as_needed=False, is_complete=False, start=True):
+    """
+        Create a processing job
+        @param instrument_id: Instrument object
+        @param ipts_id: IPTS object, or None to find the runs in the catalog
+        @param run_numbers: list of run numbers
+        @param task: queue to send the requests to
+        @param user: user making the request
+        @param create_as_needed: if True, runs missing from the DB are created
+        @param is_complete: if True, the requests are flagged as complete
+        @param start: if True, start the worker thread if it is enabled
+    """
+    job = ProcessingJob(instrument_id=instrument_id,
+                        ipts_id=ipts_id,
+                        run_list=compress_run_list(run_numbers),
+                        task=task,
+                        user=str(user) if user is not None else '',
+                        create_as_needed=create_as_needed,
+                        is_complete=is_complete,
+                        number_of_runs=len(run_numbers))
+    job.save()
+    if start and settings.PROCESSING_JOB_THREAD:
+        start_worker()
+    return job
+
+def claim_job(job):
+    """
+        Mark a queued job as running.
+        Returns False if the job was already claimed by another worker.
+        @param job: ProcessingJob object
+    """
+    # QuerySet.update() doesn't set updated_on, which tells whether the job is stale
+    claimed = ProcessingJob.objects.filter(id=job.id, status=ProcessingJob.QUEUED) \
+        .update(status=ProcessingJob.RUNNING, updated_on=timezone.now())
+    if claimed == 1:
+        job.status = ProcessingJob.RUNNING
+        return True
+    return False
+
+def requeue_jobs(stale_time=None):
+    """
+        Put back in the queue the jobs left running by a worker that
+        stopped. They will resume after their last processed run.
+        @param stale_time: only requeue the jobs that made no progress for that long [secs].
+                           If None, every running job is requeued: only do this when
+                           no worker is running.
+    """
+    jobs = ProcessingJob.objects.filter(status=ProcessingJob.RUNNING)
+    if stale_time is not None:
+        jobs = jobs.filter(updated_on__lt=timezone.now() - datetime.timedelta(seconds=stale_time))
+    count = jobs.update(status=ProcessingJob.QUEUED)
+    if count > 0:
+        logging.warning("Requeued %d stale processing jobs", count)
+    return count
+
+def run_pending_jobs():
+    """
+        Run the queued jobs, oldest first, until none are left.
+        The jobs abandoned by a worker that stopped are run again.
+        Returns the number of jobs run.
+    """
+    requeue_jobs(stale_time=settings.PROCESSING_JOB_STALE_TIME)
+    count = 0
+    while True:
+        jobs = ProcessingJob.objects.filter(status=ProcessingJob.QUEUED).order_by('id')[:1]
+        if len(jobs) == 0:
+            return count
+        if claim_job(jobs[0]):
+            run_job(jobs[0])
+            count += 1
+
+def run_job(job, chunk_size=None, rate=None):
+    """
+        Process a claimed job, starting after the runs already processed
+        @param job: ProcessingJob object
+        @param chunk_size: number of runs looked up and sent together
+        @param rate: maximum number of messages sent per second, or 0 for no limit
+    """
+    from reporting_app.amq_producer import SendError
+    if chunk_size is None:
+        chunk_size = settings.PROCESSING_JOB_CHUNK_SIZE
+    if rate is None:
+        rate = settings.PROCESSING_JOB_RATE
+    try:
+        run_numbers = validate_integer_list(job.run_list)
+        position = job.submitted + job.failed
+        while position < len(run_numbers):
+            t0 = time.time()
+            chunk = run_numbers[position:position + chunk_size]
+            runs, failures = _find_runs(job, chunk)
+            messages, build_failures = _build_messages(job, runs)
+            failures.extend(build_failures)
+            if len(messages) > 0:
+                try:
+                    reporting_app.view_util.send_activemq_messages([(job.task, data) for _, data in messages],
+                                                                   confirm=True)
+                    job.submitted += len(messages)
+                except SendError:
+                    # Only the messages that were not confirmed failed
+                    logging.error("Could not send processing requests: %s", sys.exc_value)
+                    failed = set(sys.exc_value.failed)
+                    job.submitted += len(messages) - len(failed)
+                    failures.extend([(messages[i][0], "not sent or not confirmed by the broker") for i in sorted(failed)])
+                except:
+                    logging.error("Could not send processing requests: %s", sys.exc_value)
+                    failures.extend([(run, sys.exc_value) for run, _ in messages])
+            job.failed += len(failures)
+            for run, reason in failures:
+                job.report += "%s run %s could not be submitted: %s<br>" % (str(job.instrument_id), run, reason)
+            position += len(chunk)
+            job.save(update_fields=['submitted', 'failed', 'report', 'updated_on'])
+
+            # Limit the rate at which messages are sent
+            if rate > 0:
+                delay = len(messages) / float(rate) - (time.time() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+
+        if job.failed == 0:
+            job.report += "<b>All tasks were submitted</b><br>"
+        job.status = ProcessingJob.DONE
+    except:
+        logging.error("Processing job %s failed: %s", job.id, sys.exc_value)
+        job.report += "The job stopped: %s<br>" % sys.exc_value
+        job.status = ProcessingJob.FAILED
+    job.save()
+
+def _new_run(instrument_id, ipts_id, run_number, file_path):
+    """
+        Stand-in for a run that is not in the DB
+    """
+    return type('new_run', (object,), {'instrument_id' : instrument_id,
+                                       'run_number': run_number,
+                                       'ipts_id': ipts_id,
+                                       'file': file_path})
+
+def _find_runs(job, run_numbers):
+    """
+        Look up a chunk of runs with a single query.
+        Returns a list of run objects, and a list of (run number, reason)
+        for the runs that can't be processed.
+        @param job: ProcessingJob object
+        @param run_numbers: list of run numbers
+    """
+    runs = []
+    failures = []
+    # Recovery of runs that are only in the catalog
+    if job.ipts_id is None:
+        for run in run_numbers:
+            runs.append(_new_run(job.instrument_id, '', run, ''))
+        return runs, failures
+
+    known_runs = {}
+    run_objects = DataRun.objects.filter(instrument_id=job.instrument_id,
+                                         run_number__in=run_numbers).select_related('ipts_id')
+    for run_obj in run_objects:
+        if run_obj.run_number not in known_runs or run_obj.ipts_id_id == job.ipts_id_id:
+            known_runs[run_obj.run_number] = run_obj
+
+    for run in run_numbers:
+        run_obj = known_runs.get(run)
+        if run_obj is None:
+            if job.create_as_needed:
+                file_path = ProcessingForm._create_file_path(job.instrument_id, job.ipts_id, run)
+                runs.append(_new_run(job.instrument_id, job.ipts_id, run, file_path))
+            else:
+                failures.append((run, "run not found"))
+        elif run_obj.ipts_id_id != job.ipts_id_id:
+            failures.append((run, "run was found in experiment %s" % run_obj.ipts_id))
+        else:
+            # In some cases, when the DAS has started acquiring but the run is not
+            # completed, we can have an entry without a file path. When that's the
+            # case, create a standard path before submitting.
+            if len(run_obj.file) == 0:
+                run_obj.file = ProcessingForm._create_file_path(job.instrument_id, job.ipts_id, run)
+                run_obj.save(update_fields=['file'])
+            runs.append(run_obj)
+    return runs, failures
+
+def _build_messages(job, runs):
+    """
+        Build the messages for a list of runs. The runs without a data file
+        are looked up in the catalog with a single query.
+        Returns a list of (run number, message) and a list of (run number, reason)
+        for the runs that can't be processed.
+        @param job: ProcessingJob object
+        @param runs: list of run objects
+    """
+    runs_info = {}
+    missing = [run_obj.run_number for run_obj in runs if len(run_obj.file) == 0]
+    if len(missing) > 0:
+        ipts = '' if job.ipts_id is None else job.ipts_id.expt_name.upper()
+        runs_info = get_runs_info(str(job.instrument_id), ipts, missing)
+
+    user = job.user if len(job.user) > 0 else None
+    messages = []
+    failures = []
+    for run_obj in runs:
+        try:
+            data = view_util.build_processing_request(job.instrument_id, run_obj, user=user,
+                                                      is_complete=job.is_complete,
+                                                      run_info=runs_info.get(run_obj.run_number, {}))
+            messages.append((run_obj.run_number, data))
+        except:
+            failures.append((run_obj.run_number, sys.exc_value))
+    return messages, failures
+
+def job_summary(job):
+    """
+        Return a dictionary describing the state of a job
+        @param job: ProcessingJob object
+    """
+    localtime = timezone.localtime(job.created_on)
+    df = dateformat.DateFormat(localtime)
+    return {'id': job.id,
+            'instrument': str(job.instrument_id),
+            'experiment': str(job.ipts_id) if job.ipts_id is not None else '',
+            'task': job.task,
+            'run_list': job.run_list,
+            'status': job.status,
+            'is_active': job.is_active(),
+            'number_of_runs': job.number_of_runs,
+            'submitted': job.submitted,
+            'failed': job.failed,
+            'report': job.report,
+            'created_on': df.format(settings.DATETIME_FORMAT),
+           }
+
+_worker = None
+_worker_lock = threading.Lock()
+_wakeup = threading.Event()
+
+def start_worker():
+    """
+        Start the worker thread of this process, or wake it up
+        if it is already running
+    """
+    global _worker
+    with _worker_lock:
+        _wakeup.set()
+        if _worker is None:
+            _worker = threading.Thread(target=_worker_loop, name='processing_jobs')
+            _worker.daemon = True
+            _worker.start()
+
+def _worker_loop():
+    """
+        Run the pending jobs, and exit when no new job was submitted
+    """
+    global _worker
+    try:
+        while True:
+            _wakeup.clear()
+            try:
+                run_pending_jobs()
+            except:
+                logging.error("Processing job worker: %s", sys.exc_value)
+            with _worker_lock:
+                if not _wakeup.is_set():
+                    _worker = None
+                    return
+    finally:
+        connection.close()
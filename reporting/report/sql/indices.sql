@@ -14,4 +14,13 @@ CREATE INDEX report_runstatus_time_id
   ON report_runstatus
   USING btree
   (id , created_on );
-  
\ No newline at end of file
+
+
+-- Index: report_runstatus_message_id
+-- Used by the workflow manager to detect redelivered messages
+-- DROP INDEX report_runstatus_message_id;
+
+CREATE INDEX report_runstatus_message_id
+  ON report_runstatus
+  USING btree
+  (message_id );
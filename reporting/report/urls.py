@@ -8,6 +8,7 @@ from . import views
 urlpatterns = [
     url(r'^$',                                                      views.summary,                      name='summary'),
     url(r'^processing$',                                            views.processing_admin,             name='processing_admin'),
+    url(r'^processing/jobs/(?P<job_id>\d+)/$',                      views.processing_job_status,        name='processing_job_status'),
     url(r'^(?P<instrument>[\w]+)/$',                                views.instrument_summary,           name='instrument_summary'),
     url(r'^(?P<instrument>[\w]+)/update/$',                         views.get_instrument_update,        name='get_instrument_update'),
     url(r'^(?P<instrument>[\w]+)/(?P<run_id>\d+)/$',                views.detail,                       name='detail'),
@@ -132,6 +132,20 @@ def send_processing_request(instrument_id, run_id, user=None, destination=None,
     if destination is None:
         destination = '/queue/POSTPROCESS.DATA_READY'
 
+    data = build_processing_request(instrument_id, run_id, user=user, is_complete=is_complete)
+    reporting_app.view_util.send_activemq_message(destination, data)
+    logging.info("Reduction requested: %s", str(data))
+
+def build_processing_request(instrument_id, run_id, user=None, is_complete=False, run_info=None):
+    """
+        Build the JSON payload of a processing request for a run.
+        Raises a RuntimeError if the data file can't be found.
+        @param instrument_id: Instrument object
+        @param run_id: DataRun object
+        @param user: user making the request
+        @param is_complete: if True, the run is flagged as complete
+        @param run_info: catalog information for the run, looked up if needed and not provided
+    """
     # IPTS name
     try:
         ipts = run_id.ipts_id.expt_name.upper()
@@ -142,15 +156,15 @@ def send_processing_request(instrument_id, run_id, user=None, destination=None,
     # If not, look up the online catalog
     file_path = run_id.file
     if len(file_path) == 0:
-        from report.catalog import get_run_info
-
-        run_info = get_run_info(str(instrument_id), '', run_id.run_number)
-        for _file in run_info['data_files']:
+        if run_info is None:
+            from report.catalog import get_run_info
+            run_info = get_run_info(str(instrument_id), '', run_id.run_number)
+        for _file in run_info.get('data_files', []):
             if _file.endswith('_event.nxs') or _file.endswith('.nxs.h5'):
                 file_path = _file
         # If we don't have the IPTS, fill it in too
         if len(ipts) == 0:
-            ipts = run_info['proposal']
+            ipts = run_info.get('proposal', '')
 
     # Get facility from file path
     toks = file_path.split('/')
@@ -160,7 +174,7 @@ def send_processing_request(instrument_id, run_id, user=None, destination=None,
     if len(toks) > 1:
         facility_name = toks[1].upper()
     # Sanity check
-    if len(file_path) == 0 or len(ipts) == 0 or ipts is None:
+    if len(file_path) == 0 or ipts is None or len(ipts) == 0:
         logging.error("No catalog information for run %s: message not sent", run_id)
         raise RuntimeError("Run %s not found in catalog" % str(run_id))
     # Build up dictionary
@@ -175,9 +189,7 @@ def send_processing_request(instrument_id, run_id, user=None, destination=None,
     if user is not None:
         data_dict['information'] = "Requested by %s" % user
 
-    data = json.dumps(data_dict)
-    reporting_app.view_util.send_activemq_message(destination, data)
-    logging.info("Reduction requested: %s", str(data))
+    return json.dumps(data_dict)
 
 def processing_request(request, instrument, run_id, destination):
     """
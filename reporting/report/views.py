@@ -20,10 +20,11 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 
 from dasmon.models import ActiveInstrument
-from report.models import DataRun, IPTS, Instrument, Error, RunStatus
+from report.models import DataRun, IPTS, Instrument, Error, RunStatus, ProcessingJob
 from report.catalog import get_run_info
 from report.forms import ProcessingForm
 from . import view_util
+from . import processing_jobs
 import users.view_util
 import dasmon.view_util
 import reporting_app.view_util
@@ -56,23 +57,15 @@ def processing_admin(request):
             output = processing_form.process()
             template_values['notes'] = output['report']
 
-            # Submit task and append success outcome to notes.
+            # Create a background job for the runs and report its progress
             if 'runs' in output and 'instrument' in output \
                 and 'task' in output and output['task'] is not None:
-                submission_errors = ""
-                for run_obj in output['runs']:
-                    try:
-                        is_complete = output.get('is_complete', False)
-                        view_util.send_processing_request(output['instrument'], run_obj,
-                                                          user=request.user, destination=output['task'],
-                                                          is_complete=is_complete)
-                    except:
-                        submission_errors += "%s run %s could not be submitted: %s<br>" % \
-                            (str(run_obj.instrument_id), str(run_obj.run_number), sys.exc_value)
-                        logging.error(sys.exc_value)
-                template_values['notes'] += submission_errors
-                if len(submission_errors) == 0:
-                    template_values['notes'] += "<b>All tasks were submitted</b><br>"
+                job = processing_jobs.create_job(output['instrument'], output.get('ipts', None),
+                                                 [run_obj.run_number for run_obj in output['runs']],
+                                                 output['task'], user=request.user,
+                                                 create_as_needed=processing_form.cleaned_data['create_as_needed'],
+                                                 is_complete=output.get('is_complete', False))
+                template_values['notes'] += "<b>Job %d was created for %d runs</b><br>" % (job.id, job.number_of_runs)
     else:
         # Get instrument
         if 'instrument' in request.GET:
@@ -87,10 +80,24 @@ def processing_admin(request):
 
     template_values['form'] = processing_form
     template_values['experiment_list'] = ipts
+    template_values['jobs'] = [processing_jobs.job_summary(job) for job in
+                               ProcessingJob.objects.select_related('instrument_id', 'ipts_id').order_by('-id')[:10]]
 
     return render(request, 'report/processing_admin.html', template_values)
 
 
+@login_required
+def processing_job_status(request, job_id):
+    """
+        Ajax call to get the progress of a processing job
+        @param job_id: ProcessingJob ID
+    """
+    job = get_object_or_404(ProcessingJob, id=job_id)
+    response = HttpResponse(json.dumps(processing_jobs.job_summary(job)), content_type="application/json")
+    response['Connection'] = 'close'
+    return response
+
+
 @users.view_util.login_or_local_required
 def summary(request):
     """
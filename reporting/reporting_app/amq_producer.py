@@ -0,0 +1,273 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Process-wide ActiveMQ producer for the web application.
+
+    A single connection to the brokers is shared by all the requests
+    served by a process, instead of connecting for every message.
+    The connection is opened on the first message and re-opened when
+    it is found to be closed. If the connection turns out to be closed
+    when sending, the message is sent again once on a new connection,
+    which may go to another broker. Other errors are raised: the message
+    may have reached the broker, and it isn't sent twice.
+
+    Receipts are only sent back on the connection the message was sent on.
+    When a batch is confirmed, a SendError lists the messages that could
+    not be sent or were not confirmed, so that only those are reported
+    as failed.
+
+    Usage:
+        from reporting_app.amq_producer import get_producer
+        get_producer().send('/queue/REDUCTION.REQUEST', data)
+        # Send several messages, waiting for the broker to confirm them
+        get_producer().send_batch([(destination, data), ...], confirm=True)
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import uuid
+import random
+import logging
+import threading
+import stomp
+from stomp.exception import NotConnectedException
+
+# Time to wait for the broker to confirm a batch of messages [secs]
+RECEIPT_TIMEOUT = 30.0
+
+
+class SendError(RuntimeError):
+    """
+        Raised when some messages of a batch could not be sent or confirmed
+    """
+    def __init__(self, failed, total):
+        """
+            @param failed: list of the indices of the messages that failed
+            @param total: number of messages in the batch
+        """
+        super(SendError, self).__init__("%d of %d messages could not be sent or were not confirmed by the broker" % (len(failed), total))
+        self.failed = failed
+
+
+class _ReceiptListener(stomp.ConnectionListener):
+    """
+        Collects the receipts sent by the broker on a connection
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._receipts = set()
+        ## Receipt IDs of the messages still waited for
+        self._expected = set()
+        self._connected = True
+
+    def expect(self, receipt_id):
+        """
+            Register a receipt ID before sending the message that asks for it
+            @param receipt_id: receipt ID
+        """
+        with self._condition:
+            self._expected.add(receipt_id)
+
+    def on_receipt(self, headers, body):
+        with self._condition:
+            receipt_id = headers.get('receipt-id')
+            # Drop receipts that nobody is waiting for anymore
+            if receipt_id in self._expected:
+                self._receipts.add(receipt_id)
+                self._condition.notify_all()
+
+    def on_disconnected(self):
+        # The receipts not received yet will never come
+        with self._condition:
+            self._connected = False
+            self._condition.notify_all()
+
+    def wait_for(self, receipt_ids, timeout):
+        """
+            Wait for a set of receipts. Returns the set of receipts not received.
+            @param receipt_ids: set of receipt IDs
+            @param timeout: maximum time to wait [secs]
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            missing = receipt_ids - self._receipts
+            while len(missing) > 0 and self._connected and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+                missing = receipt_ids - self._receipts
+            # Receipts arriving after this point are dropped
+            self._expected -= receipt_ids
+            self._receipts -= receipt_ids
+        return missing
+
+
+class Producer(object):
+    """
+        Shared connection used to send messages to the brokers
+    """
+    def __init__(self, brokers, user, passcode, timeout=10.0):
+        """
+            @param brokers: list of (host, port) of the brokers
+            @param user: AMQ user
+            @param passcode: AMQ passcode
+            @param timeout: connection timeout [secs]
+        """
+        self._brokers = list(brokers)
+        self._user = user
+        self._passcode = passcode
+        self._timeout = timeout
+        self._connection = None
+        ## Receipts of the current connection
+        self._receipts = None
+        self._lock = threading.RLock()
+        ## Usage counters
+        self.connections = 0
+        self.messages = 0
+
+    def _connect(self):
+        """
+            Open a connection to one of the brokers
+        """
+        # Shuffle the brokers so that we make sure we never get stuck
+        # regardless of configuration and network problem.
+        brokers = list(self._brokers)
+        random.shuffle(brokers)
+        receipts = _ReceiptListener()
+        if stomp.__version__[0]<4:
+            conn = stomp.Connection(host_and_ports=brokers,
+                                    user=self._user,
+                                    passcode=self._passcode,
+                                    wait_on_receipt=True,
+                                    timeout=self._timeout)
+            conn.set_listener('receipts', receipts)
+            conn.start()
+            conn.connect()
+        else:
+            conn = stomp.Connection(host_and_ports=brokers, keepalive=True)
+            conn.set_listener('receipts', receipts)
+            conn.start()
+            conn.connect(self._user, self._passcode, wait=True)
+        self._connection = conn
+        self._receipts = receipts
+        self.connections += 1
+
+    def _get_connection(self):
+        """
+            Return the open connection, connecting if needed
+        """
+        if self._connection is None or not self._connection.is_connected():
+            self.close()
+            self._connect()
+        return self._connection
+
+    def _send(self, destination, data, persistent, headers):
+        """
+            Send a message on the current connection.
+            Returns the receipt listener of that connection.
+        """
+        conn = self._get_connection()
+        receipts = self._receipts
+        if 'receipt' in headers:
+            receipts.expect(headers['receipt'])
+        if stomp.__version__[0]<4:
+            conn.send(destination=destination, message=data,
+                      persistent=persistent, headers=headers)
+        else:
+            conn.send(destination, data, persistent=persistent, headers=headers)
+        self.messages += 1
+        return receipts
+
+    def _deliver(self, destination, data, persistent, headers):
+        """
+            Send a message, on a new connection if the current one
+            turns out to be closed. Returns the receipt listener of
+            the connection the message was sent on.
+        """
+        with self._lock:
+            try:
+                return self._send(destination, data, persistent, headers)
+            except NotConnectedException:
+                # Nothing was sent
+                logging.warning("AMQ connection closed, reconnecting: %s", sys.exc_value)
+                self.close()
+                return self._send(destination, data, persistent, headers)
+            except:
+                # The message may have reached the broker: don't send it twice
+                self.close()
+                raise
+
+    def send(self, destination, data, persistent='true', headers=None):
+        """
+            Send a message. If the connection turns out to be closed,
+            the message is sent again on a new connection.
+            @param destination: queue to send the message to
+            @param data: message content
+            @param persistent: 'true' if the message should be persisted by the broker
+            @param headers: additional message headers
+        """
+        if headers is None:
+            headers = {}
+        self._deliver(destination, data, persistent, headers)
+
+    def send_batch(self, messages, persistent='true', confirm=False, timeout=RECEIPT_TIMEOUT):
+        """
+            Send a list of messages on the shared connection.
+            If confirm is True, wait for the broker to confirm that it received
+            each message. A SendError listing the messages that could not be
+            sent, or were not confirmed, is raised if there are any.
+            @param messages: list of (destination, data) tuples
+            @param persistent: 'true' if the messages should be persisted by the broker
+            @param confirm: if True, wait for a receipt for each message
+            @param timeout: maximum time to wait for the receipts [secs]
+        """
+        failed = []
+        # Index of the message of each receipt ID, for each connection
+        receipt_ids = {}
+        with self._lock:
+            for i, (destination, data) in enumerate(messages):
+                headers = {}
+                if confirm:
+                    receipt_id = str(uuid.uuid4())
+                    headers['receipt'] = receipt_id
+                try:
+                    receipts = self._deliver(destination, data, persistent, headers)
+                except:
+                    logging.error("AMQ send to %s failed: %s", destination, sys.exc_value)
+                    failed.append(i)
+                    continue
+                if confirm:
+                    receipt_ids.setdefault(receipts, {})[receipt_id] = i
+        if confirm:
+            deadline = time.time() + timeout
+            for receipts, indices in receipt_ids.items():
+                missing = receipts.wait_for(set(indices.keys()), max(0, deadline - time.time()))
+                failed.extend([indices[receipt_id] for receipt_id in missing])
+        if len(failed) > 0:
+            raise SendError(sorted(failed), len(messages))
+
+    def close(self):
+        """
+            Close the connection
+        """
+        with self._lock:
+            if self._connection is not None:
+                try:
+                    if self._connection.is_connected():
+                        self._connection.disconnect()
+                except:
+                    logging.warning("AMQ disconnection failed: %s", sys.exc_value)
+            self._connection = None
+
+
+_producer = None
+_producer_lock = threading.Lock()
+
+def get_producer():
+    """
+        Return the process-wide producer, created from the workflow manager settings
+    """
+    global _producer
+    with _producer_lock:
+        if _producer is None:
+            from workflow.settings import brokers, icat_user, icat_passcode
+            _producer = Producer(brokers, icat_user, icat_passcode)
+        return _producer
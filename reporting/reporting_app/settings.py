@@ -238,6 +238,12 @@ MONITOR_ON = True
 
 HEARTBEAT_TIMEOUT = 15
 
+## Snapshot of the latest DASMON values published by the DASMON listener.
+## Set to None to always read the values from the DB.
+DASMON_SNAPSHOT_FILE = '/var/tmp/dasmon_snapshot'
+## Snapshots older than this are ignored and the DB is used instead [seconds]
+DASMON_SNAPSHOT_MAX_AGE = 10
+
 ## Prefix for status parameter names for monitored sub-systems
 SYSTEM_STATUS_PREFIX = 'system_'
 
@@ -261,6 +267,17 @@ LIVE_DATA_SERVER_PORT = "443"
 # Link out to fitting application
 FITTING_URLS = {}
 
+# Bulk processing jobs: number of runs looked up and sent together
+PROCESSING_JOB_CHUNK_SIZE = 100
+# Maximum number of processing requests sent per second (0 for no limit)
+PROCESSING_JOB_RATE = 50
+# If True, jobs are run by a thread of the web process. Set to False
+# when the processjobs management command is used instead.
+PROCESSING_JOB_THREAD = True
+# Time after which a running job that made no progress is considered
+# abandoned by its worker, and is put back in the queue [secs]
+PROCESSING_JOB_STALE_TIME = 600
+
 # Import local settings if available
 try:
     from local_settings import *
@@ -10,31 +10,25 @@ import logging
 def send_activemq_message(destination, data):
     """
         Send an AMQ message to the workflow manager.
+        The connection to the brokers is shared by all the
+        requests served by this process.
 
         @param destination: queue to send the request to
         @param data: JSON data payload for the message
     """
-    from workflow.settings import brokers, icat_user, icat_passcode
-    import stomp
-    if stomp.__version__[0]<4:
-        # Shuffle the brokers so that we make sure we never get stuck
-        # regardless of configuration and network problem.
-        import random
-        random.shuffle(brokers)
-        conn = stomp.Connection(host_and_ports=brokers,
-                                user=icat_user,
-                                passcode=icat_passcode,
-                                wait_on_receipt=True,
-                                timeout=10.0)
-        conn.start()
-        conn.connect()
-        conn.send(destination=destination, message=data, persistent='true')
-    else:
-        conn = stomp.Connection(host_and_ports=brokers)
-        conn.start()
-        conn.connect(icat_user, icat_passcode, wait=True)
-        conn.send(destination, data, persistent='true')
-    conn.disconnect()
+    from reporting_app.amq_producer import get_producer
+    get_producer().send(destination, data, persistent='true')
+
+def send_activemq_messages(messages, confirm=False):
+    """
+        Send a list of AMQ messages to the workflow manager
+        on the shared connection.
+
+        @param messages: list of (destination, data) tuples
+        @param confirm: if True, wait for the broker to confirm each message
+    """
+    from reporting_app.amq_producer import get_producer
+    get_producer().send_batch(messages, persistent='true', confirm=confirm)
 
 def reduction_setup_url(instrument):
     """
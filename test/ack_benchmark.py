@@ -0,0 +1,255 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes
+"""
+    Benchmark of the acknowledgement modes of the workflow manager,
+    against a local stand-in for the STOMP broker.
+
+    The stand-in serves a fixed number of messages on a single queue,
+    never sending more unacknowledged messages than the prefetch size of
+    the subscription, and counts the ACK frames it receives. The consumer
+    acknowledges messages through the same AckBatcher as the workflow
+    manager, so the results only reflect the cost of acknowledgements
+    and of the prefetch window.
+
+    Examples:
+        python ack_benchmark.py
+        python ack_benchmark.py -n 20000 -w 0.0005
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import stomp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow'))
+from acks import AckBatcher
+
+# Escape sequences of the STOMP 1.1 header values
+HEADER_ESCAPES = {'\\c': ':', '\\n': '\n', '\\r': '\r', '\\\\': '\\'}
+
+
+def _unescape(value):
+    """
+        Decode the escape sequences of a STOMP 1.1 header value
+        @param value: header value as received
+    """
+    if '\\' not in value:
+        return value
+    decoded = ''
+    i = 0
+    while i < len(value):
+        if value[i:i + 2] in HEADER_ESCAPES:
+            decoded += HEADER_ESCAPES[value[i:i + 2]]
+            i += 2
+        else:
+            decoded += value[i]
+            i += 1
+    return decoded
+
+
+class StompStandIn(threading.Thread):
+    """
+        Minimal single-client STOMP server serving messages from memory
+    """
+    def __init__(self, number_of_messages):
+        """
+            @param number_of_messages: number of messages to serve
+        """
+        super(StompStandIn, self).__init__(name='stomp_stand_in')
+        self.daemon = True
+        self._number_of_messages = number_of_messages
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('localhost', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self._socket = None
+        self._send_lock = threading.Lock()
+        self._window = threading.Condition()
+        self._unacked = []
+        self._prefetch = 1000
+        self._ack_mode = 'auto'
+        ## Counters
+        self.ack_frames = 0
+        self.acked = 0
+        self.done = threading.Event()
+
+    def _send_frame(self, command, headers, body=''):
+        frame = command + '\n'
+        for key, value in headers.items():
+            frame += '%s:%s\n' % (key, value)
+        frame += '\n' + body + '\x00'
+        with self._send_lock:
+            self._socket.sendall(frame)
+
+    def _frames(self):
+        """
+            Generator returning the (command, headers) of the received frames
+        """
+        buf = ''
+        while True:
+            data = self._socket.recv(65536)
+            if not data:
+                return
+            buf += data
+            while '\x00' in buf:
+                frame, buf = buf.split('\x00', 1)
+                frame = frame.lstrip('\r\n')
+                header_block = frame.split('\n\n', 1)[0]
+                lines = header_block.split('\n')
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[_unescape(key)] = _unescape(value)
+                yield lines[0], headers
+
+    def _dispatch(self, destination, subscription):
+        """
+            Send the messages, respecting the prefetch window
+        """
+        for i in range(self._number_of_messages):
+            message_id = 'ID:stand-in-%d' % i
+            with self._window:
+                while self._ack_mode != 'auto' and len(self._unacked) >= self._prefetch:
+                    self._window.wait(1.0)
+                if self._ack_mode != 'auto':
+                    self._unacked.append(message_id)
+            self._send_frame('MESSAGE', {'destination': destination,
+                                         'subscription': subscription,
+                                         'message-id': message_id,
+                                         'content-length': '2'}, '{}')
+        if self._ack_mode == 'auto':
+            self.acked = self._number_of_messages
+            self.done.set()
+
+    def _ack(self, message_id):
+        with self._window:
+            if message_id not in self._unacked:
+                return
+            if self._ack_mode == 'client':
+                # Cumulative: everything delivered up to this message
+                index = self._unacked.index(message_id) + 1
+            else:
+                index = None
+            if index is None:
+                self._unacked.remove(message_id)
+                self.acked += 1
+            else:
+                del self._unacked[:index]
+                self.acked += index
+            self._window.notify_all()
+        if self.acked >= self._number_of_messages:
+            self.done.set()
+
+    def run(self):
+        self._socket, _ = self._server.accept()
+        for command, headers in self._frames():
+            if command in ['CONNECT', 'STOMP']:
+                version = '1.1' if '1.1' in headers.get('accept-version', '') else '1.0'
+                self._send_frame('CONNECTED', {'version': version, 'heart-beat': '0,0'})
+            elif command == 'SUBSCRIBE':
+                self._ack_mode = headers.get('ack', 'auto')
+                self._prefetch = int(headers.get('activemq.prefetchSize', 1000))
+                dispatcher = threading.Thread(target=self._dispatch,
+                                              args=(headers['destination'], headers.get('id', '0')))
+                dispatcher.daemon = True
+                dispatcher.start()
+            elif command == 'ACK':
+                self.ack_frames += 1
+                self._ack(headers.get('message-id', headers.get('id')))
+            elif command == 'DISCONNECT':
+                if 'receipt' in headers:
+                    self._send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+                break
+        self._socket.close()
+        self._server.close()
+
+
+class BenchmarkListener(stomp.ConnectionListener):
+    """
+        Consumer acknowledging messages through an AckBatcher
+    """
+    def __init__(self, batcher, work_time):
+        self._batcher = batcher
+        self._work_time = work_time
+
+    def on_message(self, headers, message):
+        if self._batcher is not None:
+            self._batcher.received(headers)
+        if self._work_time > 0:
+            time.sleep(self._work_time)
+        if self._batcher is not None:
+            self._batcher.completed(headers)
+
+
+def run_case(number_of_messages, ack_mode, prefetch, batch_size, interval, work_time, timeout=30.0):
+    """
+        Consume the messages with a given configuration.
+        Returns the elapsed time and the number of ACK frames.
+        Raises RuntimeError if no message is acknowledged for longer than the timeout.
+    """
+    server = StompStandIn(number_of_messages)
+    server.start()
+    conn = stomp.Connection(host_and_ports=[('localhost', server.port)])
+
+    def send_ack(message_id, subscription):
+        if stomp.__version__[0] < 4:
+            conn.ack({'message-id': message_id, 'subscription': subscription})
+        else:
+            conn.ack(message_id, subscription)
+
+    batcher = None
+    if ack_mode != 'auto':
+        batcher = AckBatcher(send_ack, mode=ack_mode, batch_size=batch_size, interval=interval)
+    conn.set_listener('benchmark', BenchmarkListener(batcher, work_time))
+    conn.start()
+    conn.connect(wait=True)
+    t0 = time.time()
+    conn.subscribe(destination='/queue/BENCHMARK', id=1, ack=ack_mode,
+                   headers={'activemq.prefetchSize': str(prefetch)})
+    acked = 0
+    last_progress = t0
+    while not server.done.wait(0.01):
+        if batcher is not None:
+            batcher.flush_if_needed()
+        if server.acked > acked:
+            acked = server.acked
+            last_progress = time.time()
+        elif time.time() - last_progress > timeout:
+            conn.disconnect()
+            raise RuntimeError("stalled after %d of %d messages" % (acked, number_of_messages))
+    elapsed = time.time() - t0
+    conn.disconnect()
+    return elapsed, server.ack_frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the AMQ acknowledgement modes')
+    parser.add_argument('-n', metavar='messages', type=int, default=5000, help='number of messages', dest='messages')
+    parser.add_argument('-w', metavar='work time', type=float, default=0.0,
+                        help='processing time per message [secs]', dest='work_time')
+    parser.add_argument('-i', metavar='interval', type=int, default=100,
+                        help='maximum time before a batch of acks is sent [ms]', dest='interval')
+    parser.add_argument('-t', metavar='timeout', type=float, default=30.0,
+                        help='time without progress after which a case fails [secs]', dest='timeout')
+    namespace = parser.parse_args()
+
+    cases = [('auto', 1000, 1),
+             ('client', 1, 1),
+             ('client', 1000, 1),
+             ('client', 1000, 10),
+             ('client', 1000, 100),
+             ('client-individual', 1000, 1),
+             ('client-individual', 1000, 100)]
+    print "%-18s %8s %6s %10s %10s" % ('mode', 'prefetch', 'batch', 'msg/sec', 'ack frames')
+    for mode, prefetch, batch_size in cases:
+        try:
+            elapsed, frames = run_case(namespace.messages, mode, prefetch, batch_size,
+                                       namespace.interval, namespace.work_time, namespace.timeout)
+        except RuntimeError:
+            print "%-18s %8d %6d failed: %s" % (mode, prefetch, batch_size, sys.exc_value)
+            continue
+        print "%-18s %8d %6d %10.0f %10d" % (mode, prefetch, batch_size,
+                                             namespace.messages / elapsed, frames)
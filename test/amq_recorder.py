@@ -0,0 +1,136 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Record AMQ traffic to a file, to be replayed offline with amq_replay.py.
+
+    Each message is appended to the file as a record made of:
+      - a fixed-size header: arrival time [epoch secs, double],
+        length of the JSON-encoded headers, length of the body,
+      - the JSON-encoded message headers,
+      - the message body.
+
+    Note that subscribing to a queue consumes its messages. Record
+    topics, or queues on a test broker.
+
+    Example:
+        python amq_recorder.py -o dasmon.rec /topic/ADARA.APP.DASMON.0 /topic/ADARA.STATUS.DASMON.0
+"""
+import sys
+import time
+import json
+import struct
+import argparse
+import threading
+import stomp
+
+## Record header: arrival time, length of the headers, length of the body
+RECORD_HEADER = struct.Struct('!dII')
+
+
+def write_message(fd, headers, message, arrival_time):
+    """
+        Append a message to a recording
+        @param fd: file object opened in append mode
+        @param headers: message headers
+        @param message: message body
+        @param arrival_time: time the message was received [epoch secs]
+    """
+    headers_str = json.dumps(headers)
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    fd.write(RECORD_HEADER.pack(arrival_time, len(headers_str), len(message)))
+    fd.write(headers_str)
+    fd.write(message)
+
+def read_messages(file_path):
+    """
+        Generator returning the (headers, message, arrival time) tuples of a recording.
+        A truncated last record, for instance if the recorder was killed, is ignored.
+        @param file_path: path of the recording
+    """
+    with open(file_path, 'rb') as fd:
+        while True:
+            header = fd.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            arrival_time, headers_length, message_length = RECORD_HEADER.unpack(header)
+            headers_str = fd.read(headers_length)
+            message = fd.read(message_length)
+            if len(headers_str) < headers_length or len(message) < message_length:
+                return
+            yield json.loads(headers_str), message, arrival_time
+
+
+class Recorder(stomp.ConnectionListener):
+    """
+        AMQ listener appending every message to a file
+    """
+    def __init__(self, file_path):
+        """
+            @param file_path: path of the recording
+        """
+        self._fd = open(file_path, 'ab')
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def on_message(self, headers, message):
+        """
+            Append a message to the recording
+            @param headers: message headers
+            @param message: message body
+        """
+        with self._lock:
+            write_message(self._fd, headers, message, time.time())
+            self._fd.flush()
+            self.count += 1
+
+    def close(self):
+        """
+            Close the recording
+        """
+        with self._lock:
+            self._fd.close()
+
+
+def run():
+    """
+        Record messages until interrupted
+    """
+    parser = argparse.ArgumentParser(description='Record AMQ messages to a file')
+    parser.add_argument('-o', metavar='file', required=True, help='recording file', dest='output')
+    parser.add_argument('-b', metavar='host:port', default='localhost:61613', help='broker', dest='broker')
+    parser.add_argument('-u', metavar='user', default='', help='AMQ user', dest='user')
+    parser.add_argument('-p', metavar='passcode', default='', help='AMQ passcode', dest='passcode')
+    parser.add_argument('destinations', nargs='+', help='topics or queues to record')
+    namespace = parser.parse_args()
+
+    host, port = namespace.broker.split(':')
+    recorder = Recorder(namespace.output)
+    if stomp.__version__[0] < 4:
+        conn = stomp.Connection(host_and_ports=[(host, int(port))],
+                                user=namespace.user,
+                                passcode=namespace.passcode,
+                                wait_on_receipt=True)
+        conn.set_listener('amq_recorder', recorder)
+        conn.start()
+        conn.connect()
+    else:
+        conn = stomp.Connection(host_and_ports=[(host, int(port))], keepalive=True)
+        conn.set_listener('amq_recorder', recorder)
+        conn.start()
+        conn.connect(namespace.user, namespace.passcode, wait=True)
+    for i, destination in enumerate(namespace.destinations):
+        conn.subscribe(destination=destination, id=i, ack='auto')
+
+    try:
+        while True:
+            time.sleep(5.0)
+            print "Recorded %d messages" % recorder.count
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    conn.disconnect()
+    recorder.close()
+    print "Recorded %d messages to %s" % (recorder.count, namespace.output)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,163 @@
+#pylint: disable=bare-except, invalid-name, too-many-locals
+"""
+    Replay AMQ traffic recorded with amq_recorder.py into the DASMON listener
+    or the workflow manager listener, without a broker, to measure the
+    performance of the ingestion path.
+
+    The messages are processed on the calling thread against the database
+    configured for the target process. Point the settings to a local
+    scratch database: the replay writes to it.
+    Messages sent by the workflow manager are counted and discarded.
+
+    Examples:
+        # Replay at twice the recorded speed
+        python amq_replay.py -s 2 dasmon dasmon.rec
+        # Replay as fast as possible
+        python amq_replay.py -s 0 workflow workflow.rec
+"""
+import os
+import sys
+import time
+import argparse
+from amq_recorder import read_messages
+
+TOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class NullConnection(object):
+    """
+        Stand-in for the AMQ connection used by the workflow manager
+        to send messages and acknowledgements
+    """
+    def __init__(self):
+        self.sent = 0
+
+    def is_connected(self):
+        return True
+
+    def send(self, *args, **kwargs):
+        self.sent += 1
+
+    def ack(self, *args, **kwargs):
+        pass
+
+
+def dasmon_target():
+    """
+        Return the message handler, final flush and metrics registry for the DASMON listener
+    """
+    sys.path.insert(0, TOP_DIR)
+    sys.path.insert(0, os.path.join(TOP_DIR, 'dasmon_listener'))
+    import amq_consumer
+    from workflow import metrics
+    listener = amq_consumer.Listener(number_of_threads=0)
+    def handler(headers, message):
+        listener.on_message(headers, message)
+        amq_consumer.status_buffer.flush_if_needed()
+        amq_consumer.status_cache.flush_if_needed()
+        amq_consumer.pv_buffer.flush_if_needed()
+        amq_consumer.record_committed()
+    def finish():
+        amq_consumer.status_buffer.flush()
+        amq_consumer.status_cache.flush()
+        amq_consumer.pv_buffer.flush()
+        amq_consumer.record_committed()
+    return handler, finish, metrics.registry, 'dasmon_listener'
+
+def workflow_target():
+    """
+        Return the message handler, final flush and metrics registry for the workflow manager
+    """
+    sys.path.insert(0, TOP_DIR)
+    sys.path.insert(0, os.path.join(TOP_DIR, 'workflow'))
+    from amq_listener import Listener
+    import metrics
+    listener = Listener(use_db_tasks=True, auto_ack=True)
+    connection = NullConnection()
+    listener.set_connection(connection)
+    def finish():
+        print "Messages sent by the workflow manager: %d" % connection.sent
+    return listener.on_message, finish, metrics.registry, 'workflowmgr'
+
+def percentile(values, fraction):
+    """
+        Return a percentile of a sorted list of values
+        @param values: sorted list
+        @param fraction: percentile, between 0 and 1
+    """
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def replay(handler, file_path, speed=1.0, limit=None):
+    """
+        Replay a recording. Returns the list of per-message processing times
+        and the total duration.
+        @param handler: function processing a message
+        @param file_path: path of the recording
+        @param speed: replay speed relative to the recording. Zero means as fast as possible.
+        @param limit: maximum number of messages to replay
+    """
+    latencies = []
+    first_arrival = None
+    t_start = time.time()
+    for headers, message, arrival_time in read_messages(file_path):
+        if limit is not None and len(latencies) >= limit:
+            break
+        if first_arrival is None:
+            first_arrival = arrival_time
+        if speed > 0:
+            delay = t_start + (arrival_time - first_arrival) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        # Stamp the message as if the broker had just received it
+        headers['timestamp'] = str(int(time.time() * 1000))
+        t0 = time.time()
+        try:
+            handler(headers, message)
+        except:
+            print "Failed to process message: %s" % sys.exc_value
+        latencies.append(time.time() - t0)
+    return latencies, time.time() - t_start
+
+def run():
+    """
+        Replay a recording and report throughput and latency
+    """
+    parser = argparse.ArgumentParser(description='Replay recorded AMQ messages into a listener')
+    parser.add_argument('-s', metavar='speed', type=float, default=1.0,
+                        help='speed factor relative to the recording; 0 for as fast as possible',
+                        dest='speed')
+    parser.add_argument('-n', metavar='count', type=int, default=None,
+                        help='maximum number of messages to replay', dest='limit')
+    parser.add_argument('target', choices=['dasmon', 'workflow'], help='listener to replay into')
+    parser.add_argument('recording', help='file written by amq_recorder.py')
+    namespace = parser.parse_args()
+
+    if namespace.target == 'dasmon':
+        handler, finish, registry, process = dasmon_target()
+    else:
+        handler, finish, registry, process = workflow_target()
+
+    latencies, duration = replay(handler, namespace.recording, namespace.speed, namespace.limit)
+    t0 = time.time()
+    finish()
+    flush_time = time.time() - t0
+
+    latencies.sort()
+    count = len(latencies)
+    print "Messages:          %d" % count
+    print "Duration:          %.3f sec (final flush: %.3f sec)" % (duration, flush_time)
+    if count > 0:
+        print "Throughput:        %.1f msg/sec" % (count / max(duration + flush_time, 1e-6))
+        print "Latency p50:       %.3f ms" % (1000.0 * percentile(latencies, 0.5))
+        print "Latency p99:       %.3f ms" % (1000.0 * percentile(latencies, 0.99))
+    queries = registry.get_histogram('db_queries_per_message', {'process': process})
+    if queries is not None and queries.count > 0:
+        print "Queries/message:   %.2f" % (queries.sum / queries.count)
+    query_time = registry.get_histogram('db_query_seconds_per_message', {'process': process})
+    if query_time is not None and query_time.count > 0:
+        print "DB time/message:   %.3f ms" % (1000.0 * query_time.sum / query_time.count)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,81 @@
+"""
+    Compare the throughput of the single-value "pvUpdate" stored procedure
+    with the batch version called through pvmon.batch.
+
+    This writes to the PV tables: run it against a test database.
+    The benchmark PVs are removed at the end.
+
+    Example:
+        python pv_batch_benchmark.py -n 10000 -p 200
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reporting'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reporting_app.settings")
+import django
+if django.VERSION[1] >= 7:
+    django.setup()
+from django.db import connection, transaction
+from pvmon.models import PVName, PV, PVCache
+from pvmon.batch import update_numeric_pvs
+
+PREFIX = 'BENCHMARK:PV'
+
+def make_values(number_of_values, number_of_pvs, instrument):
+    """
+        Create a list of (instrument, name, value, status, update_time)
+    """
+    now = int(time.time())
+    return [(instrument, '%s%d' % (PREFIX, i % number_of_pvs), float(i), 0, now + i // number_of_pvs)
+            for i in range(number_of_values)]
+
+def single(values):
+    """
+        Store values one at a time
+    """
+    cursor = connection.cursor()
+    for item in values:
+        with transaction.atomic():
+            cursor.execute('SELECT "pvUpdate"(%s, %s, %s, %s, %s)', list(item))
+
+def batch(values, batch_size):
+    """
+        Store values in batches
+    """
+    for i in range(0, len(values), batch_size):
+        update_numeric_pvs(values[i:i + batch_size], batch_size=batch_size)
+
+def clean_up():
+    """
+        Remove the benchmark entries
+    """
+    names = PVName.objects.filter(name__startswith=PREFIX)
+    PV.objects.filter(name__in=names).delete()
+    PVCache.objects.filter(name__in=names).delete()
+    names.delete()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PV insertion benchmark')
+    parser.add_argument('-n', metavar='values', type=int, default=5000, help='number of values', dest='values')
+    parser.add_argument('-p', metavar='pvs', type=int, default=100, help='number of distinct PVs', dest='pvs')
+    parser.add_argument('-b', metavar='batch size', type=int, default=500, help='batch size', dest='batch_size')
+    parser.add_argument('-i', metavar='instrument', default='test', help='instrument name', dest='instrument')
+    namespace = parser.parse_args()
+
+    values = make_values(namespace.values, namespace.pvs, namespace.instrument)
+    try:
+        t0 = time.time()
+        single(values)
+        single_time = time.time() - t0
+        print "Single:  %d values in %.2f sec: %.0f values/sec" % (len(values), single_time, len(values) / single_time)
+
+        t0 = time.time()
+        batch(values, namespace.batch_size)
+        batch_time = time.time() - t0
+        print "Batch:   %d values in %.2f sec: %.0f values/sec" % (len(values), batch_time, len(values) / batch_time)
+        print "Speedup: %.1f" % (single_time / batch_time)
+    finally:
+        clean_up()
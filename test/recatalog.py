@@ -1,29 +1,78 @@
+#pylint: disable=invalid-name
+"""
+    Send a range of runs to be cataloged or processed again.
+
+    This creates a processing job, as the processing admin page does,
+    and runs it in this process: the runs are looked up in the DB with
+    one query per chunk, and sent over a single AMQ connection.
+    See reporting/report/processing_jobs.py for details.
+    Use --background to only create the jobs, to be run by the processjobs
+    management command.
+
+    Examples:
+        python recatalog.py -b HYS -i 10717 -r 42578
+        python recatalog.py -b CNCS -i 9358 -r 77294-77344 --reduction_catalog
+        python recatalog.py -b SEQ -r 48860-48872 --find
+"""
 import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reporting'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reporting_app.settings")
+import django
+if django.VERSION[1] >= 7:
+    django.setup()
+from report.models import Instrument, IPTS
+from report.forms import validate_integer_list
+from report import processing_jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send a range of runs to the workflow manager')
+    parser.add_argument('-b', metavar='instrument', help='instrument name', required=True, dest='instrument')
+    parser.add_argument('-i', metavar='ipts', help='experiment name or IPTS number', dest='ipts')
+    parser.add_argument('-r', metavar='runs', help='run list, e.g. 4,6-8', required=True, dest='runs')
+    parser.add_argument('-q', metavar='queue', action='append', dest='queues',
+                        help='ActiveMQ queue name [default: CATALOG.DATA_READY]')
+    parser.add_argument('--reduction_catalog', help='also catalog the reduced data',
+                        action='store_true', dest='do_reduction_catalog')
+    parser.add_argument('--create', help='create the runs that are not in the DB',
+                        action='store_true', dest='create_as_needed')
+    parser.add_argument('--find', help='find the runs in the online catalog and create them',
+                        action='store_true', dest='find')
+    parser.add_argument('--rate', metavar='rate', type=float, dest='rate',
+                        help='maximum number of messages per second')
+    parser.add_argument('--background', help='only create the jobs, to be run by the processjobs command',
+                        action='store_true', dest='background')
+    namespace = parser.parse_args()
+
+    instrument_id = Instrument.objects.get(name=namespace.instrument.lower())
+    ipts_id = None
+    if not namespace.find:
+        if namespace.ipts is None:
+            parser.error("an experiment is needed unless --find is used")
+        expt_name = namespace.ipts.upper()
+        if not expt_name.startswith('IPTS-'):
+            expt_name = 'IPTS-%s' % expt_name
+        ipts_id = IPTS.objects.get(instruments=instrument_id, expt_name=expt_name)
 
-def find_runs(instrument, ipts, run_min, run_max, legacy=False):
-    base_path = "/SNS/%s/IPTS-%s/nexus/" % (instrument.upper(), ipts)
-    for r in range(run_min, run_max):
-        filepath = "%s/%s_%s.nxs.h5" % (base_path, instrument.upper(), r)
-        legacypath = "/SNS/%s/IPTS-%s/0/%s/NeXus/%s_%r_event.nxs" % (instrument.upper(), ipts, r, instrument.upper(), r)
-        if not legacy:
-            os.system("python simple_producer.py -b %s -i %s -r %s -d %s --catalog" % (instrument.upper(), ipts, r, filepath))
-            os.system("python simple_producer.py -b %s -i %s -r %s -d %s --reduction_catalog" % (instrument.upper(), ipts, r, filepath))
-        else:
-            os.system("python simple_producer.py -b %s -i %s -r %s -d %s --catalog" % (instrument.upper(), ipts, r, legacypath))
-            #os.system("python simple_producer.py -b %s -i %s -r %s -d %s --reduction_catalog" % (instrument.upper(), ipts, r, legacypath))
-
-#find_runs('HYS', 10717, 42578, 42579)    
-#find_runs('ARCS', 10094, 48147, 48156, legacy=True)
-#find_runs('BSS', 10679, 35275, 35290, legacy=True)
-#find_runs('CNCS', 9358, 77294, 77345, legacy=True)
-#find_runs('EQSANS', 11094, 31807, 31822, legacy=True)
-#find_runs('NOM', 10724, 25452, 25481, legacy=True)
-#find_runs('PG3', 2767, 18104, 18107, legacy=True)
-#find_runs('REF_L', 10328, 110610, 110638, legacy=True)
-#find_runs('REF_M', 10719, 16034, 16038, legacy=True)
-#find_runs('SEQ', 7561, 48860, 48873)
-#find_runs('SNAP', 10254, 15229, 15234, legacy=True)
-#find_runs('TOPAZ', 9949, 9408, 9409, legacy=True)
-#find_runs('VIS', 11944, 3572, 3576)
-find_runs('VULCAN', 10076, 45783, 45784, legacy=True)
+    queues = namespace.queues if namespace.queues is not None else ['CATALOG.DATA_READY']
+    if namespace.do_reduction_catalog:
+        queues.append('REDUCTION_CATALOG.DATA_READY')
 
+    run_numbers = validate_integer_list(namespace.runs)
+    for queue in queues:
+        job = processing_jobs.create_job(instrument_id, ipts_id, run_numbers, queue,
+                                         user='recatalog.py',
+                                         create_as_needed=namespace.create_as_needed or namespace.find,
+                                         is_complete=namespace.find, start=False)
+        if namespace.background:
+            print "Created job %d: %d runs for %s" % (job.id, job.number_of_runs, queue)
+            continue
+        if processing_jobs.claim_job(job):
+            processing_jobs.run_job(job, rate=namespace.rate)
+        print "Job %d [%s]: %d of %d runs submitted to %s" % (job.id, job.status, job.submitted,
+                                                              job.number_of_runs, queue)
+        if job.failed > 0:
+            print job.report.replace('<br>', '\n').replace('<b>', '').replace('</b>', '')
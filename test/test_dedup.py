@@ -0,0 +1,72 @@
+"""
+    Tests of the detection of redelivered messages.
+
+    Run with:
+        python test/test_dedup.py
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow'))
+from dedup import Deduplicator
+
+
+class DeduplicatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processed = set()
+        self.dedup = Deduplicator(capacity=3, window=3600,
+                                  lookup=lambda message_id, window: message_id in self.processed)
+
+    def test_duplicate_in_progress(self):
+        headers = {'message-id': 'ID:1'}
+        redelivered = {'message-id': 'ID:1', 'redelivered': 'true'}
+        self.assertFalse(self.dedup.is_duplicate(headers))
+        self.assertTrue(self.dedup.is_duplicate(redelivered))
+        # The duplicate is acknowledged with the first copy
+        self.assertTrue(self.dedup.hold(redelivered))
+        self.assertEqual(self.dedup.completed(headers), [redelivered])
+        self.assertEqual(self.dedup.completed(headers), [])
+        # Once the first copy is completed, duplicates are acknowledged right away
+        self.assertTrue(self.dedup.is_duplicate(redelivered))
+        self.assertFalse(self.dedup.hold(redelivered))
+
+    def test_redelivered_after_restart(self):
+        # The message was processed before a restart: it is only found by the lookup
+        self.processed.add('ID:2')
+        redelivered = {'message-id': 'ID:2', 'redelivered': 'true'}
+        self.assertTrue(self.dedup.is_duplicate(redelivered))
+        self.assertFalse(self.dedup.hold(redelivered))
+        self.assertEqual(self.dedup.lookups, 1)
+
+    def test_redelivered_not_processed(self):
+        redelivered = {'message-id': 'ID:3', 'redelivered': 'true'}
+        self.assertFalse(self.dedup.is_duplicate(redelivered))
+        self.assertEqual(self.dedup.completed(redelivered), [])
+
+    def test_forget(self):
+        headers = {'message-id': 'ID:4'}
+        self.assertFalse(self.dedup.is_duplicate(headers))
+        self.assertTrue(self.dedup.hold(headers))
+        # A rolled back message is processed again, and its duplicates are dropped
+        self.dedup.forget(headers)
+        self.assertFalse(self.dedup.is_duplicate(headers))
+        self.assertEqual(self.dedup.completed(headers), [])
+
+    def test_without_hold(self):
+        dedup = Deduplicator(capacity=3, hold_duplicates=False)
+        for i in range(10):
+            self.assertFalse(dedup.is_duplicate({'message-id': 'ID:%d' % i}))
+        self.assertTrue(dedup.is_duplicate({'message-id': 'ID:9'}))
+        self.assertFalse(dedup.hold({'message-id': 'ID:9'}))
+        self.assertEqual(len(dedup._in_flight), 0)
+
+    def test_capacity(self):
+        for i in range(10):
+            self.dedup.is_duplicate({'message-id': 'ID:%d' % i})
+        self.assertEqual(len(self.dedup), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+    Test of the DASMON listener email notifier, using a local SMTP server.
+
+    Run with:
+        python test/test_notifier.py
+"""
+import os
+import sys
+import time
+import smtpd
+import asyncore
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dasmon_listener.notifier import Notifier
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """
+        SMTP server keeping received messages in memory
+    """
+    def __init__(self, *args, **kwargs):
+        smtpd.SMTPServer.__init__(self, *args, **kwargs)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+class NotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalSMTPServer(('localhost', 0), None)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.thread.join(2.0)
+
+    def _wait_for(self, count, timeout=5.0):
+        t0 = time.time()
+        while len(self.server.messages) < count and time.time() - t0 < timeout:
+            time.sleep(0.05)
+
+    def test_connection_reuse(self):
+        """
+            Several emails should go through a single SMTP connection
+        """
+        notifier = Notifier(port=self.port, rate_limit=1000)
+        for i in range(5):
+            notifier.send('a@example.com', ['b@example.com'], 'Test %d' % i, 'content')
+        self._wait_for(5)
+        notifier.stop()
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(notifier.stats()['sent'], 5)
+
+    def test_digest(self):
+        """
+            Repeated alerts with the same key should be merged into a digest
+        """
+        notifier = Notifier(port=self.port, digest_window=0.5, rate_limit=1000)
+        for i in range(4):
+            notifier.send('a@example.com', ['b@example.com'], 'Alert', 'alert %d' % i, digest_key='SIG')
+        notifier.send('a@example.com', ['b@example.com'], 'Other', 'other', digest_key='OTHER')
+        self._wait_for(3)
+        notifier.stop()
+        # First alert, other alert, and one digest for the three repeated alerts
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(notifier.stats()['merged'], 3)
+        self.assertTrue('[digest of 3]' in self.server.messages[2][2])
+
+    def test_rate_limit(self):
+        """
+            Emails beyond the rate limit should be delayed
+        """
+        notifier = Notifier(port=self.port, rate_limit=60)
+        notifier._tokens = 1.0
+        t0 = time.time()
+        for i in range(3):
+            notifier.send('a@example.com', ['b@example.com'], 'Test %d' % i, 'content')
+        self._wait_for(3)
+        notifier.stop()
+        self.assertEqual(len(self.server.messages), 3)
+        # One email per second after the first one
+        self.assertTrue(time.time() - t0 >= 1.5)
+
+    def test_no_recipient(self):
+        """
+            Emails without a sender or recipient are ignored
+        """
+        notifier = Notifier(port=self.port)
+        notifier.send('', ['b@example.com'], 'Test', 'content')
+        notifier.send('a@example.com', [], 'Test', 'content')
+        self.assertEqual(notifier.stats()['queued'], 0)
+        self.assertTrue(notifier.ident is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+"""
+    Tests of the scheduling of the messages sent to the worker queues.
+    The held messages are stored in memory instead of the DB.
+    The tests of the DB tasks need the workflow's Django settings.
+
+    Run with:
+        python test/test_scheduler.py
+"""
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow'))
+from scheduler import Scheduler
+
+LIVE = 'POSTPROCESS.DATA_READY'
+BACKLOG = 'REDUCTION.REQUEST'
+
+
+class MemoryStore(object):
+    """
+        Stand-in for the ScheduledMessage table
+    """
+    def __init__(self):
+        self.entries = {}
+        ## Entries of a transaction that is not committed yet
+        self.uncommitted = set()
+        self._next_id = 1
+
+    def save_scheduled_message(self, queue, is_live, instrument, run_number, message):
+        self.entries[self._next_id] = (queue, is_live, instrument, run_number, message)
+        self._next_id += 1
+        return self._next_id - 1
+
+    def delete_scheduled_message(self, entry_id):
+        self.entries.pop(entry_id, None)
+
+    def load_scheduled_messages(self, queue, is_live, instrument, exclude_ids, count):
+        entries = [(entry_id, e[3], unicode(e[4])) for entry_id, e in sorted(self.entries.items())
+                   if e[:3] == (queue, is_live, instrument) and entry_id not in exclude_ids
+                   and entry_id not in self.uncommitted]
+        return entries[:count]
+
+    def count_scheduled_messages(self):
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry[:3]] = counts.get(entry[:3], 0) + 1
+        return [key + (count,) for key, count in counts.items()]
+
+
+def message(instrument, run_number):
+    return json.dumps({'instrument': instrument, 'run_number': run_number})
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.store = MemoryStore()
+
+    def _send(self, destination, data):
+        data = json.loads(data)
+        self.sent.append((destination, data['instrument'], data['run_number']))
+
+    def _scheduler(self, max_outstanding=2, queue_size=100):
+        return Scheduler(self._send, ['REDUCTION.DATA_READY'], max_outstanding=max_outstanding,
+                         live_queues=[LIVE], queue_size=queue_size, store=self.store)
+
+    def _complete(self, scheduler, instrument, run_number):
+        scheduler.status_received('/queue/REDUCTION.COMPLETE', message(instrument, run_number))
+
+    def test_unscheduled_queue(self):
+        scheduler = self._scheduler()
+        self.assertFalse(scheduler.handles('/queue/CATALOG.DATA_READY'))
+        self.assertTrue(scheduler.handles('/queue/REDUCTION.DATA_READY'))
+
+    def test_outstanding_cap(self):
+        scheduler = self._scheduler(max_outstanding=2)
+        for run in range(5):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(scheduler.waiting(), 3)
+        # A STARTED message doesn't free a slot
+        scheduler.status_received('/queue/REDUCTION.STARTED', message('seq', 0))
+        self.assertEqual(len(self.sent), 2)
+        self._complete(scheduler, 'seq', 0)
+        self.assertEqual(len(self.sent), 3)
+        scheduler.status_received('/queue/REDUCTION.ERROR', message('seq', 1))
+        self.assertEqual([s[2] for s in self.sent], [0, 1, 2, 3])
+        self.assertEqual(scheduler.outstanding(), 2)
+        # Sent messages are removed from the DB
+        self.assertEqual(len(self.store.entries), 1)
+
+    def test_not_needed(self):
+        scheduler = self._scheduler(max_outstanding=1)
+        for run in range(3):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        self.assertEqual(len(self.sent), 1)
+        # Workers reply NOT_NEEDED or DISABLED when reduction is off for the instrument
+        scheduler.status_received('/queue/REDUCTION.NOT_NEEDED', message('seq', 0))
+        self.assertEqual([s[2] for s in self.sent], [0, 1])
+        scheduler.status_received('/queue/REDUCTION.DISABLED', message('seq', 1))
+        self.assertEqual([s[2] for s in self.sent], [0, 1, 2])
+        self.assertEqual(scheduler.outstanding(), 1)
+        self.assertEqual(scheduler.waiting(), 0)
+
+    def test_live_priority(self):
+        scheduler = self._scheduler(max_outstanding=1)
+        for run in range(3):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message('arcs', 100), source=LIVE)
+        self._complete(scheduler, 'seq', 0)
+        self.assertEqual(self.sent[-1], ('/queue/REDUCTION.DATA_READY', 'arcs', 100))
+
+    def test_fair_share(self):
+        scheduler = self._scheduler(max_outstanding=2)
+        for run in range(10):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        for run in range(3):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('cncs', run), source=BACKLOG)
+        # SEQ holds both slots: the next free slot goes to CNCS
+        self._complete(scheduler, 'seq', 0)
+        self.assertEqual(self.sent[-1][1], 'cncs')
+        self._complete(scheduler, 'seq', 1)
+        self.assertEqual(self.sent[-1][1], 'seq')
+        # Both have one outstanding job: SEQ gets the slot it frees
+        self._complete(scheduler, 'seq', 2)
+        self.assertEqual(self.sent[-1][1], 'seq')
+        self._complete(scheduler, 'cncs', 0)
+        self.assertEqual(self.sent[-1][1], 'cncs')
+
+    def test_spill_to_store(self):
+        scheduler = self._scheduler(max_outstanding=1, queue_size=4)
+        for run in range(20):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        self.assertEqual(scheduler.waiting(), 19)
+        for run in range(19):
+            self._complete(scheduler, 'seq', run)
+        # Every message is sent once, in order
+        self.assertEqual([s[2] for s in self.sent], range(20))
+        self.assertEqual(scheduler.waiting(), 0)
+
+    def test_uncommitted_spill(self):
+        scheduler = self._scheduler(max_outstanding=1, queue_size=2)
+        for run in range(5):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        # The last two messages are only in the DB, and not visible yet
+        self.store.uncommitted = set([4, 5])
+        self._complete(scheduler, 'seq', 0)
+        self._complete(scheduler, 'seq', 1)
+        self.assertEqual(scheduler.waiting(), 2)
+        self._complete(scheduler, 'seq', 2)
+        self.assertEqual(scheduler.outstanding(), 0)
+        # They are read back once committed
+        self.store.uncommitted = set()
+        scheduler.poll()
+        self.assertEqual([s[2] for s in self.sent], [0, 1, 2, 3])
+        self.assertEqual(scheduler.waiting(), 1)
+
+    def test_restart(self):
+        scheduler = self._scheduler(max_outstanding=1)
+        for run in range(3):
+            scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', run), source=BACKLOG)
+        self.sent = []
+        scheduler = self._scheduler(max_outstanding=1)
+        scheduler.load()
+        self._complete(scheduler, 'seq', 1)
+        self.assertEqual([s[2] for s in self.sent], [1, 2])
+        self.assertEqual(len(self.store.entries), 0)
+
+    def test_send_failure(self):
+        scheduler = self._scheduler(max_outstanding=1)
+        def _fail(destination, data):
+            raise RuntimeError("No connection")
+        scheduler._send = _fail
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', 1), source=LIVE)
+        self.assertEqual(scheduler.outstanding(), 0)
+        self.assertEqual(scheduler.waiting(), 1)
+        scheduler._send = self._send
+        scheduler.poll()
+        self.assertEqual(len(self.sent), 1)
+
+    def test_timeout(self):
+        scheduler = Scheduler(self._send, ['REDUCTION.DATA_READY'], max_outstanding=1,
+                              job_timeout=-1, store=self.store)
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', 1))
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', 2))
+        self.assertEqual(len(self.sent), 1)
+        scheduler.poll()
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(scheduler.timed_out, 1)
+
+    def test_db_task(self):
+        # Messages sent by the action class of a DB task are scheduled as well
+        from states import StateAction
+        from routing import Route
+        class ForwardAction(StateAction):
+            def __call__(self, headers, message):
+                self.send('/queue/REDUCTION.DATA_READY', message)
+        route = Route(None, [])
+        route.task_class = 'ForwardAction'
+        route.action_cls = ForwardAction
+        scheduler = self._scheduler(max_outstanding=1)
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', 1), source=BACKLOG)
+        action = StateAction(scheduler=scheduler, source=LIVE)
+        action._call_db_task(route, {'destination': '/queue/%s' % LIVE}, message('arcs', 2))
+        self.assertEqual(len(self.sent), 1)
+        # The message is held as a live run
+        self.assertEqual(len(self.store.entries), 1)
+        self.assertEqual(self.store.entries.values()[0][:3], ('REDUCTION.DATA_READY', True, 'arcs'))
+
+    def test_recovery(self):
+        # Recovery messages are held like reprocessing requests
+        from workflow_process import WorkflowProcess
+        scheduler = self._scheduler(max_outstanding=1)
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message('seq', 1), source=BACKLOG)
+        process = WorkflowProcess(scheduler=scheduler)
+        process.send('/queue/REDUCTION.DATA_READY', message('arcs', 2))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self.store.entries), 1)
+        self.assertEqual(self.store.entries.values()[0][:3], ('REDUCTION.DATA_READY', False, 'arcs'))
+
+
+if __name__ == '__main__':
+    unittest.main()
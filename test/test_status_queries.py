@@ -0,0 +1,235 @@
+"""
+    Query budget of the workflow manager status transactions.
+    Each type of status message must be stored with a fixed number of
+    queries once the lookup caches are warm. A change that adds queries
+    to transactions.add_status_entry will make this test fail.
+    The messages processed in a group commit, and the messages they
+    send, must be stored with a single commit. Entries cached while a
+    transaction is open must not be seen by other threads.
+
+    A test database is created with the credentials of
+    workflow.database.settings, and destroyed at the end.
+
+    Run with:
+        python test/test_status_queries.py
+"""
+import os
+import sys
+import json
+import unittest
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "workflow.database.settings")
+from workflow.database import transactions
+from workflow.database.transactions import DataRun, RunStatus, WorkflowSummary, Instrument
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+
+# Maximum number of queries for each type of message
+BUDGET_NEW_RUN = 10
+BUDGET_KNOWN_RUN = 4
+BUDGET_WITH_ERROR = 5
+BUDGET_COMPLETE = 4
+
+
+class StatusQueryBudgetTest(TestCase):
+
+    def setUp(self):
+        transactions.reset_caches()
+        self.message_count = 0
+
+    def tearDown(self):
+        # The test transaction is rolled back: drop what we cached
+        transactions.reset_caches()
+
+    def send(self, queue, run_number=1234, **kwargs):
+        """
+            Store a status message and return the list of queries it needed,
+            leaving out the savepoints of the test transaction
+            @param queue: name of the status queue
+            @param run_number: run number
+        """
+        self.message_count += 1
+        data = {"instrument": "eqsans", "ipts": "IPTS-1234",
+                "run_number": run_number, "data_file": "/SNS/EQSANS/IPTS-1234/nexus/run.nxs.h5"}
+        data.update(kwargs)
+        headers = {'destination': '/queue/%s' % queue,
+                   'message-id': 'ID:test-%d' % self.message_count}
+        with CaptureQueriesContext(connection) as context:
+            transactions.add_status_entry(headers, json.dumps(data))
+        return [q['sql'] for q in context.captured_queries if 'SAVEPOINT' not in q['sql']]
+
+    def warm_up(self):
+        """
+            Populate the lookup caches with the queues, instrument and IPTS used
+        """
+        for queue in ['POSTPROCESS.DATA_READY', 'CATALOG.STARTED', 'CATALOG.COMPLETE',
+                      'REDUCTION.STARTED', 'REDUCTION.COMPLETE', 'POSTPROCESS.ERROR']:
+            self.send(queue, run_number=1)
+
+    def assert_budget(self, queries, budget):
+        self.assertTrue(len(queries) <= budget,
+                        "%d queries used, budget is %d:\n%s" % (len(queries), budget, '\n'.join(queries)))
+
+    def test_new_run(self):
+        self.warm_up()
+        queries = self.send('POSTPROCESS.DATA_READY')
+        self.assert_budget(queries, BUDGET_NEW_RUN)
+        self.assertEqual(DataRun.objects.filter(run_number=1234).count(), 1)
+
+    def test_known_run(self):
+        self.warm_up()
+        self.send('POSTPROCESS.DATA_READY')
+        for queue in ['CATALOG.STARTED', 'CATALOG.COMPLETE', 'REDUCTION.STARTED']:
+            self.assert_budget(self.send(queue), BUDGET_KNOWN_RUN)
+        summary = WorkflowSummary.objects.get(run_id__run_number=1234)
+        self.assertTrue(summary.catalog_started)
+        self.assertTrue(summary.cataloged)
+        self.assertTrue(summary.reduction_started)
+        self.assertFalse(summary.reduced)
+
+    def test_error(self):
+        self.warm_up()
+        self.send('POSTPROCESS.DATA_READY')
+        queries = self.send('POSTPROCESS.ERROR', error='Something went wrong')
+        self.assert_budget(queries, BUDGET_WITH_ERROR)
+        error = RunStatus.objects.get_last_error(DataRun.objects.get(run_number=1234))
+        self.assertEqual(error.description, 'Something went wrong')
+
+    def test_complete(self):
+        self.warm_up()
+        self.send('POSTPROCESS.DATA_READY')
+        queries = self.send('REDUCTION.COMPLETE', is_complete=True)
+        self.assert_budget(queries, BUDGET_COMPLETE)
+        self.assertTrue(WorkflowSummary.objects.get(run_id__run_number=1234).complete)
+
+    def test_incremental_matches_full_update(self):
+        self.warm_up()
+        self.send('POSTPROCESS.DATA_READY')
+        for queue in ['CATALOG.STARTED', 'CATALOG.COMPLETE', 'REDUCTION.NOT_NEEDED']:
+            self.send(queue)
+        summary = WorkflowSummary.objects.get(run_id__run_number=1234)
+        incremental = summary._flags()
+        summary.update()
+        self.assertEqual(summary._flags(), incremental)
+        self.assertTrue(summary.complete)
+
+
+class AMQConnection(object):
+    """
+        Stand-in for the connection used to publish messages
+    """
+    def __init__(self):
+        self.sent = []
+
+    def send(self, destination, message, **kwargs):
+        self.sent.append(destination)
+
+
+class CommitCounter(object):
+    """
+        Count the transactions committed on a DB connection: the
+        atomic blocks, and the statements executed in autocommit mode
+    """
+    def __init__(self, db_connection):
+        self._connection = db_connection
+        self.commits = 0
+
+    def __enter__(self):
+        commit = self._connection.commit
+        cursor = self._connection.cursor
+        counter = self
+        def _commit():
+            counter.commits += 1
+            commit()
+        class _Cursor(object):
+            def __init__(self, wrapped):
+                self._wrapped = wrapped
+            def __getattr__(self, name):
+                return getattr(self._wrapped, name)
+            def execute(self, *args, **kwargs):
+                if not counter._connection.in_atomic_block:
+                    counter.commits += 1
+                return self._wrapped.execute(*args, **kwargs)
+            def executemany(self, *args, **kwargs):
+                if not counter._connection.in_atomic_block:
+                    counter.commits += 1
+                return self._wrapped.executemany(*args, **kwargs)
+        self._connection.commit = _commit
+        self._connection.cursor = lambda: _Cursor(cursor())
+        return self
+
+    def __exit__(self, *args):
+        del self._connection.commit
+        del self._connection.cursor
+
+
+class GroupCommitCountTest(TransactionTestCase):
+
+    def setUp(self):
+        from database import transactions as workflow_transactions
+        self._transactions = workflow_transactions
+        self._transactions.reset_caches()
+
+    def tearDown(self):
+        self._transactions.reset_caches()
+
+    def test_one_commit_per_group(self):
+        from group_commit import GroupCommitter
+        from states import StateAction
+        amq = AMQConnection()
+        acked = []
+        committer = GroupCommitter(lambda h, m: StateAction(connection=amq)(h, m),
+                                   acked.append, window=1000, batch_size=2)
+        items = []
+        for run_number in [1, 2]:
+            data = {"instrument": "eqsans", "ipts": "IPTS-1234", "run_number": run_number,
+                    "data_file": "/SNS/EQSANS/IPTS-1234/nexus/run.nxs.h5"}
+            items.append(({'destination': '/queue/POSTPROCESS.DATA_READY',
+                           'message-id': 'ID:test-%d' % run_number}, json.dumps(data)))
+        committer.submit(*items[1])
+        with CommitCounter(connection) as counter:
+            committer._process_batch(items[0])
+        self.assertEqual(counter.commits, 1)
+        self.assertEqual(len(acked), 2)
+        # Each message is stored with the two messages it sent
+        self.assertEqual(len(amq.sent), 4)
+        self.assertEqual(RunStatus.objects.count(), 6)
+
+
+class UncommittedLookupTest(TransactionTestCase):
+
+    def test_uncommitted_lookup(self):
+        from database.registry import get_table
+        table = get_table(Instrument)
+        found = []
+        def _lookup():
+            found.append(table._lookup('newinstrument'))
+            connection.close()
+        with transaction.atomic():
+            table.get_or_create('newinstrument')
+            thread = threading.Thread(target=_lookup)
+            thread.start()
+            thread.join()
+        self.assertEqual(found, [None])
+        # Once committed, the entry is shared
+        table.refresh()
+        thread = threading.Thread(target=_lookup)
+        thread.start()
+        thread.join()
+        self.assertEqual(found[1].name, 'newinstrument')
+
+
+if __name__ == '__main__':
+    runner = DiscoverRunner(verbosity=1)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+    try:
+        unittest.main(exit=False)
+    finally:
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
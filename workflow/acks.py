@@ -0,0 +1,139 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes
+"""
+    Batching of the AMQ acknowledgements sent by the workflow manager.
+
+    With client acknowledgements, sending one ACK frame per message costs
+    a network round of its own. The AckBatcher collects the messages that
+    are done, meaning their DB transaction is committed, and acknowledges
+    them every batch_size messages or every interval milliseconds.
+
+    Two acknowledgement modes are supported:
+      - "client": an ACK covers the message and all the messages received
+        before it on the same subscription. A single frame is sent for the
+        longest run of completed messages, in the order they were received.
+        A message that isn't done yet holds back the acknowledgement of the
+        messages received after it, so that out-of-order completion by
+        worker threads never acknowledges a message still in progress.
+      - "client-individual": an ACK covers a single message. Each completed
+        message gets its own frame, but frames are still sent in batches.
+
+    Messages that were received but not acknowledged when the connection
+    drops are delivered again by the broker.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import collections
+
+
+class AckBatcher(object):
+    """
+        Collects completed messages and acknowledges them in batches
+    """
+    def __init__(self, send_ack, mode='client', batch_size=1, interval=0):
+        """
+            @param send_ack: function sending an ACK frame, taking a message ID and a subscription ID
+            @param mode: "client" or "client-individual"
+            @param batch_size: number of completed messages triggering an acknowledgement
+            @param interval: maximum time a completed message waits for its acknowledgement [ms]
+        """
+        self._send_ack = send_ack
+        self._cumulative = mode == 'client'
+        self._batch_size = max(1, batch_size)
+        self._interval = interval / 1000.0
+        self._lock = threading.Lock()
+        ## Message IDs in the order they were received, for each subscription
+        self._received = {}
+        ## Message IDs that are done but not yet acknowledged
+        self._completed = set()
+        ## Time at which the oldest unacknowledged completion happened
+        self._oldest_completion = None
+        ## Usage counters
+        self.acked_messages = 0
+        self.ack_frames = 0
+
+    def received(self, headers):
+        """
+            Record the arrival of a message. Must be called in the order
+            the messages are received, before they are processed.
+            @param headers: message headers
+        """
+        with self._lock:
+            subscription = headers.get('subscription')
+            if subscription not in self._received:
+                self._received[subscription] = collections.deque()
+            self._received[subscription].append(headers['message-id'])
+
+    def completed(self, headers):
+        """
+            Record that a message is done and can be acknowledged
+            @param headers: message headers
+        """
+        with self._lock:
+            self._completed.add(headers['message-id'])
+            if self._oldest_completion is None:
+                self._oldest_completion = time.time()
+        if len(self._completed) >= self._batch_size:
+            self.flush()
+
+    def flush_if_needed(self):
+        """
+            Acknowledge the completed messages if the oldest one has waited long enough
+        """
+        oldest = self._oldest_completion
+        if oldest is not None and time.time() - oldest >= self._interval:
+            self.flush()
+
+    def pending(self):
+        """
+            Return the number of messages received but not acknowledged
+        """
+        return sum([len(ids) for ids in self._received.values()])
+
+    def flush(self):
+        """
+            Acknowledge the completed messages
+        """
+        acks = []
+        with self._lock:
+            for subscription, message_ids in self._received.items():
+                if self._cumulative:
+                    # Acknowledge the longest run of completed messages
+                    last_id = None
+                    while len(message_ids) > 0 and message_ids[0] in self._completed:
+                        last_id = message_ids.popleft()
+                        self._completed.discard(last_id)
+                        self.acked_messages += 1
+                    if last_id is not None:
+                        acks.append((last_id, subscription))
+                else:
+                    remaining = collections.deque()
+                    for message_id in message_ids:
+                        if message_id in self._completed:
+                            self._completed.discard(message_id)
+                            self.acked_messages += 1
+                            acks.append((message_id, subscription))
+                        else:
+                            remaining.append(message_id)
+                    self._received[subscription] = remaining
+            # In client mode, completed messages may be waiting for earlier ones
+            self._oldest_completion = time.time() if len(self._completed) > 0 else None
+        for message_id, subscription in acks:
+            try:
+                self._send_ack(message_id, subscription)
+                self.ack_frames += 1
+            except:
+                logging.error("Failed to acknowledge message %s: %s", message_id, sys.exc_value)
+
+    def reset(self):
+        """
+            Forget the messages received on a connection that was lost.
+            The broker will deliver them again.
+        """
+        with self._lock:
+            self._received = {}
+            self._completed = set()
+            self._oldest_completion = None
@@ -32,7 +32,13 @@ class Client(object):
                  workflow_recovery=False,
                  flexible_tasks=False,
                  consumer_name="amq_consumer",
-                 auto_ack=True):
+                 auto_ack=True,
+                 worker_threads=0,
+                 max_in_flight=1000,
+                 ack_mode=None,
+                 prefetch_size=None,
+                 ack_batch_size=1,
+                 ack_interval=0):
         """
             @param brokers: list of brokers we can connect to
             @param user: activemq user
@@ -44,9 +50,27 @@ class Client(object):
             @param flexible_tasks: if True, the workflow tasks will be defined by the DB
             @param consumer_name: name of the AMQ listener
             @param auto_ack: if True, AMQ ack will be auotomatic
+            @param worker_threads: number of threads processing messages, or zero to process them on the receiver thread
+            @param max_in_flight: maximum number of messages received but not yet processed by the worker threads
+            @param ack_mode: "auto", "client" or "client-individual". If None, it is set according to auto_ack.
+            @param prefetch_size: maximum number of unacknowledged messages the broker sends to the client
+            @param ack_batch_size: number of processed messages triggering an acknowledgement
+            @param ack_interval: maximum time a processed message waits for its acknowledgement [ms]
         """
         # Connection parameters
-        self._auto_ack = auto_ack
+        if ack_mode is None:
+            if auto_ack:
+                ack_mode = 'auto'
+            elif worker_threads > 1:
+                # Workers finish messages out of order: an ack must only cover its own message
+                ack_mode = 'client-individual'
+            else:
+                ack_mode = 'client'
+        self._ack_mode = ack_mode
+        self._auto_ack = ack_mode == 'auto'
+        self._prefetch_size = prefetch_size
+        self._ack_batch_size = ack_batch_size
+        self._ack_interval = ack_interval
         self._brokers = brokers
         self._user = user
         self._passcode = passcode
@@ -62,6 +86,11 @@ class Client(object):
         self._workflow_check = workflow_check
         self._workflow_recovery = workflow_recovery
         self._flexible_tasks = flexible_tasks
+        ## Number of worker threads processing messages
+        self._worker_threads = worker_threads
+        self._max_in_flight = max_in_flight
+        ## Workflow check in progress, if any
+        self._workflow_process = None
 
         ## Listener used for dealing with incoming messages
         self._listener = None
@@ -71,6 +100,8 @@ class Client(object):
         startup_msg += "  User: %s\n" % self._user
         startup_msg += "  DB task definition allowed? %s\n" % str(self._flexible_tasks)
         startup_msg += "  Workflow check enabled? %s\n" % str(self._workflow_check)
+        startup_msg += "  Worker threads: %s\n" % str(self._worker_threads)
+        startup_msg += "  Ack mode: %s\n" % self._ack_mode
         if self._workflow_check:
             startup_msg += "  Time between checks: %s seconds\n" % str(self._workflow_check_delay)
             startup_msg += "  Recovery enabled?    %s\n" % str(self._workflow_recovery)
@@ -85,6 +116,9 @@ class Client(object):
             @param listener: listener object
         """
         self._listener = listener
+        self._listener.configure_acks(self._ack_mode, self._ack_batch_size, self._ack_interval)
+        if self._worker_threads > 0:
+            self._listener.start_workers(self._worker_threads, self._max_in_flight)
         self._connection = self.new_connection()
         self._listener.set_connection(self._connection)
 
@@ -130,12 +164,16 @@ class Client(object):
             self._disconnect()
             self._connection = self.get_connection()
 
+        # Acknowledgements must be sent on the connection the messages came from
+        if self._listener is not None:
+            self._listener.set_connection(self._connection)
+
         logging.info("[%s] Subscribing to %s", self._consumer_name, str(self._queues))
+        headers = {}
+        if self._prefetch_size is not None:
+            headers['activemq.prefetchSize'] = str(self._prefetch_size)
         for i, q in enumerate(self._queues):
-            if self._auto_ack:
-                self._connection.subscribe(destination=q, id=i, ack='auto')
-            else:
-                self._connection.subscribe(destination=q, id=i, ack='client')
+            self._connection.subscribe(destination=q, id=i, ack=self._ack_mode, headers=headers)
 
     def _disconnect(self):
         """
@@ -152,10 +190,21 @@ class Client(object):
         """
         if self._workflow_check:
             try:
-                WorkflowProcess(connection=self._connection,
-                                recovery=self._workflow_recovery,
-                                allowed_lag=self._workflow_check_delay).verify_workflow()
+                if self._workflow_process is None:
+                    # Recovery messages wait for a worker like reprocessing requests
+                    scheduler = self._listener.get_scheduler() if self._listener is not None else None
+                    self._workflow_process = WorkflowProcess(connection=self._connection,
+                                                             recovery=self._workflow_recovery,
+                                                             allowed_lag=self._workflow_check_delay,
+                                                             scheduler=scheduler)
+                else:
+                    self._workflow_process.set_connection(self._connection)
+                # The check is done in steps so that it doesn't hold up
+                # the listening loop. Keep it until it's complete.
+                if self._workflow_process.verify_workflow():
+                    self._workflow_process = None
             except:
+                self._workflow_process = None
                 logging.error("Workflow verification failed: %s", sys.exc_value)
 
     def listen_and_wait(self, waiting_period=1.0):
@@ -178,6 +227,13 @@ class Client(object):
                     self.connect()
 
                 time.sleep(waiting_period)
+                if self._listener is not None:
+                    self._listener.flush_acks()
+                    self._listener.dispatch_scheduled()
+                    if self._listener.reconnect_requested():
+                        logging.warning("[%s] Reconnecting to get the messages that were not committed", self._consumer_name)
+                        self._disconnect()
+                        continue
 
                 try:
                     if time.time()-last_heartbeat>5:
@@ -196,8 +252,10 @@ class Client(object):
                 except:
                     logging.error("Problem sending heartbeat: %s", sys.exc_value)
 
-                # Check for workflow completion
-                if time.time()-self._workflow_check_start>self._workflow_check_delay:
+                # Check for workflow completion, or continue the check in progress
+                if self._workflow_process is not None:
+                    self.verify_workflow()
+                elif time.time()-self._workflow_check_start>self._workflow_check_delay:
                     self.verify_workflow()
                     self._workflow_check_start = time.time()
             except:
@@ -5,7 +5,16 @@
 import sys
 import stomp
 import logging
+import threading
 import states
+from metrics import registry
+from worker_pool import WorkerPool
+from acks import AckBatcher
+from dedup import Deduplicator
+from scheduler import Scheduler
+from group_commit import on_commit
+from database import transactions
+from settings import DEDUP_CAPACITY, DEDUP_WINDOW
 
 
 class Listener(stomp.ConnectionListener):
@@ -21,14 +30,150 @@ class Listener(stomp.ConnectionListener):
     ## AMQ passcode
     _passcode = None
 
-    def __init__(self, use_db_tasks=False, auto_ack=True):
+    def __init__(self, use_db_tasks=False, auto_ack=True,
+                 group_commit_window=None, group_commit_size=50):
         """
             Initialization
             @param use_db_task: if True, a task definition will be looked for in the DB when executing the action
+            @param auto_ack: if True, AMQ ack will be automatic
+            @param group_commit_window: if not None, messages arriving within this number of milliseconds share a DB transaction
+            @param group_commit_size: maximum number of messages sharing a DB transaction
         """
         ## If True, the DB will be queried for task definition
         self._use_db_tasks = use_db_tasks
         self._auto_ack = auto_ack
+        ## Lock protecting the creation of the send connection by worker threads
+        self._connection_lock = threading.Lock()
+        self._group_commit_window = group_commit_window
+        self._group_commit_size = group_commit_size
+        ## Worker threads, if messages are not processed on the receiver thread
+        self._pool = None
+        ## Batched acknowledgements, if enabled
+        self._acks = None
+        ## Recently received message IDs, to drop redelivered messages
+        self._dedup = Deduplicator(capacity=DEDUP_CAPACITY, window=DEDUP_WINDOW,
+                                   lookup=transactions.message_processed)
+        ## Scheduling of the messages sent to the worker queues, if enabled
+        self._scheduler = None
+        ## Set when messages could not be committed and must be delivered again
+        self._reconnect = False
+        if group_commit_window is not None:
+            self.start_workers(1)
+
+    def start_workers(self, number_of_workers, max_in_flight=1000):
+        """
+            Process messages on a pool of worker threads.
+            Messages for a given run are always processed by the same worker.
+            @param number_of_workers: number of worker threads
+            @param max_in_flight: maximum number of messages received but not yet processed
+        """
+        self.stop()
+        # Workers get the errors, so that the DB entries of a failed message are rolled back
+        self._pool = WorkerPool(self._execute_action, self._ack,
+                                number_of_workers=number_of_workers,
+                                max_in_flight=max_in_flight,
+                                group_commit_window=self._group_commit_window,
+                                group_commit_size=self._group_commit_size,
+                                failed=self._commit_failed)
+
+    def configure_acks(self, mode, batch_size=1, interval=0):
+        """
+            Set the acknowledgement mode of the subscriptions.
+            In "client" and "client-individual" modes, messages are
+            acknowledged in batches once they are processed.
+            @param mode: "auto", "client" or "client-individual"
+            @param batch_size: number of processed messages triggering an acknowledgement
+            @param interval: maximum time a processed message waits for its acknowledgement [ms]
+        """
+        self._auto_ack = mode == 'auto'
+        self._acks = None
+        if not self._auto_ack:
+            self._acks = AckBatcher(self._send_ack, mode=mode,
+                                    batch_size=batch_size, interval=interval)
+
+    def configure_scheduler(self, queues, max_outstanding=20, live_queues=None,
+                            queue_size=100, job_timeout=21600):
+        """
+            Hold the messages sent to worker queues until a worker is available.
+            See scheduler.py for details.
+            @param queues: list of the names of the queues to schedule
+            @param max_outstanding: maximum number of outstanding jobs for each queue
+            @param live_queues: list of the input queues of live runs, which have priority
+            @param queue_size: maximum number of messages kept in memory for each queue, priority and instrument
+            @param job_timeout: time after which an outstanding job is no longer counted [secs]
+        """
+        self._scheduler = None
+        if len(queues) == 0:
+            return
+        scheduler = Scheduler(self._send_scheduled, queues,
+                              max_outstanding=max_outstanding,
+                              live_queues=live_queues,
+                              queue_size=queue_size,
+                              job_timeout=job_timeout)
+        registry.register_gauge('scheduler_waiting', scheduler.waiting, {'process': 'workflowmgr'},
+                                help_text='Number of messages waiting for a worker')
+        registry.register_gauge('scheduler_outstanding', scheduler.outstanding, {'process': 'workflowmgr'},
+                                help_text='Number of jobs sent to the workers and not completed')
+        scheduler.load()
+        self._scheduler = scheduler
+
+    def get_scheduler(self):
+        """
+            Return the Scheduler holding the messages sent to the worker queues, or None
+        """
+        return self._scheduler
+
+    def dispatch_scheduled(self):
+        """
+            Send the scheduled messages for which a worker is available
+        """
+        if self._scheduler is not None:
+            self._scheduler.poll()
+
+    def _send_scheduled(self, destination, message):
+        """
+            Send a message released by the scheduler
+            @param destination: queue to send the message to
+            @param message: message content
+        """
+        action = states.StateAction(connection=self._get_connection())
+        action.send(destination=destination, message=message, persistent='true')
+
+    def flush_acks(self):
+        """
+            Send the acknowledgements that have waited long enough
+        """
+        if self._acks is not None:
+            self._acks.flush_if_needed()
+
+    def _commit_failed(self, headers):
+        """
+            Called by a worker for a message that could not be committed.
+            The broker only delivers an unacknowledged message again after
+            a reconnection. In client mode, it also holds back the
+            acknowledgement of the messages received after it.
+            @param headers: message headers
+        """
+        self._dedup.forget(headers)
+        if not self._auto_ack:
+            self._reconnect = True
+
+    def reconnect_requested(self):
+        """
+            Return True if the connection should be closed so that the
+            messages that could not be committed are delivered again
+        """
+        reconnect = self._reconnect
+        self._reconnect = False
+        return reconnect
+
+    def on_disconnected(self):
+        """
+            Messages not acknowledged before a disconnection
+            will be delivered again by the broker
+        """
+        if self._acks is not None:
+            self._acks.reset()
 
     def set_amq_user(self, brokers, user, passcode):
         """
@@ -51,18 +196,100 @@ class Listener(stomp.ConnectionListener):
             @param message: JSON-encoded message content
         """
         logging.debug("Recv: %s", headers['destination'])
+        if self._acks is not None:
+            self._acks.received(headers)
+        if self._dedup.is_duplicate(headers):
+            logging.info("Dropping duplicate message %s: %s", headers.get('message-id'), headers['destination'])
+            registry.inc('amq_duplicates_total', {'process': 'workflowmgr'},
+                         help_text='Number of redelivered messages that were dropped')
+            # A duplicate of a message still in progress is acknowledged with it
+            if not self._dedup.hold(headers):
+                self._acknowledge(headers)
+            return
+        if self._pool is not None:
+            # The message will be acknowledged once its DB transaction is committed
+            self._pool.submit(headers, message)
+            return
+        self._process_message(headers, message)
+        self._ack(headers)
 
-        # Execute the appropriate action
+    def _process_message(self, headers, message):
+        """
+            Execute the appropriate action for a message, and log errors
+            @param headers: message headers
+            @param message: JSON-encoded message content
+        """
         try:
-            connection = self._get_connection()
-            action = states.StateAction(connection=connection,
-                                        use_db_task=self._use_db_tasks)
-            action(headers, message)
+            self._execute_action(headers, message)
         except:
             logging.error("Listener failed to process message: %s", str(sys.exc_value))
             logging.error("  Message: %s: %s", headers['destination'], str(message))
-        if not self._auto_ack:
-            connection.ack(headers['message-id'], headers['subscription'])
+
+    def _execute_action(self, headers, message):
+        """
+            Execute the appropriate action for a message.
+            Errors are raised to the caller.
+            @param headers: message headers
+            @param message: JSON-encoded message content
+        """
+        connection = self._get_connection()
+        action = states.StateAction(connection=connection,
+                                    use_db_task=self._use_db_tasks,
+                                    scheduler=self._scheduler)
+        if self._scheduler is not None:
+            # A message processed again after a rollback only counts once
+            scheduler = self._scheduler
+            on_commit(lambda: scheduler.status_received(headers['destination'], message))
+        with registry.track_message(headers, 'workflowmgr'):
+            action(headers, message)
+
+    def _ack(self, headers):
+        """
+            Acknowledge a processed message, and the duplicates
+            received while it was in progress.
+            With a worker pool, this is called once the message is committed.
+            @param headers: message headers
+        """
+        registry.message_committed(headers, 'workflowmgr')
+        for held_headers in self._dedup.completed(headers):
+            self._acknowledge(held_headers)
+        self._acknowledge(headers)
+
+    def _acknowledge(self, headers):
+        """
+            Acknowledge a message, unless acks are automatic
+            @param headers: message headers
+        """
+        if self._auto_ack:
+            return
+        if self._acks is not None:
+            self._acks.completed(headers)
+        else:
+            self._send_ack(headers['message-id'], headers['subscription'])
+
+    def _send_ack(self, message_id, subscription):
+        """
+            Send an ACK frame
+            @param message_id: ID of the message
+            @param subscription: ID of the subscription the message came from
+        """
+        self._get_connection().ack(message_id, subscription)
+
+    def stop(self):
+        """
+            Process the messages waiting in the worker threads and stop them
+        """
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
+    def stats(self):
+        """
+            Return the worker pool statistics, or None if there is no pool
+        """
+        if self._pool is not None:
+            return self._pool.stats()
+        return None
 
     def set_connection(self, connection):
         """
@@ -75,18 +302,19 @@ class Listener(stomp.ConnectionListener):
             Create a connection for sending messages, or return the existing
             one if we already created one
         """
-        if self._send_connection is None or self._send_connection.is_connected() is False:
-            logging.info("[workflow_send_connection] Attempting to connect to ActiveMQ broker")
-            if stomp.__version__[0]<4:
-                conn = stomp.Connection(host_and_ports=self._brokers,
-                                        user=self._user,
-                                        passcode=self._passcode,
-                                        wait_on_receipt=True)
-                conn.start()
-                conn.connect()
-            else:
-                conn = stomp.Connection(host_and_ports=self._brokers, keepalive=True)
-                conn.start()
-                conn.connect(self._user, self._passcode, wait=True)
-            self._send_connection = conn
-        return self._send_connection
+        with self._connection_lock:
+            if self._send_connection is None or self._send_connection.is_connected() is False:
+                logging.info("[workflow_send_connection] Attempting to connect to ActiveMQ broker")
+                if stomp.__version__[0]<4:
+                    conn = stomp.Connection(host_and_ports=self._brokers,
+                                            user=self._user,
+                                            passcode=self._passcode,
+                                            wait_on_receipt=True)
+                    conn.start()
+                    conn.connect()
+                else:
+                    conn = stomp.Connection(host_and_ports=self._brokers, keepalive=True)
+                    conn.start()
+                    conn.connect(self._user, self._passcode, wait=True)
+                self._send_connection = conn
+            return self._send_connection
@@ -0,0 +1,239 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes
+"""
+    Process-wide registry of lookup tables.
+
+    Small tables like Instrument, StatusQueue and Parameter are read
+    for almost every message or web request. A LookupTable keeps their
+    rows in a dictionary keyed by name so that lookups don't need
+    to go to the DB.
+
+    Rows created by other processes are picked up in two ways:
+      - a lookup for an unknown name goes to the DB before giving up
+        (or before creating the entry, for get_or_create()),
+      - the whole table is reloaded with a single query once
+        the refresh interval has elapsed, which also picks up changes
+        to other attributes, like Parameter.monitored.
+
+    Entries found or created while a transaction is open may not be
+    committed yet. They are only visible to the thread that looked them
+    up, until a reload outside of a transaction finds them, so that
+    other threads never use an entry that could be rolled back.
+
+    Usage:
+        instruments = get_table(Instrument)
+        instrument_id = instruments.get_or_create('eqsans')
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import time
+import logging
+import threading
+from django.db import connection, transaction, IntegrityError
+
+# Default time between full reloads of a table [secs]
+REFRESH_INTERVAL = 300
+
+# Lookup tables, keyed by (model class, field, prefix_match, refresh_interval)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+class LookupTable(object):
+    """
+        Dictionary-backed cache of a table with a unique name field
+    """
+
+    def __init__(self, model, field='name', prefix_match=False, refresh_interval=REFRESH_INTERVAL):
+        """
+            @param model: Django model class
+            @param field: name of the unique field used as key
+            @param prefix_match: if True, a name not found in the cache will be looked up with a prefix match in the DB
+            @param refresh_interval: number of seconds after which the whole table is reloaded
+        """
+        self._model = model
+        self._field = field
+        self._prefix_match = prefix_match
+        self._refresh_interval = refresh_interval
+        self._items = {}
+        ## Entries of each thread that may not be committed yet
+        self._local = threading.local()
+        self._last_refresh = None
+        self._lock = threading.Lock()
+        ## Usage counters
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.refreshes = 0
+
+    def _uncommitted(self):
+        """
+            Return the entries of this thread that may not be committed yet
+        """
+        items = getattr(self._local, 'items', None)
+        if items is None:
+            items = self._local.items = {}
+        return items
+
+    def _remember(self, name, item):
+        """
+            Add an entry to the cache. Within a transaction, the entry
+            is only seen by this thread.
+            @param name: value of the name field
+            @param item: model object
+        """
+        if connection.in_atomic_block:
+            self._uncommitted()[name] = item
+        else:
+            with self._lock:
+                self._items[name] = item
+
+    def refresh(self):
+        """
+            Reload the whole table from the DB
+        """
+        items = {}
+        for item in self._model.objects.all():
+            items[getattr(item, self._field)] = item
+        uncommitted = self._uncommitted()
+        if connection.in_atomic_block:
+            # Don't share what this thread may have written in its transaction
+            for name in uncommitted:
+                items.pop(name, None)
+        else:
+            uncommitted.clear()
+        with self._lock:
+            self._items = items
+            self._last_refresh = time.time()
+            self.refreshes += 1
+
+    def invalidate(self, name=None):
+        """
+            Remove an entry from the cache, or the whole cache if no name is given.
+            The next lookup will go to the DB.
+            @param name: name of the entry to remove
+        """
+        with self._lock:
+            if name is None:
+                self._last_refresh = None
+            else:
+                self._items.pop(name, None)
+        if name is None:
+            self._uncommitted().clear()
+        else:
+            self._uncommitted().pop(name, None)
+
+    def _lookup(self, name):
+        """
+            Find an entry in the cache, refreshing the cache if it is too old.
+            Returns None if the entry is not in the cache.
+            @param name: value of the name field
+        """
+        if self._last_refresh is None or time.time() - self._last_refresh > self._refresh_interval:
+            self.refresh()
+        item = self._items.get(name)
+        if item is None:
+            item = self._uncommitted().get(name)
+        if item is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return item
+
+    def _find_in_db(self, name):
+        """
+            Look for an entry in the DB and add it to the cache.
+            Returns None if it doesn't exist.
+            @param name: value of the name field
+        """
+        if self._prefix_match:
+            item_list = self._model.objects.filter(**{"%s__startswith" % self._field: name})
+        else:
+            item_list = self._model.objects.filter(**{self._field: name})
+        item_list = list(item_list[:1])
+        if len(item_list) == 0:
+            return None
+        self._remember(name, item_list[0])
+        return item_list[0]
+
+    def get(self, name):
+        """
+            Return the entry with the given name.
+            Raises model.DoesNotExist if it doesn't exist.
+            @param name: value of the name field
+        """
+        item = self._lookup(name)
+        if item is None:
+            item = self._find_in_db(name)
+        if item is None:
+            raise self._model.DoesNotExist("%s %s does not exist" % (self._model.__name__, name))
+        return item
+
+    def get_or_create(self, name):
+        """
+            Return the entry with the given name, creating it if it doesn't exist.
+            Note that this returns the object itself and not a tuple
+            like QuerySet.get_or_create().
+            @param name: value of the name field
+        """
+        item = self._lookup(name)
+        if item is None:
+            item = self._find_in_db(name)
+        if item is None:
+            try:
+                # Use a savepoint so that a concurrent creation doesn't break
+                # the transaction we may be running in.
+                with transaction.atomic():
+                    item = self._model(**{self._field: name})
+                    item.save()
+                self.created += 1
+            except IntegrityError:
+                # Another process created it first
+                logging.info("%s %s was created by another process", self._model.__name__, name)
+                item = self._model.objects.get(**{self._field: name})
+            self._remember(name, item)
+        return item
+
+    def items(self):
+        """
+            Return the list of cached entries, refreshing the cache if it is too old
+        """
+        if self._last_refresh is None or time.time() - self._last_refresh > self._refresh_interval:
+            self.refresh()
+        with self._lock:
+            return self._items.values()
+
+    def stats(self):
+        """
+            Return a dictionary of usage counters
+        """
+        return {'table': self._model.__name__,
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'created': self.created,
+                'refreshes': self.refreshes}
+
+
+def get_table(model, field='name', prefix_match=False, refresh_interval=REFRESH_INTERVAL):
+    """
+        Return the process-wide lookup table for a given model and options,
+        creating it if needed. Callers using different options get different tables.
+        @param model: Django model class
+        @param field: name of the unique field used as key
+        @param prefix_match: if True, a name not found in the cache will be looked up with a prefix match in the DB
+        @param refresh_interval: number of seconds after which the whole table is reloaded
+    """
+    key = (model, field, prefix_match, refresh_interval)
+    with _tables_lock:
+        if key not in _tables:
+            _tables[key] = LookupTable(model, field=field,
+                                       prefix_match=prefix_match,
+                                       refresh_interval=refresh_interval)
+        return _tables[key]
+
+
+def get_statistics():
+    """
+        Return the usage counters for all the lookup tables in this process
+    """
+    return [_tables[key].stats() for key in _tables]
@@ -258,7 +258,7 @@ class RunStatus(models.Model):
     run_id = models.ForeignKey(DataRun)
     ## Long name for this status
     queue_id = models.ForeignKey(StatusQueue)
-    ## ActiveMQ message ID
+    ## ActiveMQ message ID, used to detect redelivered messages (see report/sql/indices.sql)
     message_id = models.CharField(max_length=100, null=True)
     created_on = models.DateTimeField('Timestamp', auto_now_add=True)
 
@@ -342,45 +342,77 @@ class WorkflowSummary(models.Model):
         else:
             return str(self.run_id)
 
+    ## Status flags set by each type of status message:
+    ## (queue name prefix, summary field, value)
+    STATUS_FLAGS = [('CATALOG.COMPLETE', 'cataloged', True),
+                    ('CATALOG.STARTED', 'catalog_started', True),
+                    # Check whether we need reduction (default is no)
+                    ('REDUCTION.NOT_NEEDED', 'reduction_needed', False),
+                    ('REDUCTION.DISABLED', 'reduction_needed', False),
+                    ('REDUCTION.COMPLETE', 'reduced', True),
+                    ('REDUCTION.STARTED', 'reduction_started', True),
+                    ('REDUCTION_CATALOG.COMPLETE', 'reduction_cataloged', True),
+                    ('REDUCTION_CATALOG.STARTED', 'reduction_catalog_started', True)]
+
     def update(self):
         """
-            Update status according the messages received
+            Update status according the messages received.
+            This recomputes the whole summary from the RunStatus entries
+            of the run. It is used to audit and repair summaries, while
+            incoming messages go through update_status().
+        """
+        # Names of all the queues this run received a message from, in one query
+        queue_names = set(RunStatus.objects.filter(run_id=self.run_id) \
+                          .values_list('queue_id__name', flat=True).distinct())
+        previous = self._flags()
+        for prefix, field, value in self.STATUS_FLAGS:
+            for name in queue_names:
+                if name.startswith(prefix):
+                    setattr(self, field, value)
+                    break
+        self._update_completion()
+
+        # Only write to the DB if something changed
+        if self.pk is None or self._flags() != previous:
+            self.save()
+
+    def update_status(self, queue_name):
+        """
+            Update the status for a new message, setting only
+            the flags affected by the queue it came from.
+            The cost does not depend on the number of messages
+            already received for the run.
+            @param queue_name: name of the StatusQueue of the message
+        """
+        previous = self._flags()
+        for prefix, field, value in self.STATUS_FLAGS:
+            if queue_name.startswith(prefix):
+                setattr(self, field, value)
+        self._update_completion()
+
+        # Only write to the DB if something changed
+        if self.pk is None or self._flags() != previous:
+            self.save()
+
+    def _update_completion(self):
+        """
+            Determine overall status from the status flags
         """
         # We start with an incomplete state. If a run entry is present without
         # any action from the workflow manager, it is by definition incomplete.
         self.complete = False
-
-        # Look for cataloging status
-        if len(RunStatus.objects.status(self.run_id, 'CATALOG.COMPLETE'))>0:
-            self.cataloged = True
-        if len(RunStatus.objects.status(self.run_id, 'CATALOG.STARTED'))>0:
-            self.catalog_started = True
-
-        # Check whether we need reduction (default is no)
-        if len(RunStatus.objects.status(self.run_id, 'REDUCTION.NOT_NEEDED'))>0:
-            self.reduction_needed = False
-        elif len(RunStatus.objects.status(self.run_id, 'REDUCTION.DISABLED'))>0:
-            self.reduction_needed = False
-
-        # Look for reduction status
-        if len(RunStatus.objects.status(self.run_id, 'REDUCTION.COMPLETE'))>0:
-            self.reduced = True
-        if len(RunStatus.objects.status(self.run_id, 'REDUCTION.STARTED'))>0:
-            self.reduction_started = True
-
-        # Look for status of reduced data cataloging
-        if len(RunStatus.objects.status(self.run_id, 'REDUCTION_CATALOG.COMPLETE'))>0:
-            self.reduction_cataloged = True
-        if len(RunStatus.objects.status(self.run_id, 'REDUCTION_CATALOG.STARTED'))>0:
-            self.reduction_catalog_started = True
-
-        # Determine overall status
         if self.cataloged is True:
             if self.reduction_needed is False or \
                (self.reduced is True and self.reduction_cataloged is True):
                 self.complete = True
 
-        self.save()
+    def _flags(self):
+        """
+            Return the status flags as a tuple
+        """
+        return (self.complete, self.catalog_started, self.cataloged,
+                self.reduction_needed, self.reduction_started, self.reduced,
+                self.reduction_cataloged, self.reduction_catalog_started)
 
 
 class Error(models.Model):
@@ -490,4 +522,67 @@ class InstrumentStatus(models.Model):
 
     class Meta:
         verbose_name_plural = "Instrument status"
-        app_label = 'report'
\ No newline at end of file
+        app_label = 'report'
+
+class ProcessingJob(models.Model):
+    """
+        Bulk post-processing request, carried out in the background
+        by the reporting app. See reporting/report/processing_jobs.py.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    instrument_id = models.ForeignKey(Instrument)
+    ## Experiment, or None if it has to be found in the catalog
+    ipts_id = models.ForeignKey(IPTS, null=True, blank=True)
+    ## Runs to process, as a list of ranges (e.g. 1-3,5)
+    run_list = models.TextField()
+    ## Queue the requests are sent to
+    task = models.CharField(max_length=100)
+    ## If True, the runs missing from the DB are created
+    create_as_needed = models.BooleanField(default=False)
+    ## If True, the requests are flagged as complete
+    is_complete = models.BooleanField(default=False)
+    ## Name of the user who submitted the job
+    user = models.CharField(max_length=150, blank=True, default='')
+    status = models.CharField(max_length=10, default=QUEUED, db_index=True)
+    ## Progress counters
+    number_of_runs = models.IntegerField(default=0)
+    submitted = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    report = models.TextField(blank=True, default='')
+    created_on = models.DateTimeField('Timestamp', auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'report'
+
+    def __unicode__(self):
+        return u"%s job %d" % (self.instrument_id, self.id)
+
+    def is_active(self):
+        """
+            Return True if the job is not finished
+        """
+        return self.status in [ProcessingJob.QUEUED, ProcessingJob.RUNNING]
+
+
+class ScheduledMessage(models.Model):
+    """
+        Message held by the workflow manager until a worker is
+        available to process it. See workflow/scheduler.py.
+    """
+    ## Queue the message will be sent to
+    queue = models.CharField(max_length=100)
+    ## Messages for live runs are sent before the others
+    is_live = models.BooleanField(default=False)
+    instrument = models.CharField(max_length=20)
+    run_number = models.CharField(max_length=20)
+    message = models.TextField()
+    created_on = models.DateTimeField('Timestamp', auto_now_add=True)
+
+    class Meta:
+        app_label = 'report'
+        index_together = [('queue', 'is_live', 'instrument')]
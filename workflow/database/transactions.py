@@ -7,6 +7,8 @@ import os
 import json
 import logging
 import traceback
+import datetime
+import threading
 # The workflow modules must be on the python path
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "workflow.database.settings")
 import django
@@ -14,6 +16,7 @@ if django.VERSION[1]>=7:
     django.setup()
     from workflow.database.report.models import DataRun, RunStatus, StatusQueue, WorkflowSummary
     from workflow.database.report.models import IPTS, Instrument, Error, Information, Task
+    from workflow.database.report.models import ScheduledMessage
 else:
     # The report database module must be on the python path for Django to find it
     sys.path.append(os.path.dirname(__file__))
@@ -21,17 +24,80 @@ else:
     # Import your models for use in your script		
     from report.models import DataRun, RunStatus, StatusQueue, WorkflowSummary
     from report.models import IPTS, Instrument, Error, Information, Task
+    from report.models import ScheduledMessage
 
 from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from registry import get_table
+
+# Maximum number of IPTS entries kept in memory
+IPTS_CACHE_SIZE = 1000
+
+# IPTS entries recently seen by each thread. Another thread's entries
+# may belong to a transaction that isn't committed yet.
+_ipts_state = threading.local()
+
+def _ipts_caches():
+    """
+        Return this thread's IPTS entries, keyed by experiment name,
+        and the (IPTS id, instrument id) pairs known to be linked in the DB
+    """
+    if not hasattr(_ipts_state, 'cache'):
+        _ipts_state.cache = {}
+        _ipts_state.links = set()
+    return _ipts_state.cache, _ipts_state.links
+
+def reset_caches():
+    """
+        Forget this thread's cached IPTS entries and force a reload
+        of the lookup tables used when processing status messages.
+        This is called after a failed transaction, since entries
+        created within it may have been rolled back.
+    """
+    _ipts_cache, _ipts_links = _ipts_caches()
+    _ipts_cache.clear()
+    _ipts_links.clear()
+    get_table(StatusQueue, prefix_match=True).invalidate()
+    get_table(Instrument).invalidate()
+
+def _get_ipts(ipts, instrument_id):
+    """
+        Return the IPTS entry for an experiment name, creating it if needed,
+        and make sure it is linked to the given instrument.
+        Only the first message for a given experiment hits the DB.
+        @param ipts: experiment name
+        @param instrument_id: Instrument object
+    """
+    _ipts_cache, _ipts_links = _ipts_caches()
+    ipts_id = _ipts_cache.get(ipts)
+    if ipts_id is None:
+        ipts_id, _ = IPTS.objects.get_or_create(expt_name=ipts)
+        if len(_ipts_cache) >= IPTS_CACHE_SIZE:
+            _ipts_cache.clear()
+            _ipts_links.clear()
+        _ipts_cache[ipts] = ipts_id
+
+    # Add instrument to IPTS if not already in there
+    if (ipts_id.id, instrument_id.id) not in _ipts_links:
+        try:
+            link_model = IPTS.instruments.through
+            if not link_model.objects.filter(ipts_id=ipts_id.id,
+                                             instrument_id=instrument_id.id).exists():
+                ipts_id.instruments.add(instrument_id)
+            _ipts_links.add((ipts_id.id, instrument_id.id))
+        except:
+            traceback.print_exc()
+            logging.error(sys.exc_value)
+    return ipts_id
 
-@transaction.atomic
 def add_status_entry(headers, data):
     """
         Populate the reporting database with the contents
         of a status message of the following format:
 
         @param headers: ActiveMQ message header dictionary
-        @param data: JSON encoded message content
+        @param data: JSON encoded message content, or message envelope
 
         headers: {'expires': '0', 'timestamp': '1344613053723',
                   'destination': '/queue/POSTPROCESS.DATA_READY',
@@ -46,52 +112,59 @@ def add_status_entry(headers, data):
                "run_number": run_number,
                "data_file": message}
     """
+    try:
+        _add_status_entry(headers, data)
+    except:
+        reset_caches()
+        raise
+
+@transaction.atomic
+def _add_status_entry(headers, data):
+    """
+        Store a status message. Once the lookup caches are warm, a message
+        for a known run costs one query for each of the following:
+          - lock the DataRun entry,
+          - read the WorkflowSummary entry,
+          - insert the RunStatus entry,
+          - insert the Information or Error entry, if any,
+          - update the summary, if the message changed it.
+        @param headers: ActiveMQ message header dictionary
+        @param data: JSON encoded message content
+    """
     # Find the DB entry for this queue
     destination = headers["destination"].replace('/queue/','')
-    status_id = StatusQueue.objects.filter(name__startswith=destination)
-    if len(status_id)==0:
-        status_id = StatusQueue(name=destination)
-        status_id.save()
-    else:
-        status_id = status_id[0]
+    status_id = get_table(StatusQueue, prefix_match=True).get_or_create(destination)
 
-    # Process the data
-    data_dict = json.loads(data)
+    # Process the data. A message envelope carries its decoded content.
+    if hasattr(data, 'to_dict'):
+        data_dict = data.to_dict()
+    else:
+        data_dict = json.loads(data)
 
     # Look for instrument
     instrument = data_dict["instrument"].lower()
-    try:
-        instrument_id = Instrument.objects.get(name=instrument)
-    except Instrument.DoesNotExist:
-        instrument_id = Instrument(name=instrument)
-        instrument_id.save()
+    instrument_id = get_table(Instrument).get_or_create(instrument)
 
     # Look for IPTS ID
-    ipts = data_dict["ipts"].upper()
-    try:
-        ipts_id = IPTS.objects.get(expt_name=ipts)
-    except IPTS.DoesNotExist:
-        ipts_id = IPTS(expt_name=ipts)
-        ipts_id.save()
-
-    # Add instrument to IPTS if not already in there
-    try:
-        if IPTS.objects.filter(id=ipts_id.id, instruments__in=[instrument_id]).count()==0:
-            ipts_id.instruments.add(instrument_id)
-            ipts_id.save()
-    except:
-        traceback.print_exc()
-        logging.error(sys.exc_value)
+    ipts_id = _get_ipts(data_dict["ipts"].upper(), instrument_id)
 
-    # Check whether we already have an entry for this run
+    # Check whether we already have an entry for this run.
+    # Lock it so that concurrent messages for the same run are serialized.
     run_number = int(data_dict["run_number"])
     try:
-        run_id = DataRun.objects.get(run_number=run_number, instrument_id=instrument_id)
+        run_id = DataRun.objects.select_for_update().get(run_number=run_number,
+                                                         instrument_id=instrument_id)
         # Update the file location and IPTS as needed
-        run_id.ipts_id = ipts_id
-        if "data_file" in data_dict and len(data_dict["data_file"]) > 0:
+        changed_fields = []
+        if run_id.ipts_id_id != ipts_id.id:
+            run_id.ipts_id = ipts_id
+            changed_fields.append('ipts_id')
+        if "data_file" in data_dict and len(data_dict["data_file"]) > 0 \
+            and run_id.file != data_dict["data_file"]:
             run_id.file = data_dict["data_file"]
-        run_id.save()
+            changed_fields.append('file')
+        if len(changed_fields) > 0:
+            run_id.save(update_fields=changed_fields)
     except DataRun.DoesNotExist:
         logging.info("Creating entry for run %s-%d", instrument, run_number)
         run_id = DataRun.create_and_save(run_number=run_number,
@@ -100,11 +173,10 @@ def add_status_entry(headers, data):
                                          file=data_dict["data_file"])
 
     # Add a workflow summary for this new run
-    try:
-        summary_id = WorkflowSummary.objects.get(run_id=run_id)
-    except WorkflowSummary.DoesNotExist:
+    summary_id = WorkflowSummary.objects.get_summary(run_id)
+    new_summary = summary_id is None
+    if new_summary:
         summary_id = WorkflowSummary(run_id=run_id)
-        summary_id.save()
 
     # Create a run status object in the DB
     run_status = RunStatus(run_id=run_id,
@@ -129,13 +201,69 @@ def add_status_entry(headers, data):
                       description=mesg)
         error.save()
 
-    # Update the workflow summary
-    summary_id = WorkflowSummary.objects.get_summary(run_id)
+    # Update the workflow summary. A summary created for a run
+    # that already has status entries is computed from all of them.
     if "is_complete" in data_dict:
         summary_id.complete = True
         summary_id.save()
-    else:
+    elif new_summary:
         summary_id.update()
+    else:
+        summary_id.update_status(status_id.name)
+
+def message_processed(message_id, window):
+    """
+        Return True if a status entry was recorded for a message
+        with the given ID within the given time window
+        @param message_id: ActiveMQ message ID
+        @param window: time window [secs]
+    """
+    since = timezone.now() - datetime.timedelta(seconds=window)
+    return RunStatus.objects.filter(message_id=message_id, created_on__gte=since).exists()
+
+def save_scheduled_message(queue, is_live, instrument, run_number, message):
+    """
+        Store a message held by the scheduler. Returns the ID of the entry.
+        @param queue: queue the message will be sent to
+        @param is_live: True if the message is for a live run
+        @param instrument: instrument name
+        @param run_number: run number
+        @param message: message content
+    """
+    entry = ScheduledMessage(queue=queue, is_live=is_live, instrument=instrument,
+                             run_number=run_number, message=str(message))
+    entry.save()
+    return entry.id
+
+def delete_scheduled_message(entry_id):
+    """
+        Remove a message that the scheduler has sent
+        @param entry_id: ID of the ScheduledMessage entry
+    """
+    ScheduledMessage.objects.filter(id=entry_id).delete()
+
+def load_scheduled_messages(queue, is_live, instrument, exclude_ids, count):
+    """
+        Return the oldest messages held for a queue and an instrument,
+        as a list of (entry ID, run number, message)
+        @param queue: queue the messages will be sent to
+        @param is_live: True for the messages of live runs
+        @param instrument: instrument name
+        @param exclude_ids: IDs of the entries already loaded
+        @param count: maximum number of messages to return
+    """
+    query = ScheduledMessage.objects.filter(queue=queue, is_live=is_live, instrument=instrument)
+    if len(exclude_ids) > 0:
+        query = query.exclude(id__in=exclude_ids)
+    return list(query.order_by('id').values_list('id', 'run_number', 'message')[:count])
+
+def count_scheduled_messages():
+    """
+        Return the number of messages held by the scheduler
+        as a list of (queue, is_live, instrument, count)
+    """
+    counts = ScheduledMessage.objects.values('queue', 'is_live', 'instrument').annotate(count=Count('id'))
+    return [(item['queue'], item['is_live'], item['instrument'], item['count']) for item in counts]
 
 def add_workflow_status_entry(destination, message):
     """
@@ -155,9 +283,11 @@ def get_task(message_headers, message_data):
     """
     if "destination" in message_headers:
         destination = message_headers["destination"].replace('/queue/','')
-        status_ids = StatusQueue.objects.filter(name__startswith=destination)
-        if len(status_ids)>0:
-            status_id = status_ids[0]
+        try:
+            status_id = get_table(StatusQueue, prefix_match=True).get(destination)
+        except StatusQueue.DoesNotExist:
+            logging.error("transactions.get_task could not find queue %s", destination)
+            return None
     else:
         logging.error("transactions.get_task got badly formed message header")
         return None
@@ -173,7 +303,7 @@ def get_task(message_headers, message_data):
     if "instrument" in data_dict:
         instrument = data_dict["instrument"].lower()
         try:
-            instrument_id = Instrument.objects.get(name=instrument)
+            instrument_id = get_table(Instrument).get(instrument)
         except Instrument.DoesNotExist:
             logging.error("transactions.get_task could not find instrument entry")
             return None
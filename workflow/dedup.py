@@ -0,0 +1,141 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Detection of messages delivered more than once.
+
+    After a reconnection, the broker delivers again the messages that were
+    not acknowledged, even if they were already processed. A Deduplicator
+    remembers the IDs of the messages received recently, in a bounded
+    LRU set, so that those duplicates are dropped before any parsing or
+    DB work.
+
+    Message IDs older than the LRU capacity, or received before a restart,
+    can be looked up with an optional function, typically a DB query.
+    It is only called for messages flagged as redelivered by the broker,
+    so that first deliveries never wait for the DB.
+
+    A duplicate may arrive while the first copy is still being processed,
+    for instance after a reconnection. It must not be acknowledged before
+    the first copy is committed: if that commit fails, the message would
+    be lost. Such duplicates are held until the first copy is completed.
+    Consumers with automatic acknowledgements don't need this, and turn
+    it off with hold_duplicates=False.
+
+    Usage:
+        dedup = Deduplicator(capacity=10000, window=3600)
+        if dedup.is_duplicate(headers):
+            if not dedup.hold(headers):
+                ack(headers)
+            return
+        process(headers, message)
+        for held_headers in dedup.completed(headers):
+            ack(held_headers)
+        ack(headers)
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import collections
+
+
+class Deduplicator(object):
+    """
+        Bounded, time-windowed set of recently received message IDs
+    """
+    def __init__(self, capacity=10000, window=3600, lookup=None, hold_duplicates=True):
+        """
+            @param capacity: maximum number of message IDs kept in memory
+            @param window: number of seconds during which a message ID is remembered
+            @param lookup: function called with a message ID and a time window [secs],
+                           returning True if the message was processed within that window
+            @param hold_duplicates: if True, the messages in progress are tracked until
+                                    completed() or forget() is called for them, so that
+                                    their duplicates can be held
+        """
+        self._capacity = capacity
+        self._hold_duplicates = hold_duplicates
+        self._window = window
+        self._lookup = lookup
+        self._lock = threading.Lock()
+        ## Reception time of each message ID, oldest first
+        self._received = collections.OrderedDict()
+        ## Headers of the duplicates held for each message ID being processed
+        self._in_flight = {}
+        ## Usage counters
+        self.duplicates = 0
+        self.lookups = 0
+
+    def is_duplicate(self, headers):
+        """
+            Return True if a message with the same ID was already received.
+            Otherwise, remember its ID and return False.
+            @param headers: message headers
+        """
+        message_id = headers.get('message-id')
+        if not message_id:
+            return False
+        now = time.time()
+        with self._lock:
+            received_time = self._received.get(message_id)
+            if received_time is not None and now - received_time < self._window:
+                self.duplicates += 1
+                return True
+            self._received.pop(message_id, None)
+            self._received[message_id] = now
+            while len(self._received) > self._capacity:
+                self._received.popitem(last=False)
+
+        if self._lookup is not None and headers.get('redelivered') == 'true':
+            self.lookups += 1
+            try:
+                if self._lookup(message_id, self._window):
+                    # Already committed: nothing to hold its duplicates for
+                    self.duplicates += 1
+                    return True
+            except:
+                logging.error("Could not look up message %s: %s", message_id, sys.exc_value)
+        if self._hold_duplicates:
+            with self._lock:
+                self._in_flight[message_id] = []
+        return False
+
+    def hold(self, headers):
+        """
+            Hold a duplicate until the first copy of the message is completed.
+            Returns False if the first copy is already completed, in which case
+            the duplicate can be acknowledged right away.
+            @param headers: headers of the duplicate
+        """
+        with self._lock:
+            held = self._in_flight.get(headers.get('message-id'))
+            if held is None:
+                return False
+            held.append(headers)
+            return True
+
+    def completed(self, headers):
+        """
+            Record that a message is processed and committed.
+            Returns the headers of the duplicates held for it,
+            which can now be acknowledged.
+            @param headers: message headers
+        """
+        with self._lock:
+            return self._in_flight.pop(headers.get('message-id'), [])
+
+    def forget(self, headers):
+        """
+            Forget a message ID, so that the message will be processed
+            if it is delivered again. This is used when the processing
+            of a message was rolled back. The duplicates held for it are
+            dropped without being acknowledged.
+            @param headers: message headers
+        """
+        with self._lock:
+            self._received.pop(headers.get('message-id'), None)
+            self._in_flight.pop(headers.get('message-id'), None)
+
+    def __len__(self):
+        return len(self._received)
@@ -0,0 +1,114 @@
+#pylint: disable=invalid-name
+"""
+    Parsed message envelope passed through the workflow pipeline.
+
+    An Envelope is the JSON-encoded message itself, as a string, so that
+    it can be sent to a queue or given to code expecting the raw message,
+    but it also carries the decoded content and the headers of the message
+    it was received with. The message is decoded once when it is received,
+    and only encoded again when its content is changed.
+
+    Envelopes are immutable: with_values() and without() return new ones.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import json
+
+
+class Envelope(str):
+    """
+        JSON-encoded message together with its decoded content
+    """
+    def __new__(cls, body, data=None, headers=None):
+        """
+            @param body: JSON-encoded message content
+            @param data: decoded content, if already available
+            @param headers: headers of the message
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        envelope = str.__new__(cls, body)
+        if data is None:
+            data = json.loads(body)
+        envelope._data = data
+        envelope._headers = dict(headers) if headers is not None else {}
+        return envelope
+
+    @classmethod
+    def from_data(cls, data, headers=None):
+        """
+            Create an envelope from a data dictionary
+            @param data: message content
+            @param headers: headers of the message
+        """
+        return cls(json.dumps(data), data=dict(data), headers=headers)
+
+    @classmethod
+    def wrap(cls, message, headers=None):
+        """
+            Return the message as an envelope, decoding it only
+            if it isn't one already
+            @param message: JSON-encoded message content or Envelope
+            @param headers: headers of the message
+        """
+        if isinstance(message, cls):
+            return message
+        return cls(message, headers=headers)
+
+    @property
+    def headers(self):
+        """
+            Copy of the headers of the message
+        """
+        return dict(self._headers)
+
+    @property
+    def destination(self):
+        """
+            Name of the queue the message came from
+        """
+        return self._headers.get('destination', '').replace('/queue/', '')
+
+    def __reduce__(self):
+        return (Envelope, (str(self), self._data, self._headers))
+
+    def has_key(self, key):
+        """
+            Return True if the message content has the given entry
+            @param key: name of the entry
+        """
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+            Return a value from the message content
+            @param key: name of the entry
+            @param default: value returned if the entry doesn't exist
+        """
+        return self._data.get(key, default)
+
+    def to_dict(self):
+        """
+            Return a copy of the message content
+        """
+        return dict(self._data)
+
+    def with_values(self, **kwargs):
+        """
+            Return a new envelope with the given entries added or replaced
+        """
+        data = dict(self._data)
+        data.update(kwargs)
+        return Envelope.from_data(data, headers=self._headers)
+
+    def without(self, *keys):
+        """
+            Return an envelope without the given entries.
+            The envelope itself is returned if none of them are present.
+        """
+        if not any(key in self._data for key in keys):
+            return self
+        data = dict(self._data)
+        for key in keys:
+            data.pop(key, None)
+        return Envelope.from_data(data, headers=self._headers)
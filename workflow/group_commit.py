@@ -0,0 +1,236 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Group commit of the DB transactions of the workflow manager.
+
+    Messages are processed on a separate thread. The status entries of all
+    the messages arriving within a short window are written in a single
+    DB transaction, so that a burst of messages costs one commit instead
+    of several per message. Each message is processed within its own
+    savepoint: a failure only rolls back the entries of that message.
+
+    Messages are acknowledged only once the transaction holding their
+    entries is committed. If the commit fails, each message of the batch
+    is processed again in its own transaction, so that one bad message
+    doesn't hold back the others. A message that still can't be committed
+    is not acknowledged, and the failed function is called so that it
+    can be delivered again.
+
+    The status entries of the messages sent while processing a message
+    are part of its transaction. Publishing those messages, and other side
+    effects outside the DB, are registered with on_commit(). They only happen once
+    the transaction holding the entries of that message is committed, and
+    are dropped if it is rolled back. A message processed again after a
+    failed group commit therefore doesn't send its messages twice.
+
+    Without a commit window, a GroupCommitter is a plain worker thread
+    processing one message at a time.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import Queue
+import logging
+import threading
+from django.db import transaction, close_old_connections
+from database import transactions
+
+# Functions to call once the message being processed by this thread is committed
+_pending = threading.local()
+
+def on_commit(func):
+    """
+        Call a function once the DB entries of the message being processed
+        are committed. The function is dropped if they are rolled back.
+        Outside of a group commit, the function is called right away.
+        @param func: function taking no argument
+    """
+    callbacks = getattr(_pending, 'callbacks', None)
+    if callbacks is None:
+        func()
+    else:
+        callbacks.append(func)
+
+def _run_callbacks(callbacks):
+    """
+        Call the functions registered for committed messages
+        @param callbacks: list of functions
+    """
+    for func in callbacks:
+        try:
+            func()
+        except:
+            logging.error("Group commit: failed to run commit callback: %s", sys.exc_value)
+
+
+def _log_failure(headers, message):
+    """
+        Log the error raised while processing a message
+        @param headers: message headers
+        @param message: message content
+    """
+    logging.error("Failed to process message: %s", str(sys.exc_value))
+    logging.error("  Message: %s: %s", headers.get('destination'), str(message))
+
+
+class GroupCommitter(threading.Thread):
+    """
+        Thread processing messages in batches, one DB transaction per batch
+    """
+    def __init__(self, process, ack, window=50, batch_size=50, queue_size=10000,
+                 done=None, failed=None, name='group_commit'):
+        """
+            @param process: function processing a message, taking the headers and message.
+                            It must raise an exception if processing fails.
+            @param ack: function acknowledging a message, taking its headers
+            @param window: maximum time a message waits for others to share its transaction [ms].
+                           If None, each message is processed in its own transaction.
+            @param batch_size: maximum number of messages per transaction
+            @param queue_size: maximum number of messages waiting to be processed
+            @param done: function called with the headers of each message once it is handled, acknowledged or not
+            @param failed: function called with the headers of each message that could not be committed
+            @param name: name of the thread
+        """
+        super(GroupCommitter, self).__init__(name=name)
+        self.daemon = True
+        self._process = process
+        self._ack = ack
+        self._done = done
+        self._failed = failed
+        self._window = window / 1000.0 if window is not None else None
+        self._batch_size = batch_size
+        self._queue = Queue.Queue(queue_size)
+        self._stopping = False
+        ## Usage counters
+        self.commits = 0
+        self.messages = 0
+        self.failed_commits = 0
+
+    def submit(self, headers, message):
+        """
+            Queue a message for processing. This blocks if the queue is full.
+            @param headers: message headers
+            @param message: message content
+        """
+        self._queue.put((headers, message))
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        """
+            Process the messages already queued and stop the thread
+        """
+        self._stopping = True
+        self._queue.put(None)
+        if self.ident is not None:
+            self.join()
+
+    def run(self):
+        while not self._stopping or not self._queue.empty():
+            item = self._queue.get()
+            if item is None:
+                continue
+            self._process_batch(item)
+
+    def _process_one(self, headers, message, callbacks):
+        """
+            Process a message within a savepoint. If processing fails,
+            the entries written for that message are rolled back.
+            @param headers: message headers
+            @param message: message content
+            @param callbacks: list to add the functions registered with on_commit() to
+        """
+        _pending.callbacks = []
+        try:
+            with transaction.atomic():
+                self._process(headers, message)
+            callbacks.extend(_pending.callbacks)
+        except:
+            _log_failure(headers, message)
+            transactions.reset_caches()
+        finally:
+            _pending.callbacks = None
+
+    def _process_batch(self, first_item):
+        """
+            Process the given message, and those arriving within the
+            commit window, in a single transaction, then acknowledge them.
+            @param first_item: (headers, message) tuple
+        """
+        close_old_connections()
+        batch = [first_item]
+        if self._window is None:
+            # No grouping: the message is committed on its own
+            try:
+                self._process(*first_item)
+            except:
+                _log_failure(*first_item)
+            self._acknowledge(batch)
+            return
+        deadline = time.time() + self._window
+        callbacks = []
+        try:
+            with transaction.atomic():
+                self._process_one(first_item[0], first_item[1], callbacks)
+                while len(batch) < self._batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except Queue.Empty:
+                        break
+                    if item is None:
+                        break
+                    batch.append(item)
+                    self._process_one(item[0], item[1], callbacks)
+        except:
+            self.failed_commits += 1
+            logging.error("Group commit of %d messages failed: %s", len(batch), sys.exc_value)
+            # Entries cached while processing the batch were rolled back
+            transactions.reset_caches()
+            for item in batch:
+                self._retry_one(item)
+            return
+        _run_callbacks(callbacks)
+        self._acknowledge(batch)
+
+    def _retry_one(self, item):
+        """
+            Process a message of a group that could not be committed,
+            in its own transaction, then acknowledge it
+            @param item: (headers, message) tuple
+        """
+        callbacks = []
+        try:
+            with transaction.atomic():
+                self._process_one(item[0], item[1], callbacks)
+        except:
+            self.failed_commits += 1
+            logging.error("Commit of message %s failed: %s", item[0].get('message-id'), sys.exc_value)
+            transactions.reset_caches()
+            self._acknowledge([item], committed=False)
+            return
+        _run_callbacks(callbacks)
+        self._acknowledge([item])
+
+    def _acknowledge(self, batch, committed=True):
+        """
+            Acknowledge the messages of a committed batch
+            @param batch: list of (headers, message) tuples
+            @param committed: if False, the messages are not acknowledged
+        """
+        if committed:
+            self.commits += 1
+            self.messages += len(batch)
+        for headers, _ in batch:
+            try:
+                if committed:
+                    self._ack(headers)
+            except:
+                logging.error("Group commit: failed to acknowledge message: %s", sys.exc_value)
+            if not committed and self._failed is not None:
+                self._failed(headers)
+            if self._done is not None:
+                self._done(headers)
@@ -0,0 +1,380 @@
+#pylint: disable=bare-except, invalid-name, too-many-arguments
+"""
+    In-process metrics for the workflow manager and the DASMON listener.
+
+    The registry holds:
+      - counters, for instance the number of messages per destination,
+      - histograms, for instance the latency between the time a message
+        was stamped by the broker and the commit of its DB entries,
+      - gauges, computed when the metrics are read, for internal queue depths.
+
+    The metrics can be exposed in the Prometheus text format on a local
+    port by starting a MetricsServer:
+
+        curl http://localhost:<port>/metrics
+
+    Usage:
+        with registry.track_message(headers, 'workflowmgr'):
+            process(headers, message)
+        # Once the DB entries of the message are committed
+        registry.message_committed(headers, 'workflowmgr')
+
+    The number of DB queries per message is recorded by wrapping the
+    cursors of the connection while the message is processed.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import BaseHTTPServer
+from django.db import connections, DEFAULT_DB_ALIAS
+
+## Default histogram buckets [secs]
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+## Buckets for the number of DB queries per message
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _label_string(labels, extra=None):
+    """
+        Format labels in the Prometheus text format
+        @param labels: tuple of (name, value) pairs
+        @param extra: additional (name, value) pair
+    """
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ''
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v)) for k, v in items])
+
+
+class Histogram(object):
+    """
+        Cumulative histogram of observed values
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+            Add a value to the histogram
+            @param value: observed value
+        """
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """
+        Registry of counters, histograms and gauges
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        """
+            Turn a label dictionary into a hashable key
+        """
+        if labels is None:
+            return ()
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels=None, value=1, help_text=None):
+        """
+            Increment a counter
+            @param name: name of the counter
+            @param labels: dictionary of labels
+            @param value: increment
+            @param help_text: description of the metric
+        """
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            if help_text is not None:
+                self._help[name] = help_text
+
+    def observe(self, name, value, labels=None, buckets=DEFAULT_BUCKETS, help_text=None):
+        """
+            Add a value to a histogram
+            @param name: name of the histogram
+            @param value: observed value
+            @param labels: dictionary of labels
+            @param buckets: bucket upper bounds, used when the histogram is created
+            @param help_text: description of the metric
+        """
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+            if help_text is not None:
+                self._help[name] = help_text
+
+    def register_gauge(self, name, callback, labels=None, help_text=None):
+        """
+            Register a gauge whose value is computed when the metrics are read
+            @param name: name of the gauge
+            @param callback: function returning the current value
+            @param labels: dictionary of labels
+            @param help_text: description of the metric
+        """
+        with self._lock:
+            self._gauges.setdefault(name, {})[self._key(labels)] = callback
+            if help_text is not None:
+                self._help[name] = help_text
+
+    def get_histogram(self, name, labels=None):
+        """
+            Return a copy of a histogram, or None if nothing was observed
+            @param name: name of the histogram
+            @param labels: dictionary of labels
+        """
+        with self._lock:
+            histo = self._histograms.get(name, {}).get(self._key(labels))
+            if histo is None:
+                return None
+            copy = Histogram(histo.buckets)
+            copy.counts = list(histo.counts)
+            copy.sum = histo.sum
+            copy.count = histo.count
+            return copy
+
+    def track_message(self, headers, process):
+        """
+            Return a context manager that records the processing of a message
+            @param headers: message headers
+            @param process: name of the process
+        """
+        return MessageTracker(self, headers, process)
+
+    def message_committed(self, headers, process):
+        """
+            Record the latency between the broker timestamp of a message
+            and the commit of its DB entries
+            @param headers: message headers
+            @param process: name of the process
+        """
+        try:
+            broker_time = float(headers.get('timestamp', 0)) / 1000.0
+        except ValueError:
+            logging.debug("Bad message timestamp: %s", headers.get('timestamp'))
+            return
+        if broker_time > 0:
+            self.observe('amq_message_latency_seconds', max(time.time() - broker_time, 0), {'process': process},
+                         help_text='Time between the broker timestamp and the commit of a message')
+
+    def render(self):
+        """
+            Return the metrics in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                if name in self._help:
+                    lines.append("# HELP %s %s" % (name, self._help[name]))
+                lines.append("# TYPE %s counter" % name)
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append("%s%s %s" % (name, _label_string(key), value))
+            for name in sorted(self._histograms):
+                if name in self._help:
+                    lines.append("# HELP %s %s" % (name, self._help[name]))
+                lines.append("# TYPE %s histogram" % name)
+                for key, histo in sorted(self._histograms[name].items()):
+                    for upper, count in zip(histo.buckets, histo.counts):
+                        lines.append("%s_bucket%s %s" % (name, _label_string(key, ('le', upper)), count))
+                    lines.append("%s_bucket%s %s" % (name, _label_string(key, ('le', '+Inf')), histo.count))
+                    lines.append("%s_sum%s %s" % (name, _label_string(key), histo.sum))
+                    lines.append("%s_count%s %s" % (name, _label_string(key), histo.count))
+            gauges = dict([(name, dict(self._gauges[name])) for name in self._gauges])
+        for name in sorted(gauges):
+            if name in self._help:
+                lines.append("# HELP %s %s" % (name, self._help[name]))
+            lines.append("# TYPE %s gauge" % name)
+            for key, callback in sorted(gauges[name].items()):
+                try:
+                    lines.append("%s%s %s" % (name, _label_string(key), callback()))
+                except:
+                    logging.error("Could not compute gauge %s: %s", name, sys.exc_value)
+        return '\n'.join(lines) + '\n'
+
+
+class _TimedCursor(object):
+    """
+        Cursor wrapper recording the time of each query
+    """
+    def __init__(self, cursor, tracker):
+        self._cursor = cursor
+        self._tracker = tracker
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cursor.close()
+
+    def execute(self, sql, params=None):
+        t0 = time.time()
+        try:
+            return self._cursor.execute(sql, params)
+        finally:
+            self._tracker._queries.append({'time': time.time() - t0})
+
+    def executemany(self, sql, param_list):
+        t0 = time.time()
+        try:
+            return self._cursor.executemany(sql, param_list)
+        finally:
+            self._tracker._queries.append({'time': time.time() - t0})
+
+
+class MessageTracker(object):
+    """
+        Context manager recording the number of messages per destination,
+        and the number of DB queries and DB time needed to process a message.
+    """
+
+    def __init__(self, registry, headers, process):
+        """
+            @param registry: MetricsRegistry object
+            @param headers: message headers
+            @param process: name of the process
+        """
+        self._registry = registry
+        self._headers = headers
+        self._process = process
+        ## Connection of this thread, and the cursor method it had before it was wrapped
+        self._db = None
+        self._cursor = None
+        self._queries = []
+
+    def __enter__(self):
+        # Wrap the cursors of this thread's connection while the message is processed
+        self._db = connections[DEFAULT_DB_ALIAS]
+        self._cursor = vars(self._db).get('cursor')
+        cursor = self._db.cursor
+        self._db.cursor = lambda: _TimedCursor(cursor(), self)
+        return self
+
+    def _stop_query_tracking(self):
+        """
+            Stop recording queries and return the list of queries
+        """
+        if self._cursor is None:
+            del self._db.cursor
+        else:
+            # Cursor wrapper of an enclosing tracker
+            self._db.cursor = self._cursor
+        return self._queries
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        queries = self._stop_query_tracking()
+
+        labels = {'process': self._process,
+                  'destination': self._headers.get('destination', '')}
+        self._registry.inc('amq_messages_total', labels,
+                           help_text='Number of messages processed, per destination')
+        if exc_type is not None:
+            self._registry.inc('amq_message_errors_total', labels,
+                               help_text='Number of messages that could not be processed')
+
+        labels = {'process': self._process}
+        self._registry.observe('db_queries_per_message', len(queries), labels, buckets=QUERY_BUCKETS,
+                               help_text='Number of DB queries needed to process a message')
+        self._registry.observe('db_query_seconds_per_message', sum([float(q.get('time', 0)) for q in queries]), labels,
+                               help_text='DB time needed to process a message')
+        # Let exceptions propagate
+        return False
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        HTTP handler returning the metrics
+    """
+    def do_GET(self):
+        """
+            Return the metrics in the Prometheus text format
+        """
+        content = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        """
+            Don't log every request
+        """
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """
+        Thread serving the metrics over HTTP on a local port
+    """
+    def __init__(self, port, host='localhost'):
+        """
+            @param port: port to listen to
+            @param host: interface to listen to
+        """
+        super(MetricsServer, self).__init__(name="metrics_server")
+        self.daemon = True
+        self._server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+            Stop serving
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def start_server(port, host='localhost'):
+    """
+        Start serving the metrics. Returns the server thread, or None
+        if the server could not be started.
+        @param port: port to listen to, or None to disable the server
+        @param host: interface to listen to
+    """
+    if port is None:
+        return None
+    try:
+        server = MetricsServer(port, host)
+        server.start()
+        logging.info("Serving metrics on %s:%s", host, port)
+        return server
+    except:
+        logging.error("Could not start metrics server on port %s: %s", port, sys.exc_value)
+    return None
+
+
+## Process-wide registry
+registry = MetricsRegistry()
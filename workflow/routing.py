@@ -0,0 +1,166 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Routing table for the tasks defined in the DB.
+
+    Each Task entry maps an (instrument, input queue) pair to an action
+    class and a list of queues to send messages to. The whole table is
+    loaded in a few queries and kept in memory, so that routing a message
+    is a dictionary lookup. Action classes are imported once.
+
+    The table is reloaded after ROUTING_REFRESH_INTERVAL seconds, and
+    as soon as a Task is changed within this process.
+
+    Usage:
+        route = get_routing_table().get('eqsans', 'REDUCTION.REQUEST')
+        if route is not None:
+            route.action_cls(connection=connection)(headers, message)
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import django
+from django.db.models.signals import post_save, post_delete, m2m_changed
+if django.VERSION[1]>=7:
+    from workflow.database.report.models import Task
+else:
+    from database.report.models import Task
+from settings import ROUTING_REFRESH_INTERVAL
+
+# Action classes, keyed by their full name
+_action_classes = {}
+
+
+def import_action_class(task_class):
+    """
+        Import an action class given its full name, like "states.Reduction_request".
+        Classes are only imported once.
+        @param task_class: full name of the class
+    """
+    if task_class not in _action_classes:
+        toks = task_class.strip().split('.')
+        module = '.'.join(toks[:len(toks)-1])
+        cls = toks[len(toks)-1]
+        # Same lookup as "from <module> import <cls>" in this package
+        action_module = __import__(module, globals(), {}, [cls], -1)
+        _action_classes[task_class] = getattr(action_module, cls)
+    return _action_classes[task_class]
+
+
+class Route(object):
+    """
+        Resolved task definition
+    """
+    def __init__(self, task_class, task_queues):
+        """
+            @param task_class: full name of the action class, or None
+            @param task_queues: list of queue names to send the message to
+        """
+        ## Full name of the action class
+        self.task_class = task_class
+        ## Action class, or None if there isn't one or it can't be imported
+        self.action_cls = None
+        ## Reason why the action class could not be imported
+        self.error = None
+        ## List of queue names to send the message to
+        self.task_queues = task_queues
+        if task_class is not None:
+            try:
+                self.action_cls = import_action_class(task_class)
+            except:
+                self.error = str(sys.exc_value)
+                logging.error("Could not import task class %s: %s", task_class, self.error)
+
+
+class RoutingTable(object):
+    """
+        In-memory copy of the Task table, keyed by (instrument, input queue)
+    """
+    def __init__(self, refresh_interval=ROUTING_REFRESH_INTERVAL):
+        """
+            @param refresh_interval: number of seconds after which the table is reloaded
+        """
+        self._refresh_interval = refresh_interval
+        self._routes = {}
+        self._last_refresh = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+            Reload the whole table from the DB
+        """
+        routes = {}
+        duplicates = set()
+        task_list = Task.objects.select_related('instrument_id', 'input_queue_id') \
+            .prefetch_related('task_queue_ids')
+        for task in task_list:
+            key = (task.instrument_id.name, task.input_queue_id.name)
+            if key in routes:
+                duplicates.add(key)
+                continue
+            task_class = None
+            if task.task_class is not None and len(task.task_class.strip()) > 0:
+                task_class = task.task_class.strip()
+            routes[key] = Route(task_class, [q.name for q in task.task_queue_ids.all()])
+        for key in duplicates:
+            logging.error("Sanity check problem: %s has more than one action for %s queue", key[0], key[1])
+            del routes[key]
+        with self._lock:
+            self._routes = routes
+            self._last_refresh = time.time()
+
+    def invalidate(self):
+        """
+            Force a reload of the table on the next lookup
+        """
+        self._last_refresh = None
+
+    def get(self, instrument, input_queue):
+        """
+            Return the Route for a given instrument and queue,
+            or None if there is no task defined for them.
+            @param instrument: instrument name
+            @param input_queue: name of the queue the message came from
+        """
+        if self._last_refresh is None or time.time() - self._last_refresh > self._refresh_interval:
+            self.refresh()
+        routes = self._routes
+        key = (instrument.lower(), input_queue)
+        if key in routes:
+            return routes[key]
+        # Queue names may be given as a prefix of the full name.
+        # Remember the result, including when no task is found, until the next refresh.
+        match = None
+        for (route_instrument, route_queue), route in routes.items():
+            if route_instrument == key[0] and route_queue.startswith(input_queue):
+                match = route
+                break
+        routes[key] = match
+        return match
+
+
+_routing_table = None
+_routing_table_lock = threading.Lock()
+
+def get_routing_table():
+    """
+        Return the process-wide routing table
+    """
+    global _routing_table
+    with _routing_table_lock:
+        if _routing_table is None:
+            _routing_table = RoutingTable()
+        return _routing_table
+
+def _task_changed(sender, **kwargs):
+    """
+        Signal handler invalidating the routing table when a Task changes
+    """
+    if _routing_table is not None:
+        _routing_table.invalidate()
+
+post_save.connect(_task_changed, sender=Task)
+post_delete.connect(_task_changed, sender=Task)
+m2m_changed.connect(_task_changed, sender=Task.task_queue_ids.through)
@@ -0,0 +1,360 @@
+#pylint: disable=bare-except, invalid-name, too-many-instance-attributes, too-many-arguments
+"""
+    Scheduling of the messages sent to the reduction and cataloging workers.
+
+    Live runs and reprocessing requests are sent to the same worker queues.
+    Without scheduling, a large reprocessing request for one instrument fills
+    those queues and delays the processing of new runs on every instrument.
+
+    The Scheduler holds the messages sent to the scheduled queues and
+    releases them as workers become available:
+      - the number of outstanding jobs of each queue is capped. A job is
+        outstanding from the time its message is sent until the matching
+        COMPLETE, ERROR, NOT_NEEDED or DISABLED status message is received
+        (e.g. REDUCTION.COMPLETE for REDUCTION.DATA_READY), or until it times out. The timeout counts
+        from the STARTED status message once it is received.
+      - messages for live runs, those coming from one of the live input queues
+        (POSTPROCESS.DATA_READY), are always released before the others,
+        such as those coming from REDUCTION.REQUEST or CATALOG.REQUEST.
+      - otherwise, the next message comes from the instrument with the fewest
+        outstanding jobs, so that each instrument gets its share of the workers.
+
+    Every held message is stored in the ScheduledMessage table, so that
+    it is not lost when the workflow manager restarts. Only the oldest
+    queue_size messages of each queue, priority and instrument are kept
+    in memory. The others are read back from the table as they are needed.
+
+    Messages are submitted, and status messages received, only once the
+    transaction of the message that triggered them is committed (see
+    StateAction.send() and group_commit.on_commit()). submit() and
+    dispatch() therefore never run within a transaction that could be
+    rolled back, and the held messages are committed to the table before
+    they are queued in memory. Should a read find none of the messages
+    expected in the table, it is retried by poll(), and the messages are
+    only considered lost if they still can't be found after SPILL_GRACE_TIME.
+
+    The outstanding jobs are only kept in memory. After a restart, the
+    jobs sent before the restart are not counted.
+
+    Usage:
+        scheduler = Scheduler(send, ['REDUCTION.DATA_READY'], max_outstanding=20)
+        scheduler.load()
+        # Instead of sending the message
+        scheduler.submit('/queue/REDUCTION.DATA_READY', message, source='REDUCTION.REQUEST')
+        # For every message received
+        scheduler.status_received(headers['destination'], message)
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import sys
+import time
+import logging
+import threading
+import collections
+from envelope import Envelope
+from state_utilities import decode_message
+from database import transactions
+
+# Time after which messages that can't be read back from the DB are considered lost [secs]
+SPILL_GRACE_TIME = 60
+
+
+def _job_key(message):
+    """
+        Return the (instrument, run number) of a message
+        @param message: message content
+    """
+    try:
+        data = Envelope.wrap(message).to_dict()
+    except:
+        try:
+            data = decode_message(message)
+        except:
+            return '', ''
+    return str(data.get('instrument', '')).lower(), str(data.get('run_number', ''))
+
+
+class Scheduler(object):
+    """
+        Holds the messages sent to worker queues until a worker is available
+    """
+    def __init__(self, send, queues, max_outstanding=20, live_queues=None,
+                 queue_size=100, job_timeout=21600, store=transactions):
+        """
+            @param send: function sending a message, taking a destination and a message
+            @param queues: list of the names of the queues to schedule
+            @param max_outstanding: maximum number of outstanding jobs for each queue
+            @param live_queues: list of the input queues of live runs
+            @param queue_size: maximum number of messages kept in memory for each queue, priority and instrument
+            @param job_timeout: time after which an outstanding job is no longer counted [secs]
+            @param store: module storing the held messages (see database/transactions.py)
+        """
+        self._send = send
+        self._queues = set([q.replace('/queue/', '') for q in queues])
+        self._max_outstanding = max(1, max_outstanding)
+        self._live_queues = set(live_queues) if live_queues is not None else set()
+        self._queue_size = max(1, queue_size)
+        self._job_timeout = job_timeout
+        self._store = store
+        self._lock = threading.Lock()
+        ## Status queues of each scheduled queue, e.g. REDUCTION.COMPLETE for REDUCTION.DATA_READY
+        self._status_queues = {}
+        for queue in self._queues:
+            prefix = queue.rsplit('.', 1)[0]
+            self._status_queues['%s.STARTED' % prefix] = (queue, True)
+            self._status_queues['%s.COMPLETE' % prefix] = (queue, False)
+            self._status_queues['%s.ERROR' % prefix] = (queue, False)
+            # Workers also answer without processing the run, e.g. REDUCTION.NOT_NEEDED
+            self._status_queues['%s.NOT_NEEDED' % prefix] = (queue, False)
+            self._status_queues['%s.DISABLED' % prefix] = (queue, False)
+        ## Messages in memory for each (queue, is_live, instrument), as (entry ID, run number, message)
+        self._pending = {}
+        ## Number of messages only found in the DB, for each (queue, is_live, instrument)
+        self._spilled = {}
+        ## Keys being read back from the DB
+        self._refilling = set()
+        ## Time of the last message stored in the DB only, for each (queue, is_live, instrument)
+        self._last_spilled = {}
+        ## Time of the first read that found no message, for each (queue, is_live, instrument)
+        self._empty_since = {}
+        ## Entry IDs of the messages being sent
+        self._sending = set()
+        ## Send times of the outstanding jobs of each queue, for each (instrument, run number)
+        self._outstanding = dict([(queue, {}) for queue in self._queues])
+        ## Number of outstanding jobs for each queue, and for each (queue, instrument)
+        self._queue_load = dict([(queue, 0) for queue in self._queues])
+        self._load = {}
+        ## Time of the last message sent for each (queue, instrument)
+        self._last_sent = {}
+        ## Usage counters
+        self.sent = 0
+        self.started = 0
+        self.timed_out = 0
+
+    def handles(self, destination):
+        """
+            Return True if the messages sent to a queue are scheduled
+            @param destination: queue name
+        """
+        return destination.replace('/queue/', '') in self._queues
+
+    def load(self):
+        """
+            Read back the messages held before a restart
+        """
+        try:
+            counts = self._store.count_scheduled_messages()
+        except:
+            logging.error("Could not read the scheduled messages: %s", sys.exc_value)
+            return
+        with self._lock:
+            for queue, is_live, instrument, count in counts:
+                self._spilled[(queue, is_live, instrument)] = count
+                # Messages held for a queue that is no longer scheduled are still sent
+                self._outstanding.setdefault(queue, {})
+                self._queue_load.setdefault(queue, 0)
+        for queue, is_live, instrument, _ in counts:
+            self._refill((queue, is_live, instrument))
+        logging.info("Scheduler: %d messages waiting", sum([c[3] for c in counts]))
+        self.dispatch()
+
+    def submit(self, destination, message, source=None):
+        """
+            Hold a message until a worker is available for it
+            @param destination: queue to send the message to
+            @param message: message content
+            @param source: input queue of the message that triggered this one
+        """
+        queue = destination.replace('/queue/', '')
+        instrument, run_number = _job_key(message)
+        is_live = source in self._live_queues
+        key = (queue, is_live, instrument)
+        try:
+            entry_id = self._store.save_scheduled_message(queue, is_live, instrument, run_number, message)
+        except:
+            logging.error("Could not store scheduled message: %s", sys.exc_value)
+            entry_id = None
+        with self._lock:
+            pending = self._pending.setdefault(key, collections.deque())
+            # Messages already in the DB only are sent first
+            if entry_id is not None and (self._spilled.get(key, 0) > 0 or len(pending) >= self._queue_size):
+                self._spilled[key] = self._spilled.get(key, 0) + 1
+                self._last_spilled[key] = time.time()
+            else:
+                pending.append((entry_id, run_number, message))
+        self.dispatch()
+
+    def status_received(self, destination, message):
+        """
+            Track the outstanding jobs from the status messages of the workers
+            @param destination: queue the status message was received on
+            @param message: message content
+        """
+        status = self._status_queues.get(destination.replace('/queue/', ''))
+        if status is None:
+            return
+        queue, is_started = status
+        instrument, run_number = _job_key(message)
+        with self._lock:
+            send_times = self._outstanding[queue].get((instrument, run_number))
+            if send_times is None:
+                return
+            if is_started:
+                # The job timeout counts from the time the worker started
+                self.started += 1
+                send_times[0] = time.time()
+                send_times.sort()
+                return
+            self._remove_job(queue, instrument, run_number, 0)
+        self.dispatch()
+
+    def poll(self):
+        """
+            Forget the jobs that timed out, read back the messages
+            that could not be found in the DB before, and send the
+            messages for which a worker is available
+        """
+        cutoff = time.time() - self._job_timeout
+        with self._lock:
+            spilled = [key for key, count in self._spilled.items() if count > 0]
+        for key in spilled:
+            self._refill(key)
+        with self._lock:
+            for queue in self._outstanding:
+                for (instrument, run_number), send_times in self._outstanding[queue].items():
+                    while (instrument, run_number) in self._outstanding[queue] and send_times[0] < cutoff:
+                        self._remove_job(queue, instrument, run_number, 0)
+                        self.timed_out += 1
+                        logging.warning("Scheduler: %s r%s timed out on %s", instrument, run_number, queue)
+        self.dispatch()
+
+    def dispatch(self):
+        """
+            Send the held messages for which a worker is available
+        """
+        while True:
+            with self._lock:
+                key = self._next_key()
+                if key is None:
+                    return
+                queue, _, instrument = key
+                entry_id, run_number, message = self._pending[key].popleft()
+                self._sending.add(entry_id)
+                self._add_job(queue, instrument, run_number)
+            try:
+                self._send('/queue/%s' % queue, message)
+                self.sent += 1
+            except:
+                logging.error("Scheduler could not send to %s: %s", queue, sys.exc_value)
+                # Put the message back and try again later
+                with self._lock:
+                    self._pending[key].appendleft((entry_id, run_number, message))
+                    self._remove_job(queue, instrument, run_number, -1)
+                    self._sending.discard(entry_id)
+                return
+            try:
+                if entry_id is not None:
+                    self._store.delete_scheduled_message(entry_id)
+            except:
+                logging.error("Could not delete scheduled message %s: %s", entry_id, sys.exc_value)
+            with self._lock:
+                self._sending.discard(entry_id)
+            self._refill(key)
+
+    def _add_job(self, queue, instrument, run_number):
+        """
+            Count a job as outstanding. Must be called with the lock held.
+        """
+        self._outstanding[queue].setdefault((instrument, run_number), []).append(time.time())
+        self._queue_load[queue] += 1
+        self._load[(queue, instrument)] = self._load.get((queue, instrument), 0) + 1
+        self._last_sent[(queue, instrument)] = time.time()
+
+    def _remove_job(self, queue, instrument, run_number, index):
+        """
+            Stop counting a job as outstanding. Must be called with the lock held.
+            @param index: 0 for the oldest job of the run, -1 for the latest
+        """
+        send_times = self._outstanding[queue][(instrument, run_number)]
+        send_times.pop(index)
+        if len(send_times) == 0:
+            del self._outstanding[queue][(instrument, run_number)]
+        self._queue_load[queue] -= 1
+        self._load[(queue, instrument)] -= 1
+
+    def _next_key(self):
+        """
+            Return the (queue, is_live, instrument) of the next message
+            to send, or None. Must be called with the lock held.
+        """
+        for is_live in [True, False]:
+            best_key = None
+            best_rank = None
+            for key, pending in self._pending.items():
+                queue, key_is_live, instrument = key
+                if key_is_live != is_live or len(pending) == 0:
+                    continue
+                if self._queue_load[queue] >= self._max_outstanding:
+                    continue
+                # Fewest outstanding jobs first, then the one that waited the longest
+                rank = (self._load.get((queue, instrument), 0),
+                        self._last_sent.get((queue, instrument), 0))
+                if best_rank is None or rank < best_rank:
+                    best_key = key
+                    best_rank = rank
+            if best_key is not None:
+                return best_key
+        return None
+
+    def _refill(self, key):
+        """
+            Read back messages from the DB when few are left in memory
+            @param key: (queue, is_live, instrument)
+        """
+        with self._lock:
+            pending = self._pending.setdefault(key, collections.deque())
+            if key in self._refilling or self._spilled.get(key, 0) == 0 \
+                or len(pending) > self._queue_size / 2:
+                return
+            self._refilling.add(key)
+            exclude_ids = [item[0] for item in pending if item[0] is not None] + list(self._sending)
+            count = self._queue_size - len(pending)
+        try:
+            entries = self._store.load_scheduled_messages(key[0], key[1], key[2], exclude_ids, count)
+        except:
+            logging.error("Could not read the scheduled messages: %s", sys.exc_value)
+            with self._lock:
+                self._refilling.discard(key)
+            return
+        with self._lock:
+            self._refilling.discard(key)
+            pending = self._pending.setdefault(key, collections.deque())
+            for entry_id, run_number, message in entries:
+                pending.append((entry_id, run_number, message.encode('utf-8')))
+            if len(entries) > 0:
+                self._spilled[key] = max(0, self._spilled[key] - len(entries))
+                self._empty_since.pop(key, None)
+                return
+            # The messages may not be committed yet: only give up on them
+            # if they can't be found for a while and no message was added since
+            now = time.time()
+            if key not in self._empty_since or self._last_spilled.get(key, 0) >= self._empty_since[key]:
+                self._empty_since[key] = now
+            elif now - self._empty_since[key] > SPILL_GRACE_TIME:
+                logging.error("Scheduler: %d messages for %s could not be found", self._spilled[key], str(key))
+                self._spilled[key] = 0
+                del self._empty_since[key]
+
+    def waiting(self):
+        """
+            Return the number of messages waiting to be sent
+        """
+        with self._lock:
+            return sum([len(p) for p in self._pending.values()]) + sum(self._spilled.values())
+
+    def outstanding(self):
+        """
+            Return the number of outstanding jobs
+        """
+        with self._lock:
+            return sum(self._queue_load.values())
@@ -12,6 +12,67 @@ CATALOG_DATA_READY = "CATALOG.DATA_READY"
 REDUCTION_DATA_READY = "REDUCTION.DATA_READY"
 REDUCTION_CATALOG_DATA_READY = "REDUCTION_CATALOG.DATA_READY"
 
+# Time between reloads of the task definitions from the DB [secs]
+ROUTING_REFRESH_INTERVAL = 60
+
+# Workflow verification: incomplete runs are checked in chunks of
+# WORKFLOW_CHECK_CHUNK_SIZE runs. A check stops after WORKFLOW_CHECK_TIME_BUDGET
+# seconds and resumes on the next pass of the listening loop.
+WORKFLOW_CHECK_CHUNK_SIZE = 500
+WORKFLOW_CHECK_TIME_BUDGET = 5
+# Recovery messages are sent at most RECOVERY_RATE per second,
+# with bursts of up to RECOVERY_BURST messages.
+RECOVERY_RATE = 1.0
+RECOVERY_BURST = 20
+
+# Number of threads processing workflow messages. Messages for a given
+# run are always processed by the same thread, in the order they came in.
+# Set to zero to process messages on the AMQ receiver thread.
+WORKER_THREADS = 0
+# Maximum number of messages received but not yet processed by the worker threads
+MAX_IN_FLIGHT = 1000
+
+# Acknowledgement of workflow messages: "auto", "client" or "client-individual".
+# Set to None to use "auto". In the client modes, processed messages are
+# acknowledged every ACK_BATCH_SIZE messages or every ACK_INTERVAL milliseconds.
+ACK_MODE = None
+ACK_BATCH_SIZE = 1
+ACK_INTERVAL = 0
+# Maximum number of unacknowledged messages sent by the broker. None for the broker default.
+PREFETCH_SIZE = None
+
+# Redelivered messages are dropped if a message with the same ID was
+# received within DEDUP_WINDOW seconds. The last DEDUP_CAPACITY message IDs
+# are kept in memory. Older ones are looked up in the DB.
+DEDUP_CAPACITY = 10000
+DEDUP_WINDOW = 3600
+
+# Group commit: status entries of messages arriving within GROUP_COMMIT_WINDOW
+# milliseconds are written in a single DB transaction of at most
+# GROUP_COMMIT_SIZE messages. Set GROUP_COMMIT_WINDOW to None to disable.
+GROUP_COMMIT_WINDOW = None
+GROUP_COMMIT_SIZE = 50
+
+# Scheduling of the messages sent to the workers. Messages sent to the
+# SCHEDULED_QUEUES are held until fewer than SCHEDULER_MAX_OUTSTANDING jobs
+# of the queue are waiting for their COMPLETE, ERROR or NOT_NEEDED message. Messages for
+# live runs, coming from the SCHEDULER_LIVE_QUEUES, are sent first. Otherwise,
+# instruments with the fewest outstanding jobs are served first.
+# For example: SCHEDULED_QUEUES = [REDUCTION_DATA_READY, CATALOG_DATA_READY]
+# Leave empty to send all messages right away.
+SCHEDULED_QUEUES = []
+SCHEDULER_MAX_OUTSTANDING = 20
+SCHEDULER_LIVE_QUEUES = ['POSTPROCESS.DATA_READY']
+# Number of held messages kept in memory for each queue, priority and instrument.
+# The others are only kept in the DB until they are needed.
+SCHEDULER_QUEUE_SIZE = 100
+# Time after which a job without COMPLETE, ERROR or NOT_NEEDED message is no longer counted [secs]
+SCHEDULER_JOB_TIMEOUT = 6*60*60
+
+# Local port on which throughput and latency metrics are served
+# in the Prometheus text format. Set to None to disable.
+METRICS_PORT = 9121
+
 # Import local settings if available
 try:
     from local_settings import *
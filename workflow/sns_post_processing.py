@@ -18,8 +18,15 @@ else:
     from settings import icat_passcode as wkflow_passcode
 
 from settings import LOGGING_LEVEL
+from settings import METRICS_PORT
+from settings import GROUP_COMMIT_WINDOW, GROUP_COMMIT_SIZE
+from settings import WORKER_THREADS, MAX_IN_FLIGHT
+from settings import ACK_MODE, ACK_BATCH_SIZE, ACK_INTERVAL, PREFETCH_SIZE
+from settings import SCHEDULED_QUEUES, SCHEDULER_MAX_OUTSTANDING, SCHEDULER_LIVE_QUEUES
+from settings import SCHEDULER_QUEUE_SIZE, SCHEDULER_JOB_TIMEOUT
 from daemon import Daemon
 from database import transactions
+import metrics
 
 import os
 import argparse
@@ -65,7 +72,7 @@ class WorkflowDaemon(Daemon):
         """
         check_frequency = 24
         workflow_check = False
-        auto_ack = True
+        auto_ack = ACK_MODE in [None, 'auto']
         if self._check_frequency is not None:
             check_frequency = self._check_frequency
             workflow_check = True
@@ -76,11 +83,25 @@ class WorkflowDaemon(Daemon):
                    workflow_recovery=self._workflow_recovery,
                    flexible_tasks=self._flexible_tasks,
                    consumer_name="workflow_manager_%s" % self.pidfile,
-                   auto_ack=auto_ack)
-
-        listener = Listener(use_db_tasks=self._flexible_tasks, auto_ack=auto_ack)
+                   auto_ack=auto_ack,
+                   worker_threads=WORKER_THREADS,
+                   max_in_flight=MAX_IN_FLIGHT,
+                   ack_mode=ACK_MODE,
+                   prefetch_size=PREFETCH_SIZE,
+                   ack_batch_size=ACK_BATCH_SIZE,
+                   ack_interval=ACK_INTERVAL)
+
+        listener = Listener(use_db_tasks=self._flexible_tasks, auto_ack=auto_ack,
+                            group_commit_window=GROUP_COMMIT_WINDOW,
+                            group_commit_size=GROUP_COMMIT_SIZE)
         listener.set_amq_user(brokers, wkflow_user, wkflow_passcode)
+        listener.configure_scheduler(SCHEDULED_QUEUES,
+                                     max_outstanding=SCHEDULER_MAX_OUTSTANDING,
+                                     live_queues=SCHEDULER_LIVE_QUEUES,
+                                     queue_size=SCHEDULER_QUEUE_SIZE,
+                                     job_timeout=SCHEDULER_JOB_TIMEOUT)
         c.set_listener(listener)
+        metrics.start_server(METRICS_PORT)
         c.listen_and_wait(0.1)
 
 def run_daemon(pid_file, stdout_file, stderr_file, check_frequency, recover, flexible_tasks, command):
@@ -1,6 +1,6 @@
 import logging
 from database import transactions
-import json
+from envelope import Envelope
 import sys
 
 def decode_message(message):
@@ -46,27 +46,25 @@ def logged_action(action):
         Decorator used to log a received message before processing it
     """
     def process_function(self, headers, message):
-        # See if we have a JSON message
-        try:
-            data = json.loads(message)
-        except:
-            data = decode_message(message)
-            message = json.dumps(data)
+        # Decode the message once. See if we have a JSON message.
+        if isinstance(message, Envelope):
+            envelope = message
+        else:
+            try:
+                envelope = Envelope(message, headers=headers)
+            except:
+                envelope = Envelope.from_data(decode_message(message), headers=headers)
         
         destination = headers["destination"].replace('/queue/','')
-        logging.info("%s r%s: %s: %s" % (data["instrument"],
-                                         data["run_number"],
+        logging.info("%s r%s: %s: %s" % (envelope.get("instrument"),
+                                         envelope.get("run_number"),
                                          destination,
-                                         str(data)))
-        transactions.add_status_entry(headers, message)
+                                         str(envelope.to_dict())))
+        transactions.add_status_entry(headers, envelope)
         
         # Clean up the extra information 
-        if data.has_key('information'):
-            del data['information']
-        if data.has_key('error'):
-            del data['error']
-        message = json.dumps(data)
+        envelope = envelope.without('information', 'error')
         
-        return action(self, headers, message)
+        return action(self, headers, envelope)
 
     return process_function
\ No newline at end of file
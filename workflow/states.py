@@ -8,7 +8,10 @@ from state_utilities import logged_action
 from settings import POSTPROCESS_ERROR, CATALOG_DATA_READY
 from settings import REDUCTION_DATA_READY, REDUCTION_CATALOG_DATA_READY
 from database import transactions
-import json
+from routing import get_routing_table
+from envelope import Envelope
+from group_commit import on_commit
+from django.db import transaction
 import logging
 import sys
 import stomp
@@ -18,14 +21,18 @@ class StateAction(object):
         Base class for processing messages
     """
     _send_connection = None
-    def __init__(self, connection=None, use_db_task=False):
+    def __init__(self, connection=None, use_db_task=False, scheduler=None, source=None):
         """
             Initialization
             @param connection: AMQ connection to use to send messages
             @param use_db_task: if True, a task definition will be looked for in the DB when executing the action
+            @param scheduler: Scheduler holding the messages sent to the worker queues
+            @param source: input queue of the message being processed
         """
         self._user_db_task = use_db_task
         self._send_connection = connection
+        self._scheduler = scheduler
+        self._source = source
 
     def _call_default_task(self, headers, message):
         """
@@ -41,32 +48,48 @@ class StateAction(object):
         # Find a custom action for this message
         if destination in globals():
             action_cls = globals()[destination]
-            action_cls(connection=self._send_connection)(headers, message)
+            action_cls(connection=self._send_connection,
+                       scheduler=self._scheduler, source=self._source)(headers, message)
             
-    def _call_db_task(self, task_data, headers, message):
+    def _call_db_task(self, route, headers, message):
         """
-            @param task_data: JSON-encoded task definition
+            @param route: Route object for the task
             @param headers: message headers
             @param message: JSON-encoded message content
         """
-        task_def = json.loads(task_data)
-        if 'task_class' in task_def and len(task_def['task_class'].strip())>0:
+        if route.task_class is not None:
             try:
-                toks = task_def['task_class'].strip().split('.')
-                module = '.'.join(toks[:len(toks)-1])
-                cls = toks[len(toks)-1]
-                exec "from %s import %s as action_cls" % (module, cls)
-                action_cls(connection=self._send_connection)(headers, message)
+                if route.action_cls is None:
+                    raise ImportError(route.error)
+                route.action_cls(connection=self._send_connection,
+                                 scheduler=self._scheduler, source=self._source)(headers, message)
             except:
                 logging.error("Task [%s] failed: %s" % (headers["destination"], sys.exc_value))
-        if 'task_queues' in task_def:
-            for item in task_def['task_queues']:
-                destination = '/queue/%s' % item
-                self.send(destination=destination, message=message, persistent='true')
-        
-                headers = {'destination': destination, 
-                          'message-id': ''}
-        
+        for item in route.task_queues:
+            destination = '/queue/%s' % item
+            self.send(destination=destination, message=message, persistent='true')
+
+    def _get_route(self, headers, message):
+        """
+            Find the task defined in the DB for a message.
+            Returns None if there isn't one.
+            @param headers: message headers
+            @param message: JSON-encoded message content
+        """
+        if "destination" not in headers:
+            logging.error("StateAction got badly formed message header")
+            return None
+        try:
+            envelope = Envelope.wrap(message)
+        except:
+            logging.error("StateAction expects JSON-encoded message: %s", sys.exc_value)
+            return None
+        if not envelope.has_key("instrument"):
+            logging.error("StateAction could not find instrument information")
+            return None
+        destination = headers["destination"].replace('/queue/','')
+        return get_routing_table().get(envelope.get("instrument"), destination)
+
     @logged_action
     def __call__(self, headers, message):
         """
@@ -74,11 +97,14 @@ class StateAction(object):
             @param headers: message headers
             @param message: JSON-encoded message content
         """
+        if self._source is None:
+            self._source = headers["destination"].replace('/queue/','')
+
         # Find task definition in DB if available
         if self._user_db_task:
-            task_data = transactions.get_task(headers, message)
-            if task_data is not None:
-                self._call_db_task(task_data, headers, message)
+            route = self._get_route(headers, message)
+            if route is not None:
+                self._call_db_task(route, headers, message)
                 return
             
         # If we made it here we need to use default tasks
@@ -88,27 +114,50 @@ class StateAction(object):
         """
             Send a message to a queue
             @param destination: name of the queue
-            @param message: message content
-        """
-        logging.debug("Send: %s" % destination)
-        if self._send_connection is not None:
-            if stomp.__version__[0]<4:
-                self._send_connection.send(destination=destination, 
-                                           message=message, 
-                                           persistent=persistent)
-            else:
-                self._send_connection.send(destination, message, persistent=persistent)
-            headers = {'destination': destination, 
-                       'message-id': ''}
-            transactions.add_status_entry(headers, message)
-        else:
+            @param message: JSON-encoded message content or Envelope
+        """
+        # Messages to the worker queues wait for a worker to be available.
+        # They are stored and queued once the entries of the message being
+        # processed are committed, so that a rollback doesn't leave them queued.
+        if self._scheduler is not None and self._scheduler.handles(destination):
+            scheduler = self._scheduler
+            source = self._source
+            on_commit(lambda: scheduler.submit(destination, message, source=source))
+            return
+
+        if self._send_connection is None:
             logging.error("No AMQ connection to send to %s" % destination)
             headers = {'destination': '/queue/%s' % POSTPROCESS_ERROR, 
                        'message-id': ''}
-            data_dict = json.loads(message)
-            data_dict['error'] = "No AMQ connection: Could not send to %s" % destination
-            message = json.dumps(data_dict)
+            envelope = Envelope.wrap(message)
+            message = envelope.with_values(error="No AMQ connection: Could not send to %s" % destination)
+            transactions.add_status_entry(headers, message)
+            return
+
+        # The entry of the sent message is part of the transaction of the
+        # message being processed, and is published once it is committed.
+        # Outside of a group commit, the message is published right away
+        # and its entry is rolled back if it can't be published.
+        headers = {'destination': destination, 
+                   'message-id': ''}
+        with transaction.atomic(savepoint=False):
             transactions.add_status_entry(headers, message)
+            on_commit(lambda: self._publish(destination, message, persistent))
+
+    def _publish(self, destination, message, persistent):
+        """
+            Publish a message to the broker
+            @param destination: name of the queue
+            @param message: JSON-encoded message content or Envelope
+            @param persistent: 'true' if the message should be persisted by the broker
+        """
+        logging.debug("Send: %s" % destination)
+        if stomp.__version__[0]<4:
+            self._send_connection.send(destination=destination, 
+                                       message=message, 
+                                       persistent=persistent)
+        else:
+            self._send_connection.send(destination, message, persistent=persistent)
 
 
 class Postprocess_data_ready(StateAction):
@@ -0,0 +1,118 @@
+#pylint: disable=bare-except, invalid-name, too-many-arguments
+"""
+    Pool of worker threads for the workflow manager.
+
+    The stomp receiver thread only hands incoming messages over to the
+    workers, so that a burst of messages for one instrument doesn't hold up
+    the others. Messages are partitioned by (instrument, run number): all
+    the messages for a given run are processed by the same worker, in the
+    order they were received.
+
+    Messages are never dropped. The number of messages received but not
+    yet handled is limited: once the limit is reached, the receiver thread
+    waits for a worker to catch up.
+
+    Each message is acknowledged by its worker once it is processed, or
+    once its group commit is done. Since messages complete out of order,
+    subscriptions must use individual acknowledgements so that acknowledging
+    a message doesn't also acknowledge messages still being processed.
+
+    @copyright: 2016 Oak Ridge National Laboratory
+"""
+import threading
+from envelope import Envelope
+from state_utilities import decode_message
+from group_commit import GroupCommitter
+
+
+class WorkerPool(object):
+    """
+        Pool of threads processing workflow messages
+    """
+
+    def __init__(self, process, ack, number_of_workers=4, max_in_flight=1000,
+                 group_commit_window=None, group_commit_size=50, failed=None):
+        """
+            @param process: function processing a message, taking the headers and message.
+                            It must raise an exception if processing fails.
+            @param ack: function acknowledging a message, taking its headers
+            @param number_of_workers: number of worker threads
+            @param max_in_flight: maximum number of messages received but not yet handled
+            @param group_commit_window: if not None, messages arriving within this number of milliseconds share a DB transaction
+            @param group_commit_size: maximum number of messages sharing a DB transaction
+            @param failed: function called with the headers of each message that could not be committed
+        """
+        number_of_workers = max(1, number_of_workers)
+        max_in_flight = max(1, max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._workers = []
+        for i in range(number_of_workers):
+            worker = GroupCommitter(process, ack,
+                                    window=group_commit_window,
+                                    batch_size=group_commit_size,
+                                    queue_size=max_in_flight,
+                                    done=self._done,
+                                    failed=failed,
+                                    name="workflow_worker_%d" % i)
+            worker.start()
+            self._workers.append(worker)
+
+    @staticmethod
+    def partition_key(message):
+        """
+            Return the (instrument, run number) of a message, used
+            to assign it to a worker, and the decoded message.
+            @param message: message content
+        """
+        try:
+            message = Envelope.wrap(message)
+            data = message.to_dict()
+        except:
+            try:
+                data = decode_message(message)
+            except:
+                return message, message
+        try:
+            return (str(data["instrument"]).lower(), str(data["run_number"])), message
+        except:
+            return message, message
+
+    def submit(self, headers, message):
+        """
+            Queue a message for processing. This blocks while
+            the maximum number of messages in flight is reached.
+            @param headers: message headers
+            @param message: message content
+        """
+        key, message = self.partition_key(message)
+        self._in_flight.acquire()
+        self._workers[hash(key) % len(self._workers)].submit(headers, message)
+
+    def _done(self, headers):
+        """
+            Called by a worker when it is done with a message
+            @param headers: message headers
+        """
+        self._in_flight.release()
+
+    def __len__(self):
+        return sum([len(worker) for worker in self._workers])
+
+    def stop(self):
+        """
+            Process the pending messages and stop the worker threads
+        """
+        for worker in self._workers:
+            worker.stop()
+
+    def stats(self):
+        """
+            Return a dictionary of queue depths and per-worker counters
+        """
+        workers = []
+        for worker in self._workers:
+            workers.append({'depth': len(worker),
+                            'messages': worker.messages,
+                            'commits': worker.commits,
+                            'failed_commits': worker.failed_commits})
+        return {'depth': len(self), 'workers': workers}
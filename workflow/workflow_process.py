@@ -9,91 +9,216 @@ if django.VERSION[1]>=7:
     from workflow.database.report.models import WorkflowSummary, RunStatus
 else:
     from database.report.models import WorkflowSummary, RunStatus
+from django.db.models import Max
 from states import StateAction
 import json
+import time
 import logging
 import datetime
 
 from settings import POSTPROCESS_INFO, CATALOG_DATA_READY
 from settings import REDUCTION_DATA_READY, REDUCTION_CATALOG_DATA_READY
+from settings import WORKFLOW_CHECK_CHUNK_SIZE, WORKFLOW_CHECK_TIME_BUDGET
+from settings import RECOVERY_RATE, RECOVERY_BURST
+
+# Source given to the scheduler for recovery messages, which are never sent as live runs
+RECOVERY_SOURCE = 'WORKFLOW.RECOVERY'
+
+class TokenBucket(object):
+    """
+        Token bucket rate limiter
+    """
+    def __init__(self, rate, burst):
+        """
+            @param rate: number of tokens added per second
+            @param burst: maximum number of tokens available at once
+        """
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = self._burst
+        self._last_update = time.time()
+
+    def consume(self, count=1):
+        """
+            Take tokens from the bucket. Returns False if there
+            aren't enough tokens available, in which case none are taken.
+            A request for more than the burst size is granted when
+            the bucket is full.
+            @param count: number of tokens needed
+        """
+        now = time.time()
+        self._tokens = min(self._burst, self._tokens + (now - self._last_update) * self._rate)
+        self._last_update = now
+        if self._tokens >= min(count, self._burst):
+            self._tokens -= count
+            return True
+        return False
 
 class WorkflowProcess(StateAction):
     
-    def __init__(self, connection=None, recovery=True, allowed_lag=3600):
+    def __init__(self, connection=None, recovery=True, allowed_lag=3600,
+                 chunk_size=WORKFLOW_CHECK_CHUNK_SIZE, time_budget=WORKFLOW_CHECK_TIME_BUDGET,
+                 recovery_rate=RECOVERY_RATE, recovery_burst=RECOVERY_BURST, scheduler=None):
         """
             @param connection: AMQ connection
             @param recovery: if True, the system will try to recover from workflow problems
             @param allowed_lag: minimum number of seconds since last activity needed before identifying a problem
+            @param chunk_size: number of runs loaded at once
+            @param time_budget: maximum number of seconds spent in a call to verify_workflow()
+            @param recovery_rate: maximum number of recovery messages per second
+            @param recovery_burst: maximum number of recovery messages sent in a burst
+            @param scheduler: Scheduler holding the recovery messages sent to the worker queues
         """
-        super(WorkflowProcess, self).__init__(connection=connection)
+        super(WorkflowProcess, self).__init__(connection=connection, scheduler=scheduler,
+                                              source=RECOVERY_SOURCE)
         self._recovery = recovery
         # Amount of time allowed before we start worrying about workflow issues
         if allowed_lag is None:
             self._allowed_lag = datetime.timedelta(days=1)
         else:
             self._allowed_lag = datetime.timedelta(seconds=allowed_lag)
+        self._chunk_size = chunk_size
+        self._time_budget = time_budget
+        self._rate_limit = TokenBucket(recovery_rate, recovery_burst)
+        ## WorkflowSummary IDs of the check in progress, and position of the next one to check
+        self._pending_ids = None
+        self._position = 0
+        ## WorkflowSummary entries of the current chunk, by ID, and position of the end of the chunk
+        self._summaries = {}
+        self._chunk_end = 0
+        ## Run held back by the recovery rate limit, and the recovery it needs
+        self._blocked = None
         
     def __call__(self, *args, **kwargs):
         return self.verify_workflow()
-    
+
+    def set_connection(self, connection):
+        """
+            Set the AMQ connection used to send recovery messages
+            @param connection: AMQ connection
+        """
+        self._send_connection = connection
+
+    def stale_runs(self):
+        """
+            Return the IDs of the incomplete WorkflowSummary entries for runs
+            that haven't received a message within the allowed lag.
+        """
+        cutoff = datetime.datetime.utcnow().replace(tzinfo=utc) - self._allowed_lag
+        run_list = WorkflowSummary.objects.incomplete() \
+            .annotate(last_activity=Max('run_id__runstatus__created_on')) \
+            .filter(last_activity__lt=cutoff).order_by('id')
+        return list(run_list.values_list('id', flat=True))
+
     def verify_workflow(self):
         """
             Walk through the data runs and make sure they have
-            gone through the whole workflow.            
+            gone through the whole workflow.
+            Returns True when all the runs have been checked. Returns False
+            when the time budget or the recovery rate limit was reached,
+            in which case the next call resumes where this one stopped.
         """    
-        logging.info("Verifying workflow completeness")
-        # Get a list of run with an incomplete workflow
-        run_list = WorkflowSummary.objects.incomplete()
-        logging.info(" - list generated")
-        
+        t_start = time.time()
+        if self._pending_ids is None:
+            logging.info("Verifying workflow completeness")
+            # Get a list of run with an incomplete workflow
+            self._pending_ids = self.stale_runs()
+            self._position = 0
+            self._summaries = {}
+            self._chunk_end = 0
+            self._blocked = None
+            logging.info(" - list generated: %d runs", len(self._pending_ids))
+
+        while self._position < len(self._pending_ids):
+            # A run held back by the rate limit waits for enough tokens
+            # before going back to the DB. Its status may have changed since.
+            if self._blocked is not None:
+                summary, recovery_list = self._blocked
+                if not self._rate_limit.consume(len(recovery_list)):
+                    return False
+                self._blocked = None
+                self._recover_run(summary, self._check_run(summary))
+                self._position += 1
+                continue
+            if time.time() - t_start > self._time_budget:
+                logging.info(" - time budget reached: %d runs left to check",
+                             len(self._pending_ids) - self._position)
+                return False
+            if self._position >= self._chunk_end:
+                self._load_chunk()
+            summary = self._summaries.get(self._pending_ids[self._position])
+            if summary is not None:
+                recovery_list = self._check_run(summary)
+                if self._recovery and len(recovery_list) > 0 \
+                    and not self._rate_limit.consume(len(recovery_list)):
+                    self._blocked = (summary, recovery_list)
+                    logging.info(" - recovery rate limit reached: %d runs left to check",
+                                 len(self._pending_ids) - self._position)
+                    return False
+                self._recover_run(summary, recovery_list)
+            self._position += 1
+
+        self._pending_ids = None
+        self._summaries = {}
+        logging.info(" - verification completed")
+        return True
+
+    def _load_chunk(self):
+        """
+            Load the WorkflowSummary entries of the next chunk of runs to check
+        """
+        chunk = self._pending_ids[self._position:self._position + self._chunk_size]
+        self._summaries = {}
+        for r in WorkflowSummary.objects.filter(id__in=chunk) \
+            .select_related('run_id__instrument_id', 'run_id__ipts_id'):
+            self._summaries[r.id] = r
+        self._chunk_end = self._position + len(chunk)
+
+    def _check_run(self, r):
+        """
+            Update the workflow status of a single run and return the list
+            of (information, queue) for the recovery messages it needs
+            @param r: WorkflowSummary object
+        """
+        r.update()
+        if r.complete is True:
+            return []
+
+        # The workflow for this run is still incomplete
+        recovery_list = []
+        # Run is not cataloged
+        if r.cataloged is False:
+            recovery_list.append(("Cataloging incomplete for %s", CATALOG_DATA_READY))
+        # Run hasn't been reduced
+        if r.reduction_needed is True and r.reduced is False:
+            recovery_list.append(("Reduction incomplete for %s", REDUCTION_DATA_READY))
+        # Reduced data hasn't been cataloged
+        if r.reduction_needed is True and r.reduced is True and \
+            r.reduction_cataloged is False:
+            recovery_list.append(("Reduction cataloging incomplete for %s", REDUCTION_CATALOG_DATA_READY))
+        return recovery_list
+
+    def _recover_run(self, r, recovery_list):
+        """
+            Log the problems found for a run, and send the recovery
+            messages if recovery is enabled
+            @param r: WorkflowSummary object
+            @param recovery_list: list of (information, queue) returned by _check_run()
+        """
+        if len(recovery_list) == 0:
+            return
         # Dummy header for information logging
         logging_headers = {'destination': '/queue/%s' % POSTPROCESS_INFO, 
                            'message-id': ''}
-        
-        for r in run_list:            
-            r.update()
-            # Identify a problem only if the last message received is more
-            # than a minimum amount of time
-            now = datetime.datetime.utcnow().replace(tzinfo=utc)
-            if r.complete is False and \
-                now-RunStatus.objects.last_timestamp(r.run_id)>self._allowed_lag:
-                # The workflow for this run is still incomplete
-                # Generate a JSON description of the run, to be used
-                # when sending a message
-                message = r.run_id.json_encode()
-                data_dict = json.loads(message)
-                
-                # Run is not cataloged
-                if r.cataloged is False:
-                    data_dict["information"] = "Cataloging incomplete for %s" % str(r)
-                    logging.warn(data_dict["information"])
-                    message = json.dumps(data_dict)
-                    # Log this information
-                    transactions.add_status_entry(logging_headers, message)
-                    if self._recovery:
-                        self.send(destination='/queue/%s' % CATALOG_DATA_READY,
-                                           message=message, persistent='true')
-            
-                # Run hasn't been reduced
-                if r.reduction_needed is True and r.reduced is False:
-                    data_dict["information"] = "Reduction incomplete for %s" % str(r)
-                    logging.warn(data_dict["information"])
-                    message = json.dumps(data_dict)
-                    # Log this information
-                    transactions.add_status_entry(logging_headers, message)
-                    if self._recovery:
-                        self.send(destination='/queue/%s' % REDUCTION_DATA_READY,
-                                           message=message, persistent='true')                    
-                
-                # Reduced data hasn't been cataloged
-                if r.reduction_needed is True and r.reduced is True and \
-                    r.reduction_cataloged is False:
-                    data_dict["information"] = "Reduction cataloging incomplete for %s" % str(r)
-                    logging.warn(data_dict["information"])
-                    message = json.dumps(data_dict)
-                    # Log this information
-                    transactions.add_status_entry(logging_headers, message)
-                    if self._recovery:
-                        self.send(destination='/queue/%s' % REDUCTION_CATALOG_DATA_READY,
-                                           message=message, persistent='true')                    
-        logging.info(" - verification completed")
+        # Generate a JSON description of the run, to be used
+        # when sending a message
+        data_dict = json.loads(r.run_id.json_encode())
+        for information, queue in recovery_list:
+            data_dict["information"] = information % str(r)
+            logging.warn(data_dict["information"])
+            message = json.dumps(data_dict)
+            # Log this information
+            transactions.add_status_entry(logging_headers, message)
+            if self._recovery:
+                self.send(destination='/queue/%s' % queue,
+                          message=message, persistent='true')